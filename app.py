@@ -1,25 +1,43 @@
+import time
+# 起動レポート用（このモジュールの読み込みにかかった時間）
+_IMPORT_STARTED = time.perf_counter()
 import os
 import json
-import gspread
-import pandas as pd
 import re
 from datetime import datetime, timedelta, timezone
 import traceback
-import requests
-import threading
+import uuid
+from functools import lru_cache
 
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, g
 from flask_cors import CORS
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
-from linebot.v3 import WebhookHandler
+from urllib3.util.retry import Retry
+from linebot.v3 import WebhookParser
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
-    PushMessageRequest, ReplyMessageRequest, TextMessage,
-    FlexMessage, FlexContainer
-)
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent
+# pandas・geopy・linebot.v3.messaging は読み込みに時間がかかるので、使う処理の中で import する
+
+from sheets_gateway import SheetsGateway
+from salon_repository import SalonRepository
+from geo import SpatialIndex
+from salon_filter import SalonFilterIndex
+from salon_ranker import LocalRanker, parse_weights
+from ranking_prompt import build_ranking_prompt, LlmCallStats
+from offer_text_cache import OfferTextCache
+from http_client import HttpClient, Upstream
+from line_delivery import LineDeliverer, plan_deliveries
+from notifier import NotificationQueue
+from line_webhook import WebhookDispatcher, BatchCollector
+from flex_templates import FlexTemplate, Slot, validated_container
+from geocode_cache import GeocodeCache
+from job_queue import JobQueue, QueueFullError
+from pipeline import Step, run_step_graph
+from offer_queue import OfferQueueReader
+from datastore import LocalStore, SALON_SHEET
+from sheet_sync import SheetSync
+from metrics import MetricsRegistry, CONTENT_TYPE, log_event
+from profiler import SlowRequestProfiler
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 CORS(app)
@@ -32,21 +50,163 @@ LINE_CONTACT_LIFF_ID = "2008066763-Rv0z80wl"
 SALON_DETAIL_LIFF_ID = "2008066763-Exlv1lLY"
 SATO_EMAIL = "sato@lumina-beauty.co.jp"
 
+# --- メトリクス ---
+# 外部サービスの呼び出し・リクエスト・オファー処理の各ステップの時間と回数（/metrics で Prometheus 形式で出す）
+metrics = MetricsRegistry()
+upstream_seconds = metrics.histogram(
+    'lumina_upstream_request_seconds', '外部サービス（sheets・nominatim・gemini・line・brevo・gas）の呼び出し時間（再試行を含む）',
+    ('upstream', 'operation', 'outcome'),
+)
+http_request_seconds = metrics.histogram('lumina_http_request_seconds', 'Flask のリクエスト処理時間', ('method', 'route', 'status'))
+offer_job_seconds = metrics.histogram('lumina_offer_job_seconds', '登録処理ジョブ（process_offer_background）1回の処理時間', ('outcome',))
+offer_job_step_seconds = metrics.histogram('lumina_offer_job_step_seconds', '登録処理ジョブの各ステップの処理時間', ('step', 'outcome'))
+offer_queue_stage_seconds = metrics.histogram('lumina_offer_queue_stage_seconds', '/process-offer-queue の各段階の処理時間', ('stage',))
+offer_queue_rows = metrics.counter('lumina_offer_queue_rows_total', '/process-offer-queue で処理した Offer Queue の行数', ('status',))
+
+def observe_upstream(upstream, operation, seconds, outcome):
+    upstream_seconds.observe(seconds, upstream=upstream, operation=operation, outcome=outcome)
+
+# SLOW_REQUEST_PROFILE_SECONDS を設定すると、それ以上かかったリクエストのスタックをサンプリングして記録する（/admin/slow-requests）
+SLOW_REQUEST_PROFILE_SECONDS = float(os.environ.get('SLOW_REQUEST_PROFILE_SECONDS', 0))
+slow_request_profiler = SlowRequestProfiler(
+    SLOW_REQUEST_PROFILE_SECONDS,
+    interval_seconds=float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 10)) / 1000,
+) if SLOW_REQUEST_PROFILE_SECONDS > 0 else None
+
 # --- 認証設定 ---
 creds_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', '/etc/secrets/delta-wonder-471708-u1-93f8d5bbdf1c.json')
+# Google Sheets はプロセス全体で1つのクライアントを共有する
+sheets = SheetsGateway(creds_path, pool_size=int(os.environ.get('SHEETS_POOL_SIZE', 10)), observer=observe_upstream)
+# ユーザー管理・店舗マスタ・オファー管理・Offer Queue はローカルの SQLite を読み書きし、シートとは裏で同期する
+store = LocalStore()
+# 店舗マスタはメモリにキャッシュし、TTL切れ後は裏で（ローカルから）読み直す
+salon_repo = SalonRepository(
+    store.all_salons,
+    ttl_seconds=int(os.environ.get('SALON_CACHE_TTL_SECONDS', 300)),
+    stale_seconds=int(os.environ.get('SALON_CACHE_STALE_SECONDS', 3600)),
+)
+salon_repo.register_derived('spatial_index', lambda snapshot: SpatialIndex.from_records(snapshot.records))
+salon_repo.register_derived('salon_filter', lambda snapshot: SalonFilterIndex.from_records(snapshot.records))
+
+def create_nominatim():
+    from geopy.geocoders import Nominatim
+    return Nominatim(user_agent="lumina_offer_geocoder")
+
+# ジオコーディング結果は SQLite に永続化し、Nominatim への問い合わせは1秒に1回までに抑える（geopy は最初の問い合わせで読み込む）
+geocoder = GeocodeCache(
+    create_nominatim,
+    db_path=os.environ.get('GEOCODE_CACHE_PATH'),
+    ttl_seconds=int(os.environ.get('GEOCODE_CACHE_TTL_SECONDS', 30 * 86400)),
+    negative_ttl_seconds=int(os.environ.get('GEOCODE_NEGATIVE_TTL_SECONDS', 86400)),
+    observer=observe_upstream,
+)
+
+# Offer Queue は最初の pending 行から下だけを読む
+offer_queue_reader = OfferQueueReader(lambda: sheets.worksheet("Offer Queue"))
+sheet_sync = SheetSync(
+    store, sheets, offer_queue_reader,
+    push_interval=float(os.environ.get('SHEET_SYNC_PUSH_INTERVAL_SECONDS', 5)),
+    pull_intervals={
+        'users': float(os.environ.get('SHEET_SYNC_USERS_PULL_SECONDS', 60)),
+        'offer_queue': float(os.environ.get('SHEET_SYNC_QUEUE_PULL_SECONDS', 60)),
+        'offers': float(os.environ.get('SHEET_SYNC_OFFERS_PULL_SECONDS', 300)),
+        'salons': float(os.environ.get('SHEET_SYNC_SALONS_PULL_SECONDS', 300)),
+    },
+    # 店舗マスタを取り込んだら、同期スレッド上でスナップショットと空間インデックスを作り直す
+    on_salons_pulled=lambda: salon_repo.refresh(),
+)
+
+# 候補サロンのローカルランキング（AIを呼ぶ前の絞り込みと、AI失敗時の代わり）
+local_ranker = LocalRanker(parse_weights(os.environ.get('RANKING_WEIGHTS')))
+# AI呼び出しのプロンプトの大きさと応答時間（/admin/stats で確認できる）
+llm_stats = LlmCallStats()
+
+# 外部API（Brevo・Gemini・GAS・LINE）への呼び出しは共有の接続プール・再試行・サーキットブレーカーを通す
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+outbound = HttpClient([
+    Upstream.from_env('brevo', timeout=10, max_retries=2),
+    Upstream.from_env('gemini', timeout=60, max_retries=2),
+    Upstream.from_env('gas', timeout=5, max_retries=2),
+    Upstream.from_env('line', timeout=10, max_retries=3),
+], pool_size=HTTP_POOL_SIZE, observer=observe_upstream)
+
+# Webhook は署名の検証だけをしてすぐ応答し、イベントはワーカースレッドで処理する
+handler = WebhookDispatcher(
+    WebhookParser(os.environ.get('YOUR_CHANNEL_SECRET')),
+    concurrency=int(os.environ.get('LINE_WEBHOOK_CONCURRENCY', 4)),
+    max_pending=int(os.environ.get('LINE_WEBHOOK_MAX_PENDING', 1000)),
+)
+_line_api_client = None
+_line_api_client_pid = None
+
+@lru_cache(maxsize=None)
+def line_configuration():
+    from linebot.v3.messaging import Configuration
+    configuration = Configuration(access_token=os.environ.get('YOUR_CHANNEL_ACCESS_TOKEN'))
+    configuration.connection_pool_maxsize = HTTP_POOL_SIZE
+    # LINE SDK の再試行は urllib3 に任せる（push は X-Line-Retry-Key を付けるので、再送しても二重には届かない）
+    configuration.retries = Retry(
+        total=outbound.upstream('line').max_retries, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=None,
+        backoff_factor=0.5, respect_retry_after_header=True, raise_on_status=False,
+    )
+    return configuration
+
+def line_messaging_api():
+    """プロセス内で共有する ApiClient（接続プール）を使う MessagingApi を返す"""
+    from linebot.v3.messaging import ApiClient, MessagingApi
+    global _line_api_client, _line_api_client_pid
+    if _line_api_client is None or _line_api_client_pid != os.getpid():
+        _line_api_client, _line_api_client_pid = ApiClient(line_configuration()), os.getpid()
+    return MessagingApi(_line_api_client)
+
+def line_call(fn, operation, retry_key=None):
+    """
+    LINE API の呼び出しを、タイムアウトとサーキットブレーカー付きで実行する（operation はメトリクス用の種類）。
+    retry_key を付けた送信の 409 は「同じキーの送信は受け付け済み」なので、送れたものとして扱う。
+    """
+    try:
+        return outbound.guard('line', lambda: fn(outbound.upstream('line').timeout), operation=operation)
+    except Exception as e:
+        if retry_key is None or getattr(e, 'status', None) != 409: raise
+        print(f"LINE {operation}: リトライキー {retry_key} の送信は受け付け済みです")
+        return None
+
+# X-Line-Retry-Key（UUID 形式）。同じ送信のやり直しには同じキーを使い、LINE 側で二重に届かないようにする
+LINE_RETRY_KEY_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'lumina-offer-bot/line-retry-key')
 
-# LINE API
-configuration = Configuration(access_token=os.environ.get('YOUR_CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.environ.get('YOUR_CHANNEL_SECRET'))
+def line_retry_key(*parts):
+    return str(uuid.uuid5(LINE_RETRY_KEY_NAMESPACE, ':'.join(str(part) for part in parts)))
 
 # タイムゾーン
 JST = timezone(timedelta(hours=+9))
 GAS_WEBHOOK_URL = os.environ.get('GAS_WEBHOOK_URL')
+# GAS 側がまとめた通知（POST の {"events": [...]}）を受け付けるなら 1 にする。0 のときは1件ずつ GET で送る
+GAS_WEBHOOK_BATCH = os.environ.get('GAS_WEBHOOK_BATCH') == '1'
+
+def notify_gas_follows(items):
+    if GAS_WEBHOOK_BATCH:
+        outbound.post('gas', GAS_WEBHOOK_URL, json={'events': items}, operation='follow_batch').raise_for_status()
+        print(f"GASへのFollowイベント通知成功: {len(items)}件")
+        return
+    for params_to_gas in items:
+        try:
+            outbound.get('gas', GAS_WEBHOOK_URL, params=params_to_gas, operation='follow').raise_for_status()
+            print(f"GASへのFollowイベント通知成功: {params_to_gas['userId']}")
+        except Exception as e:
+            print(f"GASへのFollowイベント通知に失敗: {e}")
+
+# Followイベントの GAS 通知は数秒ごとにまとめて送る（同じユーザーの重複は1件にする）
+gas_follow_notifier = BatchCollector(
+    'gas-follow', notify_gas_follows,
+    interval_seconds=float(os.environ.get('GAS_NOTIFY_INTERVAL_SECONDS', 5)),
+    max_items=int(os.environ.get('GAS_NOTIFY_BATCH_SIZE', 100)),
+    key=lambda item: item['userId'],
+)
 
 # --- Helper Functions ---
 
 # ★★★ Brevo (旧Sendinblue) APIを使用したメール送信 ★★★
-def send_notification_email(subject, body):
+def send_notification_email(subject, body, raise_on_error=False):
     api_key = os.environ.get('BREVO_API_KEY')
     sender_email = os.environ.get('MAIL_USERNAME') # 送信元（Brevo登録メアド）
     sender_name = "LUMINA Offer System"
@@ -80,20 +240,36 @@ def send_notification_email(subject, body):
     }
 
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
+        response = outbound.post('brevo', url, json=payload, headers=headers, operation='send_email')
         if response.status_code in [200, 201, 202]:
             print(f"メール送信成功: {subject}")
         else:
             print(f"メール送信失敗: {response.status_code} - {response.text}")
+            if raise_on_error: raise Exception(f"Brevo API error: {response.status_code}")
     except Exception as e:
         print(f"メール送信通信エラー: {e}")
         traceback.print_exc()
+        if raise_on_error: raise
+
+# 運営宛て通知はキューに積んでバックグラウンドで送る。
+# NOTIFY_DIGEST_INTERVAL_SECONDS を設定すると、急ぎでない通知（新規登録・アンケート・LINE連絡先）をまとめて1通で送る
+notifications = NotificationQueue(
+    lambda subject, body: send_notification_email(subject, body, raise_on_error=True),
+    digest_seconds=float(os.environ.get('NOTIFY_DIGEST_INTERVAL_SECONDS', 0)),
+    digest_max=int(os.environ.get('NOTIFY_DIGEST_MAX_ITEMS', 50)),
+)
 
-def generate_single_offer_message(user_wishes, salon_info):
+OFFER_MESSAGE_FALLBACK = "サロンの特徴を基に、あなたにぴったりのオファーをご用意しました。ぜひ詳細をご覧ください。"
+
+def generate_single_offer_message(profile, salon_info):
+    """
+    オファー文を生成する（失敗時は例外）。profile は offer_text_cache.offer_profile() で絞った項目だけを受け取り、
+    同じ項目・同じサロンの人には同じ文章を使い回す（氏名などはプロンプトに入れない）。
+    """
     prompt_text = f"""
     あなたは、美容師向けのスカウトサービス「LUMINA Offer」の優秀なAIアシスタントです。
     # 候補者プロフィール:
-    {json.dumps(user_wishes, ensure_ascii=False)}
+    {json.dumps(profile, ensure_ascii=False)}
     # オファーを送るサロン情報:
     {json.dumps(salon_info, ensure_ascii=False, indent=2)}
     # あなたのタスク:
@@ -107,34 +283,41 @@ def generate_single_offer_message(user_wishes, salon_info):
     # 回答フォーマット:
     オファー文章のテキストのみを回答してください。JSON形式は不要です。
     """
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key: raise Exception("GEMINI_API_KEY is not set.")
+    model_name = "gemini-2.5-flash"
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+    headers = {"Content-Type": "application/json"}
+    data = { "contents": [{ "parts": [{"text": prompt_text}] }] }
+    started = time.monotonic()
     try:
-        api_key = os.environ.get('GEMINI_API_KEY')
-        if not api_key: return "AIサービスのAPIキーが設定されていません。"
-        model_name = "gemini-2.5-flash"
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-        headers = {"Content-Type": "application/json"}
-        data = { "contents": [{ "parts": [{"text": prompt_text}] }] }
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+        response = outbound.post('gemini', url, headers=headers, json=data, operation='offer_message')
         response.raise_for_status()
         response_json = response.json()
-        return response_json['candidates'][0]['content']['parts'][0]['text'].strip()
     except Exception as e:
-        print(f"単一オファーメッセージの生成中にエラー: {e}")
-        return "サロンの特徴を基に、あなたにぴったりのオファーをご用意しました。ぜひ詳細をご覧ください。"
+        llm_stats.record('offer_message', prompt_text, (time.monotonic() - started) * 1000, error=str(e))
+        raise
+    usage = response_json.get('usageMetadata') or {}
+    llm_stats.record('offer_message', prompt_text, (time.monotonic() - started) * 1000, prompt_tokens=usage.get('promptTokenCount'))
+    return response_json['candidates'][0]['content']['parts'][0]['text'].strip()
+
+# オファー文は Offer Queue に積むときに生成しておき、同じ組み合わせの文章は使い回す
+offer_text_cache = OfferTextCache(
+    generate_single_offer_message, OFFER_MESSAGE_FALLBACK,
+    ttl_seconds=int(os.environ.get('OFFER_TEXT_CACHE_TTL_SECONDS', 7 * 86400)),
+)
 
 def find_and_select_top_salons(user_wishes):
     try:
-        gc = gspread.service_account(filename=creds_path)
-        salon_master_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("店舗マスタ")
-        all_salons_data = salon_master_sheet.get_all_records()
-        offer_management_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("オファー管理")
-        offer_history = offer_management_sheet.get_all_records()
+        salon_snapshot = salon_repo.snapshot()
+        spatial_index = salon_repo.derived('spatial_index', snapshot=salon_snapshot)
+        salon_filter = salon_repo.derived('salon_filter', snapshot=salon_snapshot)
+        already_sent_salon_ids = store.offered_salon_ids(user_wishes.get('userId'))
     except Exception as e:
         print(f"スプレッドシート読み込みエラー: {e}")
         return [], "スプレッドシート読み込みエラー"
 
-    if not all_salons_data: return [], "サロン情報が見つかりません。"
-    salons_df = pd.DataFrame(all_salons_data)
+    if not salon_snapshot.records: return [], "サロン情報が見つかりません。"
 
     try:
         prefecture = user_wishes.get("area_prefecture", "")
@@ -146,68 +329,26 @@ def find_and_select_top_salons(user_wishes):
             cleaned_detail_area = cleaned_detail_area.replace(word, "")
         full_area = f"{prefecture} {cleaned_detail_area.strip()}"
         
-        geolocator = Nominatim(user_agent="lumina_offer_geocoder")
-        location = geolocator.geocode(full_area, timeout=10)
-        if not location:
+        user_coords = geocoder.geocode(full_area, timeout=10)
+        if not user_coords:
             print(f"ジオコーディング失敗: {full_area}")
             return [], "希望勤務地の位置情報を特定できませんでした。"
-        user_coords = (location.latitude, location.longitude)
     except Exception as e:
         print(f"ジオコーディング中にエラーが発生: {e}")
         return [], "位置情報取得中にエラーが発生しました。"
 
-    salons_df['緯度'] = pd.to_numeric(salons_df['緯度'], errors='coerce')
-    salons_df['経度'] = pd.to_numeric(salons_df['経度'], errors='coerce')
-    salons_df.dropna(subset=['緯度', '経度'], inplace=True)
-
-    distances = [geodesic(user_coords, (salon['緯度'], salon['経度'])).kilometers for _, salon in salons_df.iterrows()]
-    salons_df['距離'] = distances
-    
-    conditionally_matched_salons = salons_df[salons_df['距離'] <= 25].copy()
-    user_role = user_wishes.get("role")
-    user_license = user_wishes.get("license")
-    conditionally_matched_salons = conditionally_matched_salons[conditionally_matched_salons['募集状況'] == '募集中']
-    if conditionally_matched_salons.empty: return [], "募集中のサロンがありません。"
-
-    def role_matcher(salon_roles):
-        roles_list = [r.strip() for r in str(salon_roles).split(',')]
-        return user_role in roles_list
-    conditionally_matched_salons = conditionally_matched_salons[conditionally_matched_salons['役職'].apply(role_matcher)]
-    if conditionally_matched_salons.empty: return [], "役職に合うサロンがありません。"
-
-    if user_license == "取得済み":
-        conditionally_matched_salons = conditionally_matched_salons[conditionally_matched_salons['美容師免許'] == '取得']
-    else:
-        conditionally_matched_salons = conditionally_matched_salons[conditionally_matched_salons['美容師免許'].isin(['取得', '未取得'])]
-    if conditionally_matched_salons.empty: return [], "免許条件に合うサロンがありません。"
-    
-    user_gender = user_wishes.get("gender")
-    if user_gender:
-        conditionally_matched_salons = conditionally_matched_salons[
-            (conditionally_matched_salons['ターゲット性別'].isnull()) |
-            (conditionally_matched_salons['ターゲット性別'] == '') |
-            (conditionally_matched_salons['ターゲット性別'] == '指定なし') |
-            (conditionally_matched_salons['ターゲット性別'] == user_gender)
-        ]
-    if conditionally_matched_salons.empty: return [], "性別の条件に合うサロンがありません。"
-
-    user_age_group = user_wishes.get("age")
-    if user_age_group:
-        conditionally_matched_salons = conditionally_matched_salons[
-            (conditionally_matched_salons['ターゲット年齢'].isnull()) |
-            (conditionally_matched_salons['ターゲット年齢'] == '') |
-            (conditionally_matched_salons['ターゲット年齢'] == '指定なし') |
-            (conditionally_matched_salons['ターゲット年齢'].str.contains(user_age_group, na=False))
-        ]
-    if conditionally_matched_salons.empty: return [], "年齢の条件に合うサロンがありません。"
-    
-    already_sent_salon_ids_str = [ str(record['店舗ID']) for record in offer_history if record['ユーザーID'] == user_wishes.get('userId') ]
-    if already_sent_salon_ids_str:
-        conditionally_matched_salons = conditionally_matched_salons[
-            ~conditionally_matched_salons['店舗ID'].astype(str).isin(already_sent_salon_ids_str)
-        ]
-        if conditionally_matched_salons.empty:
-            return [], "条件に合うサロンはありますが、すべて過去にオファー済みです。"
+    # 空間インデックスで25km圏内の店舗だけを取り出す
+    positions, distances = spatial_index.query_radius(user_coords[0], user_coords[1], 25)
+    if len(positions) == 0: return [], "希望勤務地の25km圏内にサロンがありません。"
+    # 募集状況・役職・免許・性別・年齢・オファー済みは、スナップショット読み込み時に作った型付き列でまとめて判定する
+    distance_by_position = dict(zip(positions.tolist(), distances.tolist()))
+    selected, reason = salon_filter.select(user_wishes, positions, exclude_salon_ids=already_sent_salon_ids)
+    if reason: return [], reason
+    import pandas as pd
+    conditionally_matched_salons = pd.DataFrame([salon_snapshot.records[i] for i in selected])
+    conditionally_matched_salons['緯度'] = pd.to_numeric(conditionally_matched_salons['緯度'], errors='coerce')
+    conditionally_matched_salons['経度'] = pd.to_numeric(conditionally_matched_salons['経度'], errors='coerce')
+    conditionally_matched_salons['距離'] = [distance_by_position[i] for i in selected.tolist()]
 
     top_salons = []
     
@@ -219,50 +360,89 @@ def find_and_select_top_salons(user_wishes):
 
     remaining_slots = 5 - len(top_salons)
     if remaining_slots > 0 and not conditionally_matched_salons.empty:
-        salons_json_string = conditionally_matched_salons.to_json(orient='records', force_ascii=False)
-        prompt_text = f"""
-        # あなたのタスク
-        以下の候補者プロフィールと求人リストを基に、最もマッチ度が高い順に最大{remaining_slots}件のサロンの「店舗ID」をリストで回答してください。
-        # 候補者プロフィール:
-        {json.dumps(user_wishes, ensure_ascii=False)}
-        # 候補となる求人リスト:
-        {salons_json_string}
-        # 回答フォーマット
-        JSON形式のリストのみを回答してください。例: [101, 108, 125]
-        """
-        try:
-            api_key = os.environ.get('GEMINI_API_KEY')
-            if not api_key: raise Exception("GEMINI_API_KEY is not set.")
-            model_name = "gemini-2.5-flash"
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-            headers = {"Content-Type": "application/json"}
-            data = { "contents": [{ "parts": [{"text": prompt_text}] }] }
-            response = requests.post(url, headers=headers, json=data, timeout=60)
-            response.raise_for_status()
-            response_json = response.json()
-            response_text = response_json['candidates'][0]['content']['parts'][0]['text']
-            
-            json_str_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if json_str_match:
-                ranked_ids = json.loads(json_str_match.group(0))
-                for salon_id in ranked_ids:
-                    salon_info = conditionally_matched_salons[conditionally_matched_salons['店舗ID'] == salon_id].iloc[0].to_dict()
-                    top_salons.append(salon_info)
-        except Exception as e:
-            print(f"AIによるサロンランキング選出中にエラー: {e}")
+        top_salons.extend(rank_salons(user_wishes, conditionally_matched_salons.to_dict('records'), remaining_slots))
 
     return top_salons, "サロン選出完了"
 
-def create_salon_flex_message(salon, offer_text):
-    db_role = salon.get("役職", "")
-    display_role = "アシスタント" if "アシスタント" in db_role else "スタイリスト"
-    recruitment_type = salon.get("募集", "")
-    salon_id = salon.get('店舗ID')
-    
+def rank_salons_with_llm(user_wishes, candidates, limit, timeout, max_candidates):
+    """
+    Gemini に候補を順位付けさせ、(店舗IDのリスト, プロンプトに入れた候補) を返す（失敗時は例外）。
+    candidates は事前スコアの高い順。プロンプトには必要な列だけを、上位 max_candidates 件までトークン予算内で入れる。
+    """
+    prompt_text, included = build_ranking_prompt(
+        user_wishes, candidates, limit,
+        max_candidates=max_candidates,
+        token_budget=int(os.environ.get('RANKING_PROMPT_TOKEN_BUDGET', 4000)),
+    )
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key: raise Exception("GEMINI_API_KEY is not set.")
+    model_name = "gemini-2.5-flash"
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+    headers = {"Content-Type": "application/json"}
+    data = { "contents": [{ "parts": [{"text": prompt_text}] }] }
+    started = time.monotonic()
+    try:
+        # ランキングはローカルの順位で代替できるので再試行せず、タイムアウトしたらすぐ諦める
+        response = outbound.post('gemini', url, headers=headers, json=data, timeout=timeout, max_retries=0, operation='ranking')
+        response.raise_for_status()
+        response_json = response.json()
+    except Exception as e:
+        llm_stats.record('ranking', prompt_text, (time.monotonic() - started) * 1000, candidates=len(included), error=str(e))
+        raise
+    usage = response_json.get('usageMetadata') or {}
+    llm_stats.record('ranking', prompt_text, (time.monotonic() - started) * 1000, candidates=len(included), prompt_tokens=usage.get('promptTokenCount'))
+    response_text = response_json['candidates'][0]['content']['parts'][0]['text']
+
+    json_str_match = re.search(r'\[.*\]', response_text, re.DOTALL)
+    if not json_str_match: raise Exception(f"ランキングの応答に店舗IDのリストがありません: {response_text[:100]}")
+    return json.loads(json_str_match.group(0)), included
+
+def rank_salons(user_wishes, candidates, limit):
+    """
+    候補サロンから上位 limit 件を選ぶ。RANKING_MODE で方式を切り替える。
+    - local: ローカルのスコアだけで選ぶ（AIを呼ばない）
+    - llm_rerank: ローカルのスコア上位 RANKING_RERANK_TOP_K 件だけを AI に並べ替えさせる（既定）
+    - llm: ローカルのスコア上位 RANKING_PROMPT_MAX_CANDIDATES 件を AI に渡して選ばせる
+    AI が失敗・タイムアウトした場合、RANKING_FALLBACK=local ならローカルの順位で補う（none なら補わない）。
+    """
+    mode = os.environ.get('RANKING_MODE', 'llm_rerank')
+    use_fallback = os.environ.get('RANKING_FALLBACK', 'local') == 'local'
+    started = time.monotonic()
+    local_ranked = local_ranker.rank(user_wishes, candidates)
+    local_ms = (time.monotonic() - started) * 1000
+    if mode == 'local':
+        print(f"ローカルランキング: 候補{len(candidates)}件 {local_ms:.1f}ms")
+        return local_ranked[:limit]
+
+    if mode == 'llm_rerank': max_candidates = int(os.environ.get('RANKING_RERANK_TOP_K', 15))
+    else: max_candidates = int(os.environ.get('RANKING_PROMPT_MAX_CANDIDATES', 50))
+    llm_candidates = []
+    selected = []
+    try:
+        ranked_ids, llm_candidates = rank_salons_with_llm(
+            user_wishes, local_ranked, limit,
+            timeout=float(os.environ.get('RANKING_LLM_TIMEOUT_SECONDS', 20)), max_candidates=max_candidates,
+        )
+        by_id = {str(s.get('店舗ID')): s for s in llm_candidates}
+        for salon_id in ranked_ids:
+            salon = by_id.pop(str(salon_id), None)
+            if salon is not None: selected.append(salon)
+            if len(selected) >= limit: break
+    except Exception as e:
+        print(f"AIによるサロンランキング選出中にエラー: {e}")
+    print(f"サロンランキング({mode}): 候補{len(candidates)}件 → AIに{len(llm_candidates)}件, AI選出{len(selected)}件, ローカル{local_ms:.1f}ms 合計{(time.monotonic() - started) * 1000:.0f}ms")
+
+    if use_fallback and len(selected) < limit:
+        selected_ids = {str(s.get('店舗ID')) for s in selected}
+        selected += [s for s in local_ranked if str(s.get('店舗ID')) not in selected_ids][:limit - len(selected)]
+    return selected
+
+@lru_cache(maxsize=4096)
+def mask_address(address_full):
+    """住所をぼかして表示用の文字列にする（店舗ごとに同じ住所で何度も呼ばれるのでメモ化する）"""
     # ★★★ 変更点: 住所のぼかしロジックを強化 ★★★
-    address_full = salon.get("住所", "")
     masked_address = "エリア: 非公開"
-    
+
     if address_full:
         if "区" in address_full:
             # 「区」があればそこまで（例：東京都新宿区）
@@ -280,23 +460,18 @@ def create_salon_flex_message(salon, offer_text):
             # それ以外は先頭10文字程度まで表示
             cutoff = 10 if len(address_full) > 10 else len(address_full)
             masked_address = "エリア: " + address_full[:cutoff] + "..."
+    return masked_address
 
-    detail_liff_url = f"https://liff.line.me/{SALON_DETAIL_LIFF_ID}?salonId={salon_id}"
-    call_request_liff_url = f"https://liff.line.me/{CALL_REQUEST_LIFF_ID}?salonId={salon_id}"
-    
-    original_image_url = salon.get("画像URL", "")
-    if original_image_url:
-        blurred_image_url = f"https://wsrv.nl/?url={original_image_url}&blur=10&output=jpg"
-    else:
-        blurred_image_url = "https://placehold.co/600x400/333333/FFFFFF/png?text=No+Image"
-    
-    display_salon_name = salon.get("公開用店名", "非公開サロン")
+def _flex_detail_row(label, value):
+    return { "type": "box", "layout": "baseline", "spacing": "sm", "contents": [ { "type": "text", "text": label, "color": "#aaaaaa", "size": "sm", "flex": 2 }, { "type": "text", "text": value, "wrap": True, "color": "#666666", "size": "sm", "flex": 5 } ]}
 
-    return {
+# オファーの bubble（起動時に1回だけ検証し、送るときはスロットだけを埋める）
+SALON_OFFER_TEMPLATE = FlexTemplate(
+    {
         "type": "bubble",
         "hero": {
             "type": "image",
-            "url": blurred_image_url,
+            "url": Slot("image_url"),
             "size": "full",
             "aspectRatio": "20:13",
             "aspectMode": "cover"
@@ -305,14 +480,14 @@ def create_salon_flex_message(salon, offer_text):
             "type": "box",
             "layout": "vertical",
             "contents": [
-                { "type": "text", "text": display_salon_name, "weight": "bold", "size": "xl" },
+                { "type": "text", "text": Slot("salon_name"), "weight": "bold", "size": "xl" },
                 {
                     "type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm",
                     "contents": [
-                        { "type": "box", "layout": "baseline", "spacing": "sm", "contents": [ { "type": "text", "text": "勤務地", "color": "#aaaaaa", "size": "sm", "flex": 2 }, { "type": "text", "text": masked_address, "wrap": True, "color": "#666666", "size": "sm", "flex": 5 } ]},
-                        { "type": "box", "layout": "baseline", "spacing": "sm", "contents": [ { "type": "text", "text": "募集役職", "color": "#aaaaaa", "size": "sm", "flex": 2 }, { "type": "text", "text": display_role, "wrap": True, "color": "#666666", "size": "sm", "flex": 5 } ]},
-                        { "type": "box", "layout": "baseline", "spacing": "sm", "contents": [ { "type": "text", "text": "募集形態", "color": "#aaaaaa", "size": "sm", "flex": 2 }, { "type": "text", "text": recruitment_type, "wrap": True, "color": "#666666", "size": "sm", "flex": 5 } ]},
-                        { "type": "box", "layout": "baseline", "spacing": "sm", "contents": [ { "type": "text", "text": "メッセージ", "color": "#aaaaaa", "size": "sm", "flex": 2 }, { "type": "text", "text": offer_text, "wrap": True, "color": "#666666", "size": "sm", "flex": 5 } ]}
+                        _flex_detail_row("勤務地", Slot("address")),
+                        _flex_detail_row("募集役職", Slot("role")),
+                        _flex_detail_row("募集形態", Slot("recruitment")),
+                        _flex_detail_row("メッセージ", Slot("offer_text")),
                     ]
                 }
             ]
@@ -320,12 +495,38 @@ def create_salon_flex_message(salon, offer_text):
         "footer": {
             "type": "box", "layout": "vertical", "spacing": "sm",
             "contents": [
-                { "type": "button", "style": "primary", "height": "sm", "action": { "type": "uri", "label": "待遇を見る", "uri": detail_liff_url }, "color": "#59A5D8" },
-                { "type": "button", "style": "primary", "height": "sm", "action": { "type": "uri", "label": "サロン名を確認する", "uri": call_request_liff_url }, "color": "#F37335" }
+                { "type": "button", "style": "primary", "height": "sm", "action": { "type": "uri", "label": "待遇を見る", "uri": Slot("detail_url") }, "color": "#59A5D8" },
+                { "type": "button", "style": "primary", "height": "sm", "action": { "type": "uri", "label": "サロン名を確認する", "uri": Slot("call_request_url") }, "color": "#F37335" }
             ],
             "flex": 0
         }
-    }
+    },
+    sample={
+        "image_url": "https://example.com/salon.jpg", "salon_name": "非公開サロン", "address": "エリア: 東京都渋谷区",
+        "role": "スタイリスト", "recruitment": "正社員", "offer_text": OFFER_MESSAGE_FALLBACK,
+        "detail_url": "https://liff.line.me/x?salonId=1", "call_request_url": "https://liff.line.me/y?salonId=1",
+    },
+)
+
+def create_salon_flex_message(salon, offer_text):
+    db_role = salon.get("役職", "")
+    salon_id = salon.get('店舗ID')
+    original_image_url = salon.get("画像URL", "")
+    if original_image_url:
+        blurred_image_url = f"https://wsrv.nl/?url={original_image_url}&blur=10&output=jpg"
+    else:
+        blurred_image_url = "https://placehold.co/600x400/333333/FFFFFF/png?text=No+Image"
+
+    return SALON_OFFER_TEMPLATE.fill(
+        image_url=blurred_image_url,
+        salon_name=str(salon.get("公開用店名", "非公開サロン")),
+        address=mask_address(str(salon.get("住所", "") or "")),
+        role="アシスタント" if "アシスタント" in db_role else "スタイリスト",
+        recruitment=str(salon.get("募集", "")),
+        offer_text=offer_text,
+        detail_url=f"https://liff.line.me/{SALON_DETAIL_LIFF_ID}?salonId={salon_id}",
+        call_request_url=f"https://liff.line.me/{CALL_REQUEST_LIFF_ID}?salonId={salon_id}",
+    )
 
 def get_age_from_birthdate(birthdate):
     today = datetime.today()
@@ -333,27 +534,44 @@ def get_age_from_birthdate(birthdate):
     return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
 
 # --- Background Task ---
-def process_offer_background(user_id, user_wishes):
+def build_user_row_dict(user_id, user_wishes):
+    return { "ユーザーID": user_id, "登録日": datetime.now(JST).strftime('%Y/%m/%d'), "ステータス": 'オファー中', "氏名": user_wishes.get('full_name'), "性別": user_wishes.get('gender'), "生年月日": user_wishes.get('birthdate'), "電話番号": user_wishes.get('phone_number'), "MBTI": user_wishes.get('mbti'), "役職": user_wishes.get('role'), "希望エリア": user_wishes.get('area_prefecture'), "希望勤務地": user_wishes.get('area_detail'), "職場満足度": user_wishes.get('satisfaction'), "興味のある待遇": user_wishes.get('perk'), "現在の状況": user_wishes.get('current_status'), "転職希望時期": user_wishes.get('timing'), "美容師免許": user_wishes.get('license') }
+
+def build_offer_schedule(now_jst):
+    cutoff_time = now_jst.replace(hour=19, minute=30, second=0, microsecond=0)
+    first_send_date = now_jst.date() + timedelta(days=1) if now_jst >= cutoff_time else now_jst.date()
+    return [
+        (first_send_date, "21:30"),
+        (first_send_date + timedelta(days=1), "12:30"),
+        (first_send_date + timedelta(days=1), "20:00"),
+        (first_send_date + timedelta(days=3), "12:30"),
+        (first_send_date + timedelta(days=4), "21:30")
+    ]
+
+def process_offer_background(job):
     """
-    時間のかかる処理（メール、スプレッドシート、AI、LINE）をバックグラウンドで実行
+    時間のかかる処理（メール、スプレッドシート、AI、LINE）をワーカーで実行する。
+    互いに依存しないステップ（メール・ウェルカムメッセージ・ユーザー保存・マッチング）は並行に実行する。
+    副作用のあるステップは job.step() 経由で実行し、失敗時はバックオフ付きで再試行、完了済みのものは再実行時に飛ばす。
     """
-    print(f"Start background process for user: {user_id}")
+    user_id = job.key
+    user_wishes = job.payload
+    print(f"Start background process for user: {user_id} (job {job.job_id}, attempt {job.attempt})")
     # アプリケーションコンテキスト内で実行
     with app.app_context():
-        try:
-            # 1. 年齢計算（メールに載せるため、最初に計算する）
-            if 'birthdate' in user_wishes and user_wishes['birthdate']:
-                try:
-                    age = get_age_from_birthdate(user_wishes.get('birthdate'))
-                    user_wishes['age'] = f"{(age // 10) * 10}代"
-                except: user_wishes['age'] = ''
-
-            # 2. 管理者へメール通知 (Brevo API使用)
+        # 1. 年齢計算（メールに載せるため、最初に計算する）
+        if 'birthdate' in user_wishes and user_wishes['birthdate']:
             try:
-                user_name = user_wishes.get('full_name', '不明なユーザー')
-                subject = f"【LUMINAオファー】{user_name}様から新規プロフィール登録がありました"
-                
-                body = f"""
+                age = get_age_from_birthdate(user_wishes.get('birthdate'))
+                user_wishes['age'] = f"{(age // 10) * 10}代"
+            except: user_wishes['age'] = ''
+
+        # 2. 管理者へメール通知 (Brevo API使用)
+        def notify_admin(_):
+            user_name = user_wishes.get('full_name', '不明なユーザー')
+            subject = f"【LUMINAオファー】{user_name}様から新規プロフィール登録がありました"
+            
+            body = f"""
 新規ユーザー登録がありました。内容を確認してください。
 
 ■ 基本情報
@@ -373,80 +591,193 @@ def process_offer_background(user_id, user_wishes):
 ・現在の状況: {user_wishes.get('current_status')}
 ・転職希望時期: {user_wishes.get('timing')}
 """
-                send_notification_email(subject, body)
-            except Exception as e:
-                print(f"[Background] メール送信エラー: {e}")
-                traceback.print_exc()
+            notifications.enqueue(subject, body)
 
-            # 3. ユーザーへウェルカムメッセージ送信
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    welcome_message = ( "ご登録ありがとうございます！\nLUMINA Offerが、あなたにピッタリな『好待遇サロンの公認オファー』をご連絡いたします。\n楽しみにお待ちください！" )
-                    line_bot_api.push_message(PushMessageRequest( to=user_id, messages=[TextMessage(text=welcome_message)] ))
-            except Exception as e:
-                print(f"[Background] LINE送信エラー: {e}")
-
-            # 4. ユーザー管理シートへの保存
-            try:
-                gc = gspread.service_account(filename=creds_path)
-                user_management_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("ユーザー管理")
-                user_headers = user_management_sheet.row_values(1)
-                user_row_dict = { "ユーザーID": user_id, "登録日": datetime.now(JST).strftime('%Y/%m/%d'), "ステータス": 'オファー中', "氏名": user_wishes.get('full_name'), "性別": user_wishes.get('gender'), "生年月日": user_wishes.get('birthdate'), "電話番号": user_wishes.get('phone_number'), "MBTI": user_wishes.get('mbti'), "役職": user_wishes.get('role'), "希望エリア": user_wishes.get('area_prefecture'), "希望勤務地": user_wishes.get('area_detail'), "職場満足度": user_wishes.get('satisfaction'), "興味のある待遇": user_wishes.get('perk'), "現在の状況": user_wishes.get('current_status'), "転職希望時期": user_wishes.get('timing'), "美容師免許": user_wishes.get('license') }
-                profile_headers = user_headers[:16]
-                profile_row_values = [user_row_dict.get(h, '') for h in profile_headers]
-                cell = user_management_sheet.find(user_id, in_column=1)
-                if cell:
-                    range_to_update = f'A{cell.row}:{chr(ord("A") + len(profile_row_values) - 1)}{cell.row}'
-                    user_management_sheet.update(range_to_update, [profile_row_values])
-                else:
-                    full_row = profile_row_values + [''] * (len(user_headers) - len(profile_headers))
-                    user_management_sheet.append_row(full_row, value_input_option='USER_ENTERED')
-            except Exception as e:
-                print(f"[Background] シート保存エラー: {e}"); traceback.print_exc()
-
-            # 5. オファーマッチングと予約
-            try:
-                user_wishes['userId'] = user_id
-                top_salons, reason = find_and_select_top_salons(user_wishes)
-                
-                if not top_salons:
-                    print(f"[Background] ユーザーID {user_id} にマッチするサロンなし: {reason}")
-                else:
-                    now_jst = datetime.now(JST)
-                    cutoff_time = now_jst.replace(hour=19, minute=30, second=0, microsecond=0)
-                    first_send_date = now_jst.date() + timedelta(days=1) if now_jst >= cutoff_time else now_jst.date()
-                    
-                    schedule = [
-                        (first_send_date, "21:30"),
-                        (first_send_date + timedelta(days=1), "12:30"),
-                        (first_send_date + timedelta(days=1), "20:00"),
-                        (first_send_date + timedelta(days=3), "12:30"),
-                        (first_send_date + timedelta(days=4), "21:30")
-                    ]
-                    
-                    rows_to_append = []
-                    for i, salon in enumerate(top_salons):
-                        if i < len(schedule):
-                            send_date, send_time_str = schedule[i]
-                            send_time_obj = datetime.strptime(send_time_str, "%H:%M").time()
-                            send_at_datetime = datetime.combine(send_date, send_time_obj, tzinfo=JST)
-                            send_at_iso = send_at_datetime.isoformat()
-                            new_row = [user_id, salon['店舗ID'], send_at_iso, 'pending']
-                            rows_to_append.append(new_row)
-
-                    if rows_to_append:
-                        gc_q = gspread.service_account(filename=creds_path)
-                        queue_sheet = gc_q.open("店舗マスタ_LUMINA Offer用").worksheet("Offer Queue")
-                        queue_sheet.append_rows(rows_to_append, value_input_option='USER_ENTERED')
-                        print(f"[Background] {len(rows_to_append)} offers scheduled.")
-
-            except Exception as e:
-                print(f"[Background] オファー予約エラー: {e}"); traceback.print_exc()
+        # 3. ユーザーへウェルカムメッセージ送信
+        def send_welcome(_):
+            from linebot.v3.messaging import PushMessageRequest, TextMessage
+            line_bot_api = line_messaging_api()
+            welcome_message = ( "ご登録ありがとうございます！\nLUMINA Offerが、あなたにピッタリな『好待遇サロンの公認オファー』をご連絡いたします。\n楽しみにお待ちください！" )
+            retry_key = line_retry_key('job', job.job_id, 'send_welcome')
+            line_call(lambda timeout: line_bot_api.push_message(PushMessageRequest( to=user_id, messages=[TextMessage(text=welcome_message)] ), x_line_retry_key=retry_key, _request_timeout=timeout), 'push', retry_key=retry_key)
+
+        # 4. ユーザー管理への保存（シートへは同期スレッドが書き込む）
+        def save_user(_):
+            user_headers = store.headers("ユーザー管理")
+            if not user_headers:
+                # まだシートを取り込んでいない（起動直後・他プロセスの取り込み待ち）。取り込みを待ち、無ければ例外でステップごと再試行する
+                sheet_sync.ensure_initialized()
+                user_headers = store.headers("ユーザー管理")
+                if not user_headers: raise RuntimeError("ユーザー管理のヘッダーをまだ取り込んでいません")
+            user_row_dict = build_user_row_dict(user_id, user_wishes)
+            profile_cells = {i + 1: user_row_dict.get(h, '') for i, h in enumerate(user_headers[:16])}
+            store.upsert_user(user_id, profile_cells, len(user_headers))
+
+        # 5. オファーマッチングと予約
+        def match_salons(_):
+            # 予約まで完了済みならマッチング（ジオコーディング・AI）もやり直さない
+            if job.is_done('schedule_offers'): return [], "予約済み"
+            user_wishes['userId'] = user_id
+            return find_and_select_top_salons(user_wishes)
+
+        # 6. オファー文の事前生成（送信時にはAIを呼ばない）。生成できなかった分は None のまま積み、送信時に生成し直す
+        def generate_offer_texts(inputs):
+            top_salons, _ = inputs['match_salons']
+            schedule_count = len(build_offer_schedule(datetime.now(JST)))
+            return list(offer_generation_executor.map(lambda salon: offer_text_cache.get(user_wishes, salon, fallback=False), top_salons[:schedule_count]))
+
+        def schedule_offers(inputs):
+            top_salons, reason = inputs['match_salons']
+            offer_texts = inputs['generate_offer_texts']
+            if not top_salons:
+                print(f"[Background] ユーザーID {user_id} にマッチするサロンなし: {reason}")
+                return
+
+            schedule = build_offer_schedule(datetime.now(JST))
+            rows_to_append = []
+            for i, salon in enumerate(top_salons):
+                if i < len(schedule):
+                    send_date, send_time_str = schedule[i]
+                    send_time_obj = datetime.strptime(send_time_str, "%H:%M").time()
+                    send_at_datetime = datetime.combine(send_date, send_time_obj, tzinfo=JST)
+                    send_at_iso = send_at_datetime.isoformat()
+                    new_row = [user_id, salon['店舗ID'], send_at_iso, 'pending']
+                    rows_to_append.append(new_row)
+
+            if rows_to_append:
+                store.enqueue_offers(rows_to_append, offer_texts)
+                print(f"[Background] {len(rows_to_append)} offers scheduled.")
+
+        steps = [
+            Step('notify_admin', notify_admin),
+            Step('welcome_message', send_welcome),
+            Step('save_user', save_user),
+            Step('match_salons', match_salons),
+            Step('generate_offer_texts', generate_offer_texts, deps=['match_salons']),
+            Step('schedule_offers', schedule_offers, deps=['match_salons', 'generate_offer_texts']),
+        ]
+        # マッチングとオファー文の生成（キャッシュされる）はチェックポイントせず、それ以外は job.step で再試行・記録する
+        uncheckpointed = ('match_salons', 'generate_offer_texts')
+        run_step = lambda name, call: call() if name in uncheckpointed else job.step(name, call)
+        skipped = set(job.state['done'])
+        _, timings, errors = run_step_graph(steps, offer_step_executor, run_step)
+        job.record('graph_timings', timings)
+        # job.step は失敗を例外にせず job.state['failed'] に記録する
+        failed = set(errors) | set(job.state['failed'])
+        for name, t in timings.items():
+            if name == 'total': continue
+            offer_job_step_seconds.observe(t['duration'], step=name, outcome='skipped' if name in skipped else 'error' if name in failed else 'ok')
+        offer_job_seconds.observe(timings['total']['duration'], outcome='error' if failed else 'ok')
+        log_event(
+            'offer_job', userId=user_id, jobId=job.job_id, attempt=job.attempt, seconds=timings['total']['duration'],
+            steps={name: t['duration'] for name, t in timings.items() if name != 'total'}, skipped=sorted(skipped), failed=sorted(failed),
+        )
+        if errors:
+            # 再試行するとチェックポイント済みのステップは飛ばされる
+            raise next(iter(errors.values()))
+
+# 1ジョブ内のステップを並行実行するためのスレッドプール
+offer_step_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('OFFER_WORKER_CONCURRENCY', 4)) * 4,
+    thread_name_prefix='offer-step',
+)
+# Offer Queue の送信処理用（オファー文生成とLINE送信）
+offer_generation_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('OFFER_GENERATION_CONCURRENCY', 8)), thread_name_prefix='offer-gen')
+line_push_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LINE_PUSH_CONCURRENCY', 8)), thread_name_prefix='line-push')
+# LINE のレート制限（push 2,000回/秒・multicast 200回/秒）より低めに抑える
+line_deliverer = LineDeliverer(
+    push_rate=float(os.environ.get('LINE_PUSH_RATE_PER_SECOND', 1000)),
+    multicast_rate=float(os.environ.get('LINE_MULTICAST_RATE_PER_SECOND', 100)),
+)
 
+# 登録処理のジョブキュー（SQLiteに永続化し、同時実行数を制限する）
+offer_jobs = JobQueue(
+    'offer',
+    process_offer_background,
+    concurrency=int(os.environ.get('OFFER_WORKER_CONCURRENCY', 4)),
+    max_pending=int(os.environ.get('OFFER_QUEUE_MAX_PENDING', 200)),
+    step_attempts=int(os.environ.get('OFFER_STEP_ATTEMPTS', 3)),
+)
+
+# Offer Queue の送信処理は、期限の来た行を SQLite 上で確保してから送る（別プロセスで重なって実行されても二重に送らない）。
+# 確保の期限を過ぎた行は、途中で落ちた実行の分として次の実行が取り直す
+OFFER_QUEUE_CLAIM_SECONDS = float(os.environ.get('OFFER_QUEUE_CLAIM_SECONDS', 600))
+
+# --- リクエストの計測 ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if slow_request_profiler: slow_request_profiler.begin()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    seconds = time.perf_counter() - g.get('request_started', time.perf_counter())
+    http_request_seconds.observe(seconds, method=request.method, route=route, status=response.status_code)
+    if slow_request_profiler:
+        profile = slow_request_profiler.end(f"{request.method} {route}")
+        if profile:
+            log_event('slow_request', method=request.method, route=route, status=response.status_code, seconds=profile['duration_s'], top_lines=profile['top_lines'][:5])
+    return response
+
+# --- シート同期 ---
+@app.before_request
+def start_sheet_sync():
+    # 初回だけ、ローカルに無いシートをその場で取り込んでから同期スレッドを起動する
+    try:
+        sheet_sync.ensure_initialized()
+    except Exception as e:
+        print(f"シートの初回取り込みでエラー: {e}"); traceback.print_exc()
+    sheet_sync.start()
+    # 再起動前に終わらなかったジョブ・送れなかった通知があれば処理する
+    offer_jobs.start()
+    notifications.start()
+
+# --- 起動時のウォームアップ ---
+# gunicorn.conf.py から呼ぶ。import_seconds はこのモジュールの読み込み時間、warm_up は各準備にかかった秒数
+startup_report = {"pid": os.getpid(), "import_seconds": None, "warm_up": {}, "warm_up_errors": {}}
+
+def _warm_imports():
+    import pandas  # noqa: F401
+    import geopy.geocoders  # noqa: F401
+    import linebot.v3.messaging  # noqa: F401
+
+def _warm_flex_templates():
+    SALON_OFFER_TEMPLATE.validate()
+    follow_bubble()
+
+def _warm_salon_snapshot():
+    # 店舗マスタをまだ一度も取り込んでいなければ作らない（空のスナップショットが TTL の間キャッシュされ、preload なら fork 後のワーカーにも引き継がれるため）
+    if not store.is_pulled(SALON_SHEET):
+        print("[startup] 店舗マスタが未取り込みのため、スナップショットの準備を省略します")
+        return
+    snapshot = salon_repo.snapshot()
+    salon_repo.derived('spatial_index', snapshot=snapshot)
+    salon_repo.derived('salon_filter', snapshot=snapshot)
+
+def warm_up(network=True):
+    """
+    最初のリクエストが払っていた準備（重いライブラリの読み込み・テンプレートの検証・店舗スナップショットの構築）を先に済ませる。
+    network=True なら、シートの認証とローカルへの取り込み、LINE の接続、バックグラウンドスレッドの起動も行う
+    （接続やスレッドは fork 後に引き継げないので、gunicorn の preload 時の親プロセスでは network=False で呼ぶ）。
+    """
+    steps = [("imports", _warm_imports), ("flex_templates", _warm_flex_templates)]
+    if network:
+        steps += [("sheets", sheets.spreadsheet), ("local_store", sheet_sync.ensure_initialized)]
+    steps.append(("salon_snapshot", _warm_salon_snapshot))
+    if network:
+        steps += [("line_client", line_messaging_api), ("background_threads", lambda: (sheet_sync.start(), offer_jobs.start(), notifications.start()))]
+    startup_report["pid"] = os.getpid()
+    for name, fn in steps:
+        started = time.perf_counter()
+        try:
+            fn()
         except Exception as e:
-            print(f"[Background] 予期せぬエラー: {e}")
-            traceback.print_exc()
+            startup_report["warm_up_errors"][name] = str(e)
+            print(f"[startup] ウォームアップ {name} でエラー: {e}")
+        startup_report["warm_up"][name] = round(time.perf_counter() - started, 3)
+    print(f"[startup] pid={os.getpid()} import={startup_report['import_seconds']}s warm_up={startup_report['warm_up']}")
+    return startup_report
 
 # --- Routes ---
 
@@ -455,59 +786,63 @@ def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        handler.accept(body, signature)
     except InvalidSignatureError:
         abort(400)
+    except QueueFullError as e:
+        # 処理待ちが多すぎるときは受け付けず、LINE の再送に任せる
+        print(f"Webhookイベントのキューが満杯です: {e}")
+        return "Busy", 503
     return 'OK'
 
+# 友だち追加時のあいさつ（中身は固定なので、1回だけ組み立てて使い回す）
+PROFILE_LIFF_URL = "https://liff.line.me/2008066763-ZJ72p7OJ"
+YOUR_NEW_IMAGE_URL = "https://raw.githubusercontent.com/satoshoma-lumina/lumina-offer-bot/4c57f959238f64d2254550c2347db1d9a625a435/%E3%82%B9%E3%82%AD%E3%83%9E%C3%97MBTI%E8%A8%B4%E6%B1%82_%E6%95%B0%E5%AD%97%E5%A4%89%E6%9B%B4Vr.png"
+FOLLOW_BUBBLE_JSON = {
+    "type": "bubble",
+    "hero": { "type": "image", "url": YOUR_NEW_IMAGE_URL, "size": "full", "aspectRatio": "1024:678", "aspectMode": "fit" },
+    "body": {
+        "type": "box", "layout": "vertical",
+        "contents": [
+            { "type": "text", "text": "”3分”でオファーが届く！", "weight": "bold", "size": "xl", "align": "center" },
+            { "type": "text", "text": "業界初！MBTIで相性マッチ", "wrap": True, "margin": "lg", "size": "md", "color": "#666666", "align": "center" }
+        ],
+        "paddingTop": "xl", "paddingBottom": "lg"
+    },
+    "footer": {
+        "type": "box", "layout": "vertical",
+        "contents": [ { "type": "button", "action": { "type": "uri", "label": "今すぐMBTI入力▶▶", "uri": PROFILE_LIFF_URL }, "style": "primary", "color": "#F37335", "height": "sm", "margin": "sm" } ],
+        "spacing": "sm", "flex": 0, "paddingAll": "md"
+    }
+}
+
+@lru_cache(maxsize=None)
+def follow_bubble():
+    from linebot.v3.messaging import FlexContainer
+    return FlexContainer.from_dict(FOLLOW_BUBBLE_JSON)
+
 @handler.add(FollowEvent)
 def handle_follow(event):
     if GAS_WEBHOOK_URL:
-        try:
-            params_to_gas = { 'userId': event.source.user_id, 'timestamp': event.timestamp }
-            requests.get(GAS_WEBHOOK_URL, params=params_to_gas, timeout=5)
-            print(f"GASへのFollowイベント通知成功: {event.source.user_id}")
-        except Exception as e:
-            print(f"GASへのFollowイベント通知に失敗: {e}")
-    
+        gas_follow_notifier.add({ 'userId': event.source.user_id, 'timestamp': event.timestamp })
+
     try:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            PROFILE_LIFF_URL = "https://liff.line.me/2008066763-ZJ72p7OJ"
-            YOUR_NEW_IMAGE_URL = "https://raw.githubusercontent.com/satoshoma-lumina/lumina-offer-bot/4c57f959238f64d2254550c2347db1d9a625a435/%E3%82%B9%E3%82%AD%E3%83%9E%C3%97MBTI%E8%A8%B4%E6%B1%82_%E6%95%B0%E5%AD%97%E5%A4%89%E6%9B%B4Vr.png"
-            flex_message_json = {
-                "type": "bubble",
-                "hero": { "type": "image", "url": YOUR_NEW_IMAGE_URL, "size": "full", "aspectRatio": "1024:678", "aspectMode": "fit" },
-                "body": {
-                    "type": "box", "layout": "vertical",
-                    "contents": [
-                        { "type": "text", "text": "”3分”でオファーが届く！", "weight": "bold", "size": "xl", "align": "center" },
-                        { "type": "text", "text": "業界初！MBTIで相性マッチ", "wrap": True, "margin": "lg", "size": "md", "color": "#666666", "align": "center" }
-                    ],
-                    "paddingTop": "xl", "paddingBottom": "lg"
-                },
-                "footer": {
-                    "type": "box", "layout": "vertical",
-                    "contents": [ { "type": "button", "action": { "type": "uri", "label": "今すぐMBTI入力▶▶", "uri": PROFILE_LIFF_URL }, "style": "primary", "color": "#F37335", "height": "sm", "margin": "sm" } ],
-                    "spacing": "sm", "flex": 0, "paddingAll": "md"
-                }
-            }
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[FlexMessage(alt_text="LUMINA Offer プロフィール登録", contents=FlexContainer.from_dict(flex_message_json))]
-                )
-            )
+        from linebot.v3.messaging import FlexMessage, ReplyMessageRequest
+        line_bot_api = line_messaging_api()
+        line_call(lambda timeout: line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[FlexMessage(alt_text="LUMINA Offer プロフィール登録", contents=follow_bubble())]
+            ),
+            _request_timeout=timeout,
+        ), 'reply')
     except Exception as e:
         print(f"Followイベントへの返信メッセージ送信エラー: {e}"); traceback.print_exc()
 
 @app.route("/api/salon-detail/<int:salon_id>", methods=['GET'])
 def get_salon_detail(salon_id):
     try:
-        gc = gspread.service_account(filename=creds_path)
-        salon_master_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("店舗マスタ")
-        all_salons = salon_master_sheet.get_all_records()
-        salon_info = next((s for s in all_salons if str(s['店舗ID']) == str(salon_id)), None)
+        salon_info = salon_repo.get(salon_id)
         if salon_info: return jsonify(salon_info)
         else: return jsonify({"error": "Salon not found"}), 404
     except Exception as e:
@@ -522,17 +857,13 @@ def submit_questionnaire():
     data = request.get_json()
     user_id = data.get('userId')
     try:
-        gc = gspread.service_account(filename=creds_path)
-        user_management_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("ユーザー管理")
-        cell = user_management_sheet.find(user_id, in_column=1)
-        if cell:
-            row_to_update = cell.row
-            update_values = [ data.get('q1_area'), data.get('q2_job_changes'), data.get('q3_current_employment'), data.get('q4_experience_years'), data.get('q5_desired_employment'), data.get('q6_priorities'), data.get('q7_improvement_point'), data.get('q8_ideal_beautician') ]
-            user_management_sheet.update(f'Q{row_to_update}:X{row_to_update}', [update_values])
-            user_name = user_management_sheet.cell(row_to_update, 4).value
+        update_values = [ data.get('q1_area'), data.get('q2_job_changes'), data.get('q3_current_employment'), data.get('q4_experience_years'), data.get('q5_desired_employment'), data.get('q6_priorities'), data.get('q7_improvement_point'), data.get('q8_ideal_beautician') ]
+        # Q〜X列（17〜24列目）
+        if store.update_user_cells(user_id, {17 + i: v for i, v in enumerate(update_values)}):
+            user_name = store.get_user(user_id).get('氏名')
             subject = f"【LUMINAオファー】{user_name}様からアンケート回答がありました"
             body = f"{user_name}様（ユーザーID: {user_id}）からアンケート回答がありました。\n内容を確認してください。"
-            send_notification_email(subject, body)
+            notifications.enqueue(subject, body)
             return jsonify({"status": "success", "message": "Questionnaire submitted successfully"})
         else: return jsonify({"status": "error", "message": "User not found"}), 404
     except Exception as e:
@@ -546,15 +877,11 @@ def submit_line_contact():
     line_url = data.get('lineUrl')
     if not user_id or not line_url: return jsonify({"status": "error", "message": "Invalid data"}), 400
     try:
-        gc = gspread.service_account(filename=creds_path)
-        sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("ユーザー管理")
-        cell = sheet.find(user_id, in_column=1)
-        if cell:
-            sheet.update_cell(cell.row, 25, line_url)
-            user_name = sheet.cell(cell.row, 4).value
+        if store.update_user_cells(user_id, {25: line_url}):
+            user_name = store.get_user(user_id).get('氏名')
             subject = f"【LUMINAオファー】{user_name}様からLINE連絡先の登録がありました"
             body = f"{user_name}様（ユーザーID: {user_id}）からLINE連絡先登録。\nURL: {line_url}"
-            send_notification_email(subject, body)
+            notifications.enqueue(subject, body)
             return jsonify({"status": "success", "message": "LINE contact submitted successfully"})
         else: return jsonify({"status": "error", "message": "User not found"}), 404
     except Exception as e:
@@ -572,23 +899,18 @@ def submit_call_request():
         return jsonify({"status": "error", "message": "Missing required fields"}), 400
 
     try:
-        gc = gspread.service_account(filename=creds_path)
-        user_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("ユーザー管理")
-        user_cell = user_sheet.find(user_id, in_column=1)
+        user = store.get_user(user_id)
         user_phone = "不明"; user_name = "不明"
-        if user_cell:
-            user_name = user_sheet.cell(user_cell.row, 4).value
-            user_phone = user_sheet.cell(user_cell.row, 7).value
+        if user:
+            user_name = user.get('氏名')
+            user_phone = user.get('電話番号')
 
-        salon_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("店舗マスタ")
-        all_salons = salon_sheet.get_all_records()
-        salon_info = next((s for s in all_salons if str(s['店舗ID']) == str(salon_id)), None)
+        salon_info = salon_repo.get(salon_id)
         salon_name = salon_info['店舗名'] if salon_info else "サロンID: " + str(salon_id)
 
-        offer_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("オファー管理")
         today_str = datetime.now(JST).strftime('%Y/%m/%d %H:%M:%S')
         new_row = [user_id, salon_id, today_str, "電話希望: " + time_slot]
-        offer_sheet.append_row(new_row, value_input_option='USER_ENTERED')
+        store.append_offers([new_row])
 
         priority_marker = "【至急】" if "今すぐ" in time_slot else ""
         subject = f"{priority_marker}【LUMINA】サロン名確認・電話依頼（{user_name}様）"
@@ -597,7 +919,8 @@ def submit_call_request():
 <b>■ ユーザー情報</b><br>氏名: {user_name}<br><b>電話番号: <a href="tel:{user_phone}">{user_phone}</a></b><br>ユーザーID: {user_id}<br><br>
 <b>■ 希望連絡時間</b><br><span style="font-size:16px; font-weight:bold; color:red;">{time_slot}</span><br><br>
 <b>■ 対象サロン</b><br>{salon_name} (ID: {salon_id})<hr>"""
-        send_notification_email(subject, body)
+        # 電話依頼は時間帯の指定があるので、まとめずにすぐ送る
+        notifications.enqueue(subject, body, urgent=True)
         return jsonify({"status": "success", "message": "Call request submitted"})
 
     except Exception as e:
@@ -612,58 +935,176 @@ def trigger_offer():
     user_wishes = data.get('wishes')
     if not user_id or not user_wishes: return jsonify({"status": "error", "message": "Missing userId or wishes"}), 400
 
-    # スレッドを開始して、すぐにレスポンスを返す
-    thread = threading.Thread(target=process_offer_background, args=(user_id, user_wishes))
-    thread.start()
+    # ジョブキューに積んで、すぐにレスポンスを返す
+    try:
+        job = offer_jobs.submit(user_id, user_wishes)
+    except QueueFullError as e:
+        print(f"オファー処理キューが満杯です: {e}")
+        return jsonify({"status": "error", "message": "Too many requests, please retry later"}), 503
+
+    return jsonify({"status": "success", "message": "Accepted", "jobId": job['id'], "jobStatus": job['status']}), 200
+
+@app.route("/offer-jobs/<user_id>", methods=['GET'])
+def get_offer_job_status(user_id):
+    job = offer_jobs.get_latest(user_id)
+    if not job: return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({
+        "status": "success",
+        "job": { "id": job['id'], "status": job['status'], "attempts": job['attempts'], "steps": job['state'], "lastError": job['last_error'], "createdAt": job['created_at'], "updatedAt": job['updated_at'] }
+    })
+
+def is_permanent_push_error(e):
+    # 4xx（ブロック・ユーザー不在など）は再送しても届かない。429 は次回に再送する
+    status = getattr(e, 'status', None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+def deliver_offer_chunk(items, line_bot_api):
+    """
+    items: [(queue_id, user_id, user_wishes, salon_info, 事前生成したオファー文 or None)]
+    LINE送信を行い、(queue_id, status, オファー管理に追記する行 or None) のリストを返す。
+    status が None の行は今回送れなかったので pending のまま残す。
+    オファー文は通常キューに積んだときに生成済み。無い行（シートから直接追加された行など）だけキャッシュ経由で生成する。
+    同じユーザー宛ては5通ずつ1回の push にまとめ、内容がまったく同じものは multicast で送る。
+    """
+    with offer_queue_stage_seconds.time(stage='generate_texts'):
+        offer_messages = list(offer_generation_executor.map(lambda item: item[4] or offer_text_cache.get(item[2], item[3]), items))
+    outgoing = [
+        (queue_id, user_id, {"altText": "非公開サロンからのオファー", "contents": create_salon_flex_message(salon_info, offer_message)})
+        for (queue_id, user_id, _, salon_info, _), offer_message in zip(items, offer_messages)
+    ]
+
+    from linebot.v3.messaging import FlexMessage, MulticastRequest, PushMessageRequest
 
-    return jsonify({"status": "success", "message": "Accepted"}), 200
+    def send(delivery):
+        messages = [FlexMessage(alt_text=m["altText"], contents=validated_container(m["contents"])) for m in delivery.messages]
+        # 同じ宛先・同じ Offer Queue の行の組み合わせなら、次回の実行で送り直しても同じキーになる
+        retry_key = line_retry_key('offer', *sorted(delivery.to), *sorted(delivery.keys))
+        if delivery.kind == 'multicast':
+            line_call(lambda timeout: line_bot_api.multicast(MulticastRequest(to=delivery.to, messages=messages), x_line_retry_key=retry_key, _request_timeout=timeout), 'multicast', retry_key=retry_key)
+        else:
+            line_call(lambda timeout: line_bot_api.push_message(PushMessageRequest(to=delivery.to[0], messages=messages), x_line_retry_key=retry_key, _request_timeout=timeout), 'push', retry_key=retry_key)
+
+    with offer_queue_stage_seconds.time(stage='send'):
+        statuses = line_deliverer.deliver(
+            plan_deliveries(outgoing), send, line_push_executor,
+            classify_error=lambda e: 'error' if is_permanent_push_error(e) else None,
+        )
+    today_str = datetime.now(JST).strftime('%Y/%m/%d')
+    results = []
+    for queue_id, user_id, _, salon_info, _ in items:
+        status = statuses.get(queue_id)
+        new_offer_row = [ user_id, salon_info.get('店舗ID'), today_str, "送信済み" ] + [''] * 11 if status == 'sent' else None
+        results.append((queue_id, status, new_offer_row))
+    return results
 
 @app.route("/process-offer-queue", methods=['GET'])
 def process_offer_queue():
     cron_secret = request.args.get('secret')
     if cron_secret != os.environ.get('CRON_SECRET'): return "Unauthorized", 401
+    claim_owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    due_rows = []
     try:
+        started = time.monotonic()
+        time_budget = float(os.environ.get('OFFER_QUEUE_TIME_BUDGET_SECONDS', 240))
+        chunk_size = int(os.environ.get('OFFER_QUEUE_CHUNK_SIZE', 50))
         now_iso = datetime.now(JST).isoformat()
-        gc = gspread.service_account(filename=creds_path)
-        queue_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("Offer Queue")
-        user_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("ユーザー管理")
-        salon_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("店舗マスタ")
-        offer_management_sheet = gc.open("店舗マスタ_LUMINA Offer用").worksheet("オファー管理")
-        
-        all_queue = queue_sheet.get_all_records()
-        all_users = user_sheet.get_all_records(value_render_option='UNFORMATTED_VALUE')
-        all_salons = salon_sheet.get_all_records()
-        users_dict = {str(u['ユーザーID']): u for u in all_users}
-        salons_dict = {str(s['店舗ID']): s for s in all_salons}
-        
-        for idx, record in enumerate(all_queue):
-            row_num = idx + 2
-            if record.get('status') == 'pending' and record.get('send_at') <= now_iso:
-                user_id = str(record.get('user_id')); salon_id = str(record.get('salon_id'))
-                user_wishes = users_dict.get(user_id); salon_info = salons_dict.get(salon_id)
-
-                if user_wishes and salon_info:
-                    print(f"Processing: {user_id} -> {salon_id}")
-                    offer_message = generate_single_offer_message(user_wishes, salon_info)
-                    
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        flex_container = FlexContainer.from_dict(create_salon_flex_message(salon_info, offer_message))
-                        messages = [FlexMessage(alt_text=f"非公開サロンからのオファー", contents=flex_container)]
-                        line_bot_api.push_message(PushMessageRequest(to=user_id, messages=messages))
-                    
-                    try:
-                        today_str = datetime.now(JST).strftime('%Y/%m/%d')
-                        new_offer_row = [ user_id, salon_info.get('店舗ID'), today_str, "送信済み" ] + [''] * 11 
-                        offer_management_sheet.append_row(new_offer_row, value_input_option='USER_ENTERED')
-                    except Exception as e: print(f"オファー管理シートへの書き込み中にエラー: {e}")
-
-                    queue_sheet.update_cell(row_num, 4, 'sent')
-                else: queue_sheet.update_cell(row_num, 4, 'error')
+
+        # 期限の来た行（他の実行が確保していないもの）を確保し、その行が参照するユーザーだけをローカルから読む
+        with offer_queue_stage_seconds.time(stage='load'):
+            due_rows = store.claim_due_queue(now_iso, claim_owner, OFFER_QUEUE_CLAIM_SECONDS)
+            users_dict = store.get_users({r['user_id'] for r in due_rows})
+            salons_dict = salon_repo.snapshot().by_id
+
+        due_items = []; status_updates = []
+        for r in due_rows:
+            user_wishes = users_dict.get(r['user_id']); salon_info = salons_dict.get(r['salon_id'])
+            if user_wishes and salon_info: due_items.append((r['id'], r['user_id'], user_wishes, salon_info, r['offer_text']))
+            else: status_updates.append((r['id'], 'error'))
+        store.set_queue_status(status_updates)
+        offer_queue_rows.inc(len(status_updates), status='error')
+        # 同じユーザー宛ての行が同じチャンクに入り、1回の push にまとまるように並べる
+        due_items.sort(key=lambda item: item[1])
+
+        sent_count = 0; processed = 0
+        line_bot_api = line_messaging_api()
+        for chunk_start in range(0, len(due_items), chunk_size):
+            # 時間切れなら残りは pending のまま次回の実行に回す
+            if time.monotonic() - started > time_budget:
+                print(f"処理時間の上限({time_budget}s)に達したため、残り {len(due_items) - processed} 件は次回に送ります")
+                break
+            chunk = due_items[chunk_start:chunk_start + chunk_size]
+            print(f"Processing chunk: {len(chunk)} offers")
+            results = deliver_offer_chunk(chunk, line_bot_api)
+            processed += len(chunk)
+
+            # チャンクごとに、ステータスとオファー管理の行をローカルに書く（シートへは同期スレッドがまとめて書き込む）
+            offer_rows = [row for _, status, row in results if row]
+            with offer_queue_stage_seconds.time(stage='save'):
+                store.set_queue_status([(queue_id, status) for queue_id, status, _ in results if status])
+                if offer_rows: store.append_offers(offer_rows)
+            sent_count += len(offer_rows)
+            for _, status, _ in results: offer_queue_rows.inc(status=status or 'deferred')
+
+        log_event('offer_queue', due=len(due_rows), deliverable=len(due_items), processed=processed, sent=sent_count, seconds=round(time.monotonic() - started, 3))
         return "Offer queue processed.", 200
     except Exception as e:
         print(f"Queue Error: {e}"); traceback.print_exc()
         return "An error occurred.", 500
+    finally:
+        # 時間切れ・429 などで送らなかった行は確保を外し、次の実行ですぐ取れるようにする
+        store.release_queue_claims([r['id'] for r in due_rows], claim_owner)
+
+@app.route("/archive-offer-queue", methods=['GET'])
+def archive_offer_queue():
+    cron_secret = request.args.get('secret')
+    if cron_secret != os.environ.get('CRON_SECRET'): return "Unauthorized", 401
+    try:
+        days = int(request.args.get('days', os.environ.get('OFFER_QUEUE_ARCHIVE_DAYS', 30)))
+        # シートの行を消すので、同期を担当しているプロセスで行う
+        ran, archived = sheet_sync.run_as_leader('archive_queue', older_than_days=days)
+        if not ran: return jsonify({"status": "accepted", "message": "Archive requested from the syncing worker"}), 202
+        print(f"Offer Queue から {archived} 行をアーカイブしました")
+        return jsonify({"status": "success", "archived": archived})
+    except Exception as e:
+        print(f"Offer Queue のアーカイブ中にエラー: {e}"); traceback.print_exc()
+        return jsonify({"status": "error", "message": "Failed to archive offer queue"}), 500
+
+@app.route("/admin/stats", methods=['GET'])
+def admin_stats():
+    cron_secret = request.args.get('secret')
+    if cron_secret != os.environ.get('CRON_SECRET'): return "Unauthorized", 401
+    return jsonify({"sheets": sheets.stats(), "salons": salon_repo.stats(), "geocode": geocoder.stats(), "offer_jobs": offer_jobs.stats(), "sync": sheet_sync.stats(), "llm": llm_stats.stats(), "offer_texts": offer_text_cache.stats(), "upstreams": outbound.stats(), "line_delivery": line_deliverer.stats(), "notifications": notifications.stats(), "webhook": handler.stats(), "gas_follow": gas_follow_notifier.stats(), "startup": startup_report})
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    cron_secret = request.args.get('secret')
+    if cron_secret != os.environ.get('CRON_SECRET'): return "Unauthorized", 401
+    return metrics.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+@app.route("/admin/slow-requests", methods=['GET'])
+def slow_requests():
+    cron_secret = request.args.get('secret')
+    if cron_secret != os.environ.get('CRON_SECRET'): return "Unauthorized", 401
+    if not slow_request_profiler: return jsonify({"status": "disabled", "message": "Set SLOW_REQUEST_PROFILE_SECONDS to enable"})
+    return jsonify({"status": "success", "stats": slow_request_profiler.stats(), "profiles": slow_request_profiler.recent()})
+
+@app.route("/admin/salon-cache/invalidate", methods=['POST'])
+def invalidate_salon_cache():
+    cron_secret = request.args.get('secret')
+    if cron_secret != os.environ.get('CRON_SECRET'): return "Unauthorized", 401
+    salon_repo.invalidate()
+    if request.args.get('reload') == '1':
+        try:
+            # シートから取り込み直す（取り込み後にスナップショットも作り直される）。同期を担当しているプロセスで行う
+            ran, _ = sheet_sync.run_as_leader('pull', name='salons')
+            if not ran: return jsonify({"status": "accepted", "message": "Reload requested from the syncing worker"}), 202
+            return jsonify({"status": "success", "message": "Reloaded", "salons": len(salon_repo.snapshot().records)})
+        except Exception as e:
+            print(f"店舗マスタの再読み込みエラー: {e}"); traceback.print_exc()
+            return jsonify({"status": "error", "message": "Failed to reload salons"}), 500
+    return jsonify({"status": "success", "message": "Invalidated"})
+
+startup_report["import_seconds"] = round(time.perf_counter() - _IMPORT_STARTED, 3)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5001))
@@ -0,0 +1,80 @@
+"""
+find_and_select_top_salons の距離計算のベンチマーク。
+
+従来の iterrows + geopy.geodesic と、geo.distances_within（バウンディングボックス + ベクトル化Lambert）を
+1k / 10k / 100k 店舗で比較し、geodesic との最大誤差も表示する。
+
+    python benchmarks/bench_distance.py
+    python benchmarks/bench_distance.py --sizes 1000 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from geo import distances_within  # noqa: E402
+
+USER_COORDS = (35.6812, 139.7671)  # 東京駅
+
+
+def make_salons(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # 半分は都心付近、残りは全国に散らばらせる
+    near = n // 2
+    lats = np.concatenate([USER_COORDS[0] + rng.normal(0, 0.2, near), rng.uniform(26.0, 45.0, n - near)])
+    lons = np.concatenate([USER_COORDS[1] + rng.normal(0, 0.2, near), rng.uniform(127.0, 145.0, n - near)])
+    return pd.DataFrame({'店舗ID': np.arange(1, n + 1), '緯度': lats, '経度': lons})
+
+
+def current_path(salons_df):
+    distances = [geodesic(USER_COORDS, (salon['緯度'], salon['経度'])).kilometers for _, salon in salons_df.iterrows()]
+    salons_df = salons_df.copy()
+    salons_df['距離'] = distances
+    return salons_df[salons_df['距離'] <= 25]
+
+
+def vectorized_path(salons_df):
+    positions, distances = distances_within(USER_COORDS[0], USER_COORDS[1], salons_df['緯度'].to_numpy(), salons_df['経度'].to_numpy(), 25)
+    matched = salons_df.iloc[positions].copy()
+    matched['距離'] = distances
+    return matched
+
+
+def best_of(fn, arg, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'salons':>8} {'current[ms]':>12} {'vectorized[ms]':>15} {'speedup':>8} {'matched':>8} {'max_err[m]':>11}")
+    for n in args.sizes:
+        salons_df = make_salons(n)
+        # 従来方式は遅いので大きいサイズでは1回だけ測る
+        current_time, current_result = best_of(current_path, salons_df, 1 if n >= 100000 else args.repeat)
+        vector_time, vector_result = best_of(vectorized_path, salons_df, args.repeat)
+
+        assert set(current_result['店舗ID']) == set(vector_result['店舗ID']), "マッチした店舗が一致しません"
+        merged = current_result.merge(vector_result, on='店舗ID', suffixes=('_geodesic', '_vector'))
+        max_error_m = (merged['距離_geodesic'] - merged['距離_vector']).abs().max() * 1000 if not merged.empty else 0.0
+
+        print(f"{n:>8} {current_time * 1000:>12.1f} {vector_time * 1000:>15.2f} {current_time / vector_time:>7.0f}x {len(vector_result):>8} {max_error_m:>11.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+オファーの Flex Message を1通組み立てるコストのベンチマーク。
+
+以前の手順（bubble の dict を毎回組み立て、FlexContainer.from_dict で検証）と、
+起動時に検証したテンプレートのスロットを埋めるだけの手順とで、FlexMessage を作って送信用の dict にするまでの時間を比べる。
+
+    python benchmarks/bench_flex_templates.py --messages 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# app のローカルDBは一時ディレクトリに作る（LINE の認証情報は送信しないのでダミーでよい）
+os.environ.setdefault('LUMINA_DB_PATH', os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+os.environ.setdefault('YOUR_CHANNEL_SECRET', 'bench')
+os.environ.setdefault('YOUR_CHANNEL_ACCESS_TOKEN', 'bench')
+from linebot.v3.messaging import FlexContainer, FlexMessage  # noqa: E402
+
+import app  # noqa: E402
+from flex_templates import validated_container  # noqa: E402
+
+ADDRESSES = ['東京都渋谷区神南1-2-3', '神奈川県平塚市紅谷町4-5', '北海道虻田郡ニセコ町', '大阪府大阪市北区梅田1-1', 'どこかの住所がとても長い場合の例']
+
+
+def make_salons(n, seed=0):
+    rng = random.Random(seed)
+    return [{
+        '店舗ID': i + 1,
+        '公開用店名': f'サロン{i + 1}',
+        '住所': rng.choice(ADDRESSES),
+        '画像URL': rng.choice(['', f'https://example.com/{i}.jpg']),
+        '役職': rng.choice(['スタイリスト', 'アシスタント', 'スタイリスト, アシスタント']),
+        '募集': rng.choice(['正社員', '業務委託', 'パート']),
+    } for i in range(n)]
+
+
+def legacy_bubble(salon, offer_text):
+    """変更前の create_salon_flex_message と同じ組み立て方"""
+    db_role = salon.get("役職", "")
+    display_role = "アシスタント" if "アシスタント" in db_role else "スタイリスト"
+    address_full = salon.get("住所", "")
+    masked_address = "エリア: 非公開"
+    if address_full:
+        if "区" in address_full: masked_address = "エリア: " + address_full[:address_full.find("区") + 1]
+        elif "市" in address_full: masked_address = "エリア: " + address_full[:address_full.find("市") + 1]
+        elif "郡" in address_full: masked_address = "エリア: " + address_full[:address_full.find("郡") + 1]
+        else: masked_address = "エリア: " + address_full[:10] + "..."
+    salon_id = salon.get('店舗ID')
+    image = salon.get("画像URL", "")
+    image = f"https://wsrv.nl/?url={image}&blur=10&output=jpg" if image else "https://placehold.co/600x400/333333/FFFFFF/png?text=No+Image"
+
+    def row(label, value):
+        return {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": label, "color": "#aaaaaa", "size": "sm", "flex": 2}, {"type": "text", "text": value, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
+    return {
+        "type": "bubble",
+        "hero": {"type": "image", "url": image, "size": "full", "aspectRatio": "20:13", "aspectMode": "cover"},
+        "body": {"type": "box", "layout": "vertical", "contents": [
+            {"type": "text", "text": salon.get("公開用店名", "非公開サロン"), "weight": "bold", "size": "xl"},
+            {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
+                row("勤務地", masked_address), row("募集役職", display_role), row("募集形態", salon.get("募集", "")), row("メッセージ", offer_text)]},
+        ]},
+        "footer": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": [
+            {"type": "button", "style": "primary", "height": "sm", "action": {"type": "uri", "label": "待遇を見る", "uri": f"https://liff.line.me/{app.SALON_DETAIL_LIFF_ID}?salonId={salon_id}"}, "color": "#59A5D8"},
+            {"type": "button", "style": "primary", "height": "sm", "action": {"type": "uri", "label": "サロン名を確認する", "uri": f"https://liff.line.me/{app.CALL_REQUEST_LIFF_ID}?salonId={salon_id}"}, "color": "#F37335"},
+        ], "flex": 0},
+    }
+
+
+def legacy_message(salon, offer_text):
+    return FlexMessage(alt_text="非公開サロンからのオファー", contents=FlexContainer.from_dict(legacy_bubble(salon, offer_text))).to_dict()
+
+
+def template_message(salon, offer_text):
+    return FlexMessage(alt_text="非公開サロンからのオファー", contents=validated_container(app.create_salon_flex_message(salon, offer_text))).to_dict()
+
+
+def per_call_us(fn, salons, offer_text):
+    started = time.perf_counter()
+    for salon in salons: fn(salon, offer_text)
+    return (time.perf_counter() - started) / len(salons) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+
+    salons = make_salons(args.messages)
+    offer_text = app.OFFER_MESSAGE_FALLBACK
+    # SDK で正規化したときに以前と同じ内容になることを確認してから測る（テンプレートの出力には SDK が補う既定値が入らない）
+    for salon in salons[:50]:
+        normalized = FlexContainer.from_dict(template_message(salon, offer_text)['contents']).to_dict()
+        assert legacy_message(salon, offer_text)['contents'] == normalized, salon
+
+    app.mask_address.cache_clear()
+    legacy_us = per_call_us(legacy_message, salons, offer_text)
+    template_us = per_call_us(template_message, salons, offer_text)
+    follow_legacy_us = per_call_us(lambda s, t: FlexMessage(alt_text="x", contents=FlexContainer.from_dict(app.FOLLOW_BUBBLE_JSON)).to_dict(), salons, offer_text)
+    follow_prebuilt_us = per_call_us(lambda s, t: FlexMessage(alt_text="x", contents=app.follow_bubble()).to_dict(), salons, offer_text)
+
+    print(f"offer  messages={args.messages}  from_dict={legacy_us:8.1f}us/msg  template={template_us:8.1f}us/msg  speedup={legacy_us / template_us:5.1f}x")
+    print(f"follow messages={args.messages}  from_dict={follow_legacy_us:8.1f}us/msg  prebuilt={follow_prebuilt_us:8.1f}us/msg  speedup={follow_legacy_us / follow_prebuilt_us:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
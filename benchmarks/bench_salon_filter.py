@@ -0,0 +1,103 @@
+"""
+募集条件の絞り込みベンチマーク。
+
+以前の pandas による逐次フィルタ（role_matcher の .apply、str.contains、中間 DataFrame のコピー）と、
+SalonFilterIndex のマスク演算とで、1リクエストあたりの絞り込み時間を比べる。
+
+    python benchmarks/bench_salon_filter.py --salons 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from salon_filter import SalonFilterIndex  # noqa: E402
+
+ROLES = ['スタイリスト', 'アシスタント', 'スタイリスト, アシスタント']
+GENDERS = ['', '指定なし', '女性', '男性']
+AGES = ['', '指定なし', '20代,30代', '30代,40代', '20代']
+
+
+def make_records(n, seed=0):
+    rng = random.Random(seed)
+    return [{
+        '店舗ID': i + 1,
+        '募集状況': rng.choice(['募集中', '募集中', '停止']),
+        '役職': rng.choice(ROLES),
+        '美容師免許': rng.choice(['取得', '未取得']),
+        'ターゲット性別': rng.choice(GENDERS),
+        'ターゲット年齢': rng.choice(AGES),
+    } for i in range(n)]
+
+
+def make_users(n, seed=1):
+    rng = random.Random(seed)
+    return [{
+        'role': rng.choice(['スタイリスト', 'アシスタント']),
+        'license': rng.choice(['取得済み', '未取得']),
+        'gender': rng.choice(['女性', '男性']),
+        'age': rng.choice(['20代', '30代', '40代']),
+    } for _ in range(n)]
+
+
+def pandas_filter(df, user_wishes, sent_ids):
+    """変更前の find_and_select_top_salons と同じ手順の絞り込み"""
+    df = df[df['募集状況'] == '募集中']
+    user_role = user_wishes.get('role')
+    df = df[df['役職'].apply(lambda roles: user_role in [r.strip() for r in str(roles).split(',')])]
+    if user_wishes.get('license') == '取得済み':
+        df = df[df['美容師免許'] == '取得']
+    else:
+        df = df[df['美容師免許'].isin(['取得', '未取得'])]
+    gender = user_wishes.get('gender')
+    df = df[(df['ターゲット性別'].isnull()) | (df['ターゲット性別'] == '') | (df['ターゲット性別'] == '指定なし') | (df['ターゲット性別'] == gender)]
+    age = user_wishes.get('age')
+    df = df[(df['ターゲット年齢'].isnull()) | (df['ターゲット年齢'] == '') | (df['ターゲット年齢'] == '指定なし') | (df['ターゲット年齢'].str.contains(age, na=False))]
+    return df[~df['店舗ID'].astype(str).isin(sent_ids)]
+
+
+def per_call_ms(fn, items):
+    started = time.perf_counter()
+    for item in items: fn(item)
+    return (time.perf_counter() - started) / len(items) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--salons', type=int, nargs='+', default=[5000, 50000])
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    users = make_users(args.queries)
+    sent_ids = [str(i) for i in range(1, 40)]
+    for n in args.salons:
+        records = make_records(n)
+        df = pd.DataFrame(records)
+
+        started = time.perf_counter()
+        index = SalonFilterIndex.from_records(records)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        # 結果が一致することを確認してから測る
+        for user in users[:5]:
+            expected = sorted(pandas_filter(df, user, sent_ids)['店舗ID'].tolist())
+            selected, _ = index.select(user, exclude_salon_ids=sent_ids)
+            assert sorted(records[i]['店舗ID'] for i in selected) == expected
+
+        pandas_ms = per_call_ms(lambda u: pandas_filter(df, u, sent_ids), users)
+        mask_ms = per_call_ms(lambda u: index.select(u, exclude_salon_ids=sent_ids), users)
+        # 実際の経路では、空間インデックスで絞った（25km圏内の）位置だけを評価する
+        positions = np.sort(np.random.default_rng(0).choice(n, size=min(n, 2000), replace=False))
+        subset_ms = per_call_ms(lambda u: index.select(u, positions, exclude_salon_ids=sent_ids), users)
+
+        print(f"salons={n:>7}  build={build_ms:8.1f}ms  pandas={pandas_ms:8.3f}ms/req  "
+              f"mask={mask_ms:8.3f}ms/req  mask(2000 candidates)={subset_ms:6.3f}ms/req  speedup={pandas_ms / mask_ms:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+SpatialIndex の半径検索ベンチマーク。
+
+店舗を全国（主要都市に偏らせて）配置し、総店舗数を増やしても
+25km 検索の時間がほぼ変わらないことを確認する。
+
+    python benchmarks/bench_spatial_index.py
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from geo import SpatialIndex, distances_within  # noqa: E402
+
+# 東京・大阪・名古屋・福岡・札幌
+CITIES = [(35.6812, 139.7671), (34.7025, 135.4959), (35.1709, 136.8815), (33.5902, 130.4207), (43.0687, 141.3508)]
+
+
+def make_coords(n, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = np.array(CITIES)[rng.integers(0, len(CITIES), n)]
+    # 都市圏（σ≒30km）に8割、残りは全国に散らばらせる
+    spread = rng.random(n) < 0.8
+    lats = np.where(spread, centers[:, 0] + rng.normal(0, 0.27, n), rng.uniform(26.0, 45.0, n))
+    lons = np.where(spread, centers[:, 1] + rng.normal(0, 0.33, n), rng.uniform(127.0, 145.0, n))
+    return lats, lons
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--radius', type=float, default=25.0)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    print(f"{'salons':>8} {'build[ms]':>10} {'index[us]':>10} {'scan[us]':>10} {'hits(avg)':>10}")
+    for n in args.sizes:
+        lats, lons = make_coords(n)
+        start = time.perf_counter()
+        index = SpatialIndex(lats, lons)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        # 検索地点は都市の中心付近（実際の希望勤務地に近い分布）
+        points = np.array(CITIES)[rng.integers(0, len(CITIES), args.queries)] + rng.normal(0, 0.05, (args.queries, 2))
+        hits = 0
+        start = time.perf_counter()
+        for lat, lon in points:
+            positions, _ = index.query_radius(lat, lon, args.radius)
+            hits += len(positions)
+        index_us = (time.perf_counter() - start) / args.queries * 1e6
+
+        start = time.perf_counter()
+        for lat, lon in points:
+            distances_within(lat, lon, lats, lons, args.radius)
+        scan_us = (time.perf_counter() - start) / args.queries * 1e6
+
+        print(f"{n:>8} {build_ms:>10.1f} {index_us:>10.0f} {scan_us:>10.0f} {hits / args.queries:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
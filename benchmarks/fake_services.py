@@ -0,0 +1,382 @@
+"""
+ベンチマーク・負荷試験用の外部サービスの代わり（ネットワークには出ない）。
+
+- FakeSpreadsheet / FakeWorksheet: gspread のスプレッドシート・ワークシートの代わり。呼び出しごとに遅延を入れ、
+  quota_error_rate の割合で 429（クォータ超過）の APIError を投げる
+- FakeHttpSession: HttpClient.session() の代わり。Gemini（ランキング・オファー文）・Brevo・GAS に応答する
+- FakeMessagingApi: linebot.v3.messaging.MessagingApi の代わり（push / multicast / reply）
+- FakeNominatim: geopy の Nominatim の代わり（AREAS の地名だけを知っている）
+- make_salon_rows / make_user_wishes: 店舗マスタとユーザーの合成データ
+
+呼び出しの回数・時間・エラーは UpstreamCalls に外部サービスごとに記録する。
+"""
+import json
+import random
+import re
+import threading
+import time
+
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_to_rowcol
+
+# 既定の遅延（ミリ秒）。実測した本番の中央値に近い値にしている
+DEFAULT_LATENCY_MS = {
+    'sheets_read': 250, 'sheets_write': 400,
+    'gemini_ranking': 1500, 'gemini_offer': 2500,
+    'line': 60, 'brevo': 150, 'gas': 300, 'nominatim': 400,
+}
+
+# (都道府県, 希望勤務地, 緯度, 経度)
+AREAS = [
+    ('東京都', '渋谷周辺', 35.658, 139.702),
+    ('東京都', '新宿', 35.690, 139.700),
+    ('神奈川県', '横浜駅あたり', 35.466, 139.622),
+    ('大阪府', '梅田', 34.702, 135.495),
+    ('愛知県', '名古屋中心部', 35.170, 136.881),
+    ('福岡県', '天神', 33.590, 130.399),
+]
+
+SALON_HEADERS = [
+    '店舗ID', '店舗名', '公開用店名', '住所', '画像URL', '緯度', '経度', '募集状況', '役職', '美容師免許',
+    'ターゲット性別', 'ターゲット年齢', '募集', '特徴', 'サロンの魅力キャッチコピー', 'サロン紹介文', '給与詳細', '休日詳細', '福利厚生詳細',
+]
+USER_HEADERS = [
+    'ユーザーID', '登録日', 'ステータス', '氏名', '性別', '生年月日', '電話番号', 'MBTI', '役職', '希望エリア', '希望勤務地',
+    '職場満足度', '興味のある待遇', '現在の状況', '転職希望時期', '美容師免許',
+] + [f'Q{i}' for i in range(1, 9)] + ['LINE URL']
+OFFER_HEADERS = ['ユーザーID', '店舗ID', '送信日', 'ステータス']
+QUEUE_HEADERS = ['user_id', 'salon_id', 'send_at', 'status']
+
+FEATURES = ['教育体制充実', 'アットホーム', '完全週休2日制', '高歩合', '社会保険完備', 'シフト自由', '大手サロン', '新規客が多い', '撮影', '個室']
+PERKS = ['教育', '給与', '休日', '福利厚生', '人間関係']
+MBTI = ['INTJ', 'INFP', 'ENFP', 'ESTJ', 'ISFJ', 'ENTP', 'ESFP', 'ISTP']
+
+OFFER_TEXT = "LUMINA Offerから、あなたに特別なオファーが届いています。こちらのサロンは教育体制が整っており、あなたの強みを活かせます。まずは、サロンから話を聞いてみませんか？"
+
+
+class UpstreamCalls:
+    """外部サービスごとの呼び出し回数・合計時間・エラー回数（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            entry = self._calls.setdefault(name, {"calls": 0, "errors": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            if error: entry["errors"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(entry, seconds=round(entry["seconds"], 3)) for name, entry in sorted(self._calls.items())}
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+
+
+class FakeServices:
+    """
+    遅延とエラー率の設定を持ち、各サービスの代わりから呼ばれる。
+    latency_ms は DEFAULT_LATENCY_MS と同じキーで上書きする（実際の遅延は ±50% でばらつかせる）。scale=0 なら待たない。
+    """
+
+    def __init__(self, latency_ms=None, scale=1.0, sheets_quota_error_rate=0.0, gemini_error_rate=0.0, line_error_rate=0.0, seed=0):
+        self.latency_ms = dict(DEFAULT_LATENCY_MS, **(latency_ms or {}))
+        self.scale = scale
+        self.sheets_quota_error_rate = sheets_quota_error_rate
+        self.gemini_error_rate = gemini_error_rate
+        self.line_error_rate = line_error_rate
+        self.calls = UpstreamCalls()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def _random(self):
+        with self._rng_lock:
+            return self._rng.random()
+
+    def call(self, name, latency_key, error_rate=0.0):
+        """遅延を入れて呼び出しを記録し、エラーにするなら True を返す"""
+        started = time.perf_counter()
+        delay = self.latency_ms[latency_key] / 1000 * self.scale * (0.5 + self._random())
+        if delay > 0: time.sleep(delay)
+        failed = error_rate > 0 and self._random() < error_rate
+        self.calls.record(name, time.perf_counter() - started, error=failed)
+        return failed
+
+
+# --- Google Sheets ---
+
+class FakeResponse:
+    """requests.Response の代わり（HttpClient と gspread の APIError が使う属性だけ）"""
+
+    def __init__(self, status_code, payload=None, text=None, headers=None):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = text if text is not None else json.dumps(payload, ensure_ascii=False)
+        self.headers = headers or {}
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f"{self.status_code} Error", response=self)
+
+
+def quota_error():
+    return APIError(FakeResponse(429, {"error": {"code": 429, "message": "Quota exceeded for quota metric 'Read requests'", "status": "RESOURCE_EXHAUSTED"}}))
+
+
+class FakeWorksheet:
+    """gspread.Worksheet の代わり。get_all_values などは本物と同じく文字列で返す"""
+
+    def __init__(self, services, title, rows, sheet_id):
+        self.services = services
+        self.title = title
+        self.id = sheet_id
+        self._rows = [[str(v) for v in row] for row in rows]
+        self._lock = threading.Lock()
+
+    def _call(self, kind):
+        if self.services.call(f'sheets.{kind}', f'sheets_{kind}', self.services.sheets_quota_error_rate):
+            raise quota_error()
+
+    def _ensure(self, row, col):
+        while len(self._rows) < row: self._rows.append([])
+        cells = self._rows[row - 1]
+        while len(cells) < col: cells.append('')
+
+    def _set_range(self, a1_range, values):
+        start = a1_range.split('!')[-1].split(':')[0]
+        row, col = a1_to_rowcol(start)
+        for i, line in enumerate(values):
+            for j, value in enumerate(line):
+                self._ensure(row + i, col + j)
+                self._rows[row + i - 1][col + j - 1] = str(value)
+
+    def _appended(self, start, end):
+        return {'updates': {'updatedRange': f"'{self.title}'!A{start}:Z{end}"}}
+
+    @property
+    def row_count(self):
+        return len(self._rows)
+
+    def get_all_values(self, **kwargs):
+        self._call('read')
+        with self._lock:
+            return [list(row) for row in self._rows]
+
+    def get(self, a1_range=None, **kwargs):
+        self._call('read')
+        with self._lock:
+            return self._get(a1_range)
+
+    def _get(self, a1_range):
+        start, _, end = a1_range.split('!')[-1].partition(':')
+        first_row, _ = a1_to_rowcol(start if any(ch.isdigit() for ch in start) else start + '1')
+        last_row = a1_to_rowcol(end)[0] if any(ch.isdigit() for ch in end) else len(self._rows)
+        return [list(row) for row in self._rows[first_row - 1:last_row]]
+
+    def batch_get(self, ranges, **kwargs):
+        self._call('read')
+        with self._lock:
+            return [self._get(r) for r in ranges]
+
+    def row_values(self, row, **kwargs):
+        self._call('read')
+        with self._lock:
+            return list(self._rows[row - 1]) if row <= len(self._rows) else []
+
+    def col_values(self, col, **kwargs):
+        self._call('read')
+        with self._lock:
+            return [row[col - 1] if len(row) >= col else '' for row in self._rows]
+
+    def batch_update(self, data, **kwargs):
+        self._call('write')
+        with self._lock:
+            for item in data: self._set_range(item['range'], item['values'])
+
+    def update(self, a1_range, values=None, **kwargs):
+        self._call('write')
+        with self._lock:
+            self._set_range(a1_range, values)
+
+    def append_rows(self, rows, **kwargs):
+        self._call('write')
+        with self._lock:
+            start = len(self._rows) + 1
+            self._rows.extend([str(v) for v in row] for row in rows)
+            return self._appended(start, len(self._rows))
+
+    def append_row(self, row, **kwargs):
+        return self.append_rows([row], **kwargs)
+
+    def delete_rows(self, start_index, end_index=None):
+        self._call('write')
+        with self._lock:
+            del self._rows[start_index - 1:(end_index or start_index)]
+
+
+class FakeSpreadsheet:
+    """gspread.Spreadsheet の代わり。SheetsGateway.spreadsheet を置き換えて使う"""
+
+    def __init__(self, services, sheets):
+        self.services = services
+        self._worksheets = {}
+        for title, rows in sheets.items(): self.add_worksheet(title, rows=rows)
+
+    def worksheet(self, title):
+        self.services.call('sheets.open', 'sheets_read')
+        if title not in self._worksheets: raise WorksheetNotFound(title)
+        return self._worksheets[title]
+
+    def add_worksheet(self, title, rows=None, cols=None):
+        # 本物の rows は行数の指定だが、ここでは初期データ（行のリスト）も受け付ける
+        worksheet = FakeWorksheet(self.services, title, rows if isinstance(rows, list) else [], len(self._worksheets) + 1)
+        self._worksheets[title] = worksheet
+        return worksheet
+
+    def replace(self, title, rows):
+        """ワークシートの中身を入れ替える（規模を変えて測り直すとき）"""
+        worksheet = self._worksheets[title]
+        with worksheet._lock:
+            worksheet._rows = [[str(v) for v in row] for row in rows]
+
+
+# --- HTTP（Gemini・Brevo・GAS） ---
+
+class FakeHttpSession:
+    """requests.Session の代わり。URL で呼び先を判定する"""
+
+    def __init__(self, services):
+        self.services = services
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if 'generativelanguage' in url: return self._gemini(kwargs.get('json') or {})
+        if 'brevo' in url:
+            self.services.call('brevo', 'brevo')
+            return FakeResponse(201, {"messageId": "<fake@smtp-relay.brevo.com>"})
+        self.services.call('gas', 'gas')
+        return FakeResponse(200, {"status": "ok"})
+
+    def _gemini(self, data):
+        prompt = data['contents'][0]['parts'][0]['text']
+        ranking = '「店舗ID」をリスト' in prompt
+        name = 'gemini.ranking' if ranking else 'gemini.offer'
+        if self.services.call(name, name.replace('.', '_'), self.services.gemini_error_rate):
+            return FakeResponse(429, {"error": {"code": 429, "message": "Resource has been exhausted"}}, headers={"Retry-After": "1"})
+        if ranking:
+            # プロンプトに入っていた候補を、入っていた順のまま返す
+            ids = [int(i) for i in re.findall(r'"店舗ID": ?(\d+)', prompt)]
+            text = json.dumps(ids[:5])
+        else:
+            text = OFFER_TEXT
+        return FakeResponse(200, {
+            "candidates": [{"content": {"parts": [{"text": text}]}}],
+            "usageMetadata": {"promptTokenCount": len(prompt) // 2, "candidatesTokenCount": len(text) // 2},
+        })
+
+
+# --- LINE ---
+
+class FakeMessagingApi:
+    """linebot.v3.messaging.MessagingApi の代わり（送ったメッセージ数も数える）"""
+
+    def __init__(self, services):
+        self.services = services
+
+    def _call(self, name, request, recipients):
+        if self.services.call(name, 'line', self.services.line_error_rate):
+            from linebot.v3.messaging import ApiException
+            raise ApiException(status=429, reason='Too Many Requests')
+        for _ in range(recipients * len(request.messages)): self.services.calls.record('line.messages', 0)
+
+    def push_message(self, push_message_request, **kwargs):
+        self._call('line.push', push_message_request, 1)
+
+    def multicast(self, multicast_request, **kwargs):
+        self._call('line.multicast', multicast_request, len(multicast_request.to))
+
+    def reply_message_with_http_info(self, reply_message_request, **kwargs):
+        self._call('line.reply', reply_message_request, 1)
+
+
+# --- Nominatim ---
+
+class _Location:
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class FakeNominatim:
+    def __init__(self, services):
+        self.services = services
+
+    def geocode(self, query, timeout=None, **kwargs):
+        self.services.call('nominatim', 'nominatim')
+        for prefecture, detail, lat, lon in AREAS:
+            if query.startswith(prefecture) and detail[:2] in query: return _Location(lat, lon)
+        return None
+
+
+# --- 合成データ ---
+
+def make_salon_rows(n, seed=0):
+    """AREAS の周辺（約 ±20km）に散らばった n 店舗の店舗マスタ（見出し行を含む）"""
+    rng = random.Random(seed)
+    rows = [SALON_HEADERS]
+    for i in range(1, n + 1):
+        prefecture, detail, lat, lon = rng.choice(AREAS)
+        features = rng.sample(FEATURES, 3)
+        rows.append([
+            i, f'サロン{i}', f'LUMINA{i}', f'{prefecture}{detail[:2]}区{rng.randint(1, 9)}-{rng.randint(1, 30)}',
+            rng.choice(['', f'https://example.com/salon/{i}.jpg']),
+            round(lat + rng.uniform(-0.18, 0.18), 6), round(lon + rng.uniform(-0.22, 0.22), 6),
+            rng.choice(['募集中', '募集中', '募集中', '停止']),
+            rng.choice(['スタイリスト', 'アシスタント', 'スタイリスト, アシスタント']),
+            rng.choice(['取得', '未取得']),
+            rng.choice(['', '指定なし', '女性', '男性']),
+            rng.choice(['', '指定なし', '20代,30代', '30代,40代']),
+            rng.choice(['正社員', '業務委託', 'パート']),
+            ' '.join(features),
+            f'{features[0]}で{features[1]}なサロン',
+            f'{detail}で{rng.randint(2, 40)}年続くサロンです。' + '丁寧な教育と明るい雰囲気が自慢です。' * rng.randint(1, 4),
+            f'月給{rng.randint(20, 40)}万円〜 歩合あり',
+            rng.choice(['完全週休2日制', '週休2日', 'シフト自由', '土日休み可能']),
+            rng.choice(['社会保険完備', '社保完備 講習費補助', '交通費支給']),
+        ])
+    return rows
+
+
+def make_user_wishes(n, seed=0, prefix='LOAD'):
+    """/trigger-offer に送る (userId, wishes) を n 件"""
+    rng = random.Random(seed)
+    users = []
+    for i in range(n):
+        prefecture, detail, _, _ = rng.choice(AREAS)
+        users.append((f'{prefix}{i:06d}', {
+            'full_name': f'テスト{i}', 'gender': rng.choice(['女性', '男性']),
+            'birthdate': f'{rng.randint(1975, 2004)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+            'phone_number': f'090{rng.randint(10000000, 99999999)}', 'mbti': rng.choice(MBTI),
+            'role': rng.choice(['スタイリスト', 'アシスタント']), 'license': rng.choice(['取得済み', '未取得']),
+            'area_prefecture': prefecture, 'area_detail': detail,
+            'satisfaction': str(rng.randint(1, 5)), 'perk': rng.choice(PERKS),
+            'current_status': rng.choice(['在職中', '離職中']), 'timing': rng.choice(['すぐにでも', '3ヶ月以内', '良い所があれば']),
+        }))
+    return users
+
+
+def make_sheets(salons, seed=0):
+    """FakeSpreadsheet に渡す初期データ（店舗マスタ以外は見出し行だけ）"""
+    return {
+        '店舗マスタ': make_salon_rows(salons, seed),
+        'ユーザー管理': [USER_HEADERS],
+        'オファー管理': [OFFER_HEADERS],
+        'Offer Queue': [QUEUE_HEADERS],
+    }
@@ -0,0 +1,277 @@
+"""
+オフラインの負荷試験。外部サービス（Sheets・Gemini・LINE・Brevo・GAS・Nominatim）を fake_services の代わりに差し替えて、
+Flask アプリに並行してリクエストを送り、シナリオごとにスループット・レイテンシ（p50/p95/p99）・外部サービスの呼び出し回数を出す。
+
+シナリオ（店舗マスタの規模ごとに実行する）
+- salon-detail : GET /api/salon-detail/<id> を並行に
+- match        : find_and_select_top_salons（ジオコーディング・絞り込み・ランキング）を並行に
+- trigger-offer: POST /trigger-offer の受付と、ジョブ完了（オファー予約）までの時間
+- offer-queue  : 期限の来た行を --queue-rows 行積んで GET /process-offer-queue（1回ごとに積み直して --queue-runs 回）
+
+遅延は fake_services.DEFAULT_LATENCY_MS を --latency-scale 倍したもの（0 なら待たない）。
+ワーカー数などはアプリと同じ環境変数（OFFER_WORKER_CONCURRENCY など）で変えられる。
+
+    python benchmarks/loadtest.py --salons 300,3000 --users 50 --concurrency 16
+    python benchmarks/loadtest.py --scenarios salon-detail,match --latency-scale 0.1 --sheets-quota-error-rate 0.05 --json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# ローカルDBは一時ディレクトリに作る。認証情報・APIキーは外部に送らないのでダミーでよい
+os.environ.setdefault('LUMINA_DB_PATH', os.path.join(tempfile.mkdtemp(), 'loadtest.sqlite3'))
+for name in ('YOUR_CHANNEL_SECRET', 'YOUR_CHANNEL_ACCESS_TOKEN', 'CRON_SECRET', 'GEMINI_API_KEY', 'BREVO_API_KEY'):
+    os.environ.setdefault(name, 'loadtest')
+os.environ.setdefault('MAIL_USERNAME', 'loadtest@example.com')
+
+import app  # noqa: E402
+from fake_services import (  # noqa: E402
+    OFFER_TEXT, FakeHttpSession, FakeMessagingApi, FakeNominatim, FakeServices, FakeSpreadsheet, make_salon_rows, make_sheets,
+    make_user_wishes,
+)
+
+SCENARIOS = ['salon-detail', 'match', 'trigger-offer', 'offer-queue']
+
+
+def install_fakes(services, salons):
+    """app の外部サービスの入口を差し替える"""
+    spreadsheet = FakeSpreadsheet(services, make_sheets(salons))
+    session = FakeHttpSession(services)
+    messaging_api = FakeMessagingApi(services)
+    app.sheets.spreadsheet = lambda *args, **kwargs: spreadsheet
+    app.outbound.session = lambda: session
+    app.line_messaging_api = lambda: messaging_api
+    app.geocoder._geocoder = FakeNominatim(services)
+    return spreadsheet
+
+
+def percentile(sorted_values, p):
+    if not sorted_values: return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, size, latencies, errors, elapsed, concurrency, services, **extra):
+    values = sorted(latencies)
+    result = {
+        "scenario": name, "salons": size, "requests": len(latencies) + errors, "errors": errors, "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3), "throughput_rps": round(len(values) / elapsed, 1) if elapsed > 0 else None,
+        "p50_ms": None, "p95_ms": None, "p99_ms": None, "upstream_calls": services.calls.snapshot(),
+    }
+    for p in (50, 95, 99):
+        value = percentile(values, p)
+        result[f"p{p}_ms"] = round(value * 1000, 1) if value is not None else None
+    result.update(extra)
+    return result
+
+
+def run_concurrently(fn, items, concurrency):
+    """items を concurrency 並列で fn に渡し、(成功した呼び出しの秒数のリスト, 失敗数, 経過秒) を返す"""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def call(item):
+        started = time.perf_counter()
+        try:
+            ok = fn(item)
+        except Exception:
+            ok = False
+        seconds = time.perf_counter() - started
+        with lock:
+            if ok: latencies.append(seconds)
+            else: errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, items))
+    return latencies, errors[0], time.perf_counter() - started
+
+
+_clients = threading.local()
+
+
+def client():
+    # Flask のテストクライアントはスレッドごとに作る
+    if not hasattr(_clients, 'client'): _clients.client = app.app.test_client()
+    return _clients.client
+
+
+def with_age(wishes):
+    wishes = dict(wishes)
+    age = app.get_age_from_birthdate(wishes['birthdate'])
+    wishes['age'] = f"{(age // 10) * 10}代"
+    return wishes
+
+
+def wait_for_jobs(timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = app.offer_jobs.stats()
+        if not stats.get('queued') and not stats.get('running'): return True
+        time.sleep(0.05)
+    return False
+
+
+# --- シナリオ ---
+
+def scenario_salon_detail(size, args, services):
+    rng = random.Random(size)
+    salon_ids = [rng.randint(1, size) for _ in range(args.requests)]
+    latencies, errors, elapsed = run_concurrently(
+        lambda salon_id: client().get(f'/api/salon-detail/{salon_id}').status_code == 200, salon_ids, args.concurrency)
+    return [summarize('salon-detail', size, latencies, errors, elapsed, args.concurrency, services)]
+
+
+def scenario_match(size, args, services):
+    users = [(user_id, dict(with_age(wishes), userId=user_id)) for user_id, wishes in make_user_wishes(args.users, seed=size, prefix=f'M{size}_')]
+    matched = []
+
+    def match(user):
+        top_salons, _ = app.find_and_select_top_salons(dict(user[1]))
+        matched.append(len(top_salons))
+        return True
+
+    latencies, errors, elapsed = run_concurrently(match, users, args.concurrency)
+    return [summarize('match', size, latencies, errors, elapsed, args.concurrency, services,
+                      avg_matched=round(sum(matched) / len(matched), 2) if matched else 0)]
+
+
+def scenario_trigger_offer(size, args, services):
+    users = make_user_wishes(args.users, seed=size, prefix=f'T{size}_')
+    submitted = []
+
+    def trigger(user):
+        user_id, wishes = user
+        response = client().post('/trigger-offer', json={'userId': user_id, 'wishes': wishes})
+        if response.status_code == 200: submitted.append(user_id)
+        return response.status_code == 200
+
+    latencies, errors, accept_elapsed = run_concurrently(trigger, users, args.concurrency)
+    accepted = summarize('trigger-offer/accept', size, latencies, errors, accept_elapsed, args.concurrency, services)
+    # 受付中に動き始めたジョブの呼び出しは trigger-offer/job の方で数える
+    accepted["upstream_calls"] = {}
+
+    started = time.perf_counter()
+    drained = wait_for_jobs(args.job_timeout)
+    elapsed = accept_elapsed + (time.perf_counter() - started)
+    # 受付からジョブ完了（オファー予約まで）の時間は jobs テーブルの記録から出す
+    job_seconds, failed, statuses = [], 0, {}
+    for user_id in submitted:
+        job = app.offer_jobs.get_latest(user_id)
+        statuses[job['status']] = statuses.get(job['status'], 0) + 1
+        if job['status'] == 'done': job_seconds.append(job['updated_at'] - job['created_at'])
+        else: failed += 1
+    end_to_end = summarize('trigger-offer/job', size, job_seconds, failed + errors, elapsed, app.offer_jobs.concurrency, services,
+                           job_statuses=statuses, drained=drained)
+    return [accepted, end_to_end]
+
+
+def seed_due_queue(size, rows, run, missing_text_ratio):
+    """期限切れの Offer Queue の行と、その宛先のユーザーをローカルに入れる（1ユーザー5行）"""
+    rng = random.Random(run)
+    headers = app.store.headers('ユーザー管理')
+    send_at = (datetime.now(app.JST) - timedelta(minutes=5)).isoformat()
+    queue_rows, texts = [], []
+    for user_id, wishes in make_user_wishes((rows + 4) // 5, seed=run, prefix=f'Q{size}_{run}_'):
+        user_row = app.build_user_row_dict(user_id, wishes)
+        app.store.upsert_user(user_id, {c + 1: user_row.get(h, '') for c, h in enumerate(headers[:16])}, len(headers))
+        for salon_id in rng.sample(range(1, size + 1), min(5, size)):
+            queue_rows.append([user_id, salon_id, send_at, 'pending'])
+            texts.append(None if rng.random() < missing_text_ratio else OFFER_TEXT)
+    app.store.enqueue_offers(queue_rows[:rows], texts[:rows])
+
+
+def scenario_offer_queue(size, args, services):
+    latencies, errors, total = [], 0, 0.0
+    for run in range(args.queue_runs):
+        seed_due_queue(size, args.queue_rows, run, args.queue_missing_text_ratio)
+        started = time.perf_counter()
+        response = client().get(f"/process-offer-queue?secret={os.environ['CRON_SECRET']}")
+        seconds = time.perf_counter() - started
+        total += seconds
+        if response.status_code == 200: latencies.append(seconds)
+        else: errors += 1
+    # このシナリオのスループットは1秒あたりに処理した行数
+    result = summarize('offer-queue', size, latencies, errors, total, 1, services, due_rows_per_run=args.queue_rows)
+    result["throughput_rows_per_s"] = round(args.queue_rows * len(latencies) / total, 1) if total > 0 else None
+    return [result]
+
+
+RUNNERS = {
+    'salon-detail': scenario_salon_detail,
+    'match': scenario_match,
+    'trigger-offer': scenario_trigger_offer,
+    'offer-queue': scenario_offer_queue,
+}
+
+
+def format_result(r):
+    calls = ' '.join(f"{name}={c['calls']}" + (f"(err {c['errors']})" if c['errors'] else '') for name, c in r['upstream_calls'].items())
+    throughput = f"{r['throughput_rows_per_s']}rows/s" if 'throughput_rows_per_s' in r else f"{r['throughput_rps']}req/s"
+    return (f"{r['scenario']:<22} salons={r['salons']:<6} n={r['requests']:<5} err={r['errors']:<3} {throughput:>12}  "
+            f"p50={r['p50_ms']}ms p95={r['p95_ms']}ms p99={r['p99_ms']}ms\n{'':<22} upstream: {calls or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--salons', default='300,3000', help='店舗マスタの規模（カンマ区切り）')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help='salon-detail のリクエスト数')
+    parser.add_argument('--users', type=int, default=50, help='match / trigger-offer のユーザー数')
+    parser.add_argument('--queue-rows', type=int, default=200)
+    parser.add_argument('--queue-runs', type=int, default=3)
+    parser.add_argument('--queue-missing-text-ratio', type=float, default=0.1, help='オファー文が事前生成されていない行の割合')
+    parser.add_argument('--job-timeout', type=float, default=600)
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    parser.add_argument('--sheets-quota-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--line-error-rate', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help='アプリのログを表示する')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.salons.split(',')]
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(RUNNERS)
+    if unknown: parser.error(f"unknown scenarios: {sorted(unknown)}")
+
+    # 初回の取り込みは遅延・エラーなしで済ませる
+    services = FakeServices(scale=0)
+    spreadsheet = install_fakes(services, sizes[0])
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    results = []
+    with log:
+        app.sheet_sync.ensure_initialized()
+        app.warm_up(network=False)
+        services.scale = args.latency_scale
+        services.sheets_quota_error_rate = args.sheets_quota_error_rate
+        services.gemini_error_rate = args.gemini_error_rate
+        services.line_error_rate = args.line_error_rate
+        for size in sizes:
+            if size != sizes[0]:
+                spreadsheet.replace('店舗マスタ', make_salon_rows(size))
+                app.sheet_sync.pull('salons')
+            for name in scenarios:
+                services.calls.reset()
+                results += RUNNERS[name](size, args, services)
+
+    if args.json:
+        print(json.dumps({"latency_scale": args.latency_scale, "results": results}, ensure_ascii=False, indent=2))
+        return
+    print(f"latency_scale={args.latency_scale} concurrency={args.concurrency} sheets_quota_error_rate={args.sheets_quota_error_rate}")
+    for result in results: print(format_result(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+app の起動コストのレポート。リリースごとに実行して、結果の JSON を比べられるようにする。
+
+別プロセスで `python -X importtime -c "import app"` を実行し、app の読み込み時間と、
+app が直接読み込んでいるモジュールごとの時間（子モジュールを含む）を出す。
+続けて warm_up(network=False) の各準備にかかった時間も測る（シートや LINE には接続しない）。
+
+    python benchmarks/report_startup.py --top 15
+    python benchmarks/report_startup.py --json > startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WARM_UP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+report = app.warm_up(network=False)
+print("STARTUP_REPORT " + json.dumps({"import_seconds": round(imported, 3), "warm_up": report["warm_up"], "warm_up_errors": report["warm_up_errors"]}))
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    # ローカルDBは一時ディレクトリに作る（LINE の認証情報は使わないのでダミーでよい）
+    env.setdefault('LUMINA_DB_PATH', os.path.join(tempfile.mkdtemp(), 'startup.sqlite3'))
+    env.setdefault('YOUR_CHANNEL_SECRET', 'startup-report')
+    env.setdefault('YOUR_CHANNEL_ACCESS_TOKEN', 'startup-report')
+    return env
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力を [(モジュール名, 自身の時間us, 子を含む時間us, 深さ)] にする"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        head, cumulative_us, name = line.split('|', 2)
+        # 名前の前の空白（最初の1文字を除く）2つごとに1段深い
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        rows.append((name.strip(), int(head.split(':', 1)[1]), int(cumulative_us), depth))
+    return rows
+
+
+def measure_imports(top):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=ROOT, env=_env(), capture_output=True, text=True, check=True,
+    )
+    rows = parse_importtime(result.stderr)
+    app_row = next(row for row in reversed(rows) if row[0] == 'app')
+    # app の直下（深さ1）で読み込まれたモジュールを時間の長い順に
+    app_index = rows.index(app_row)
+    direct = []
+    for name, _, cumulative_us, depth in reversed(rows[:app_index]):
+        if depth == 0: break
+        if depth == 1: direct.append((name, cumulative_us))
+    direct.sort(key=lambda item: -item[1])
+    return {
+        "app_import_ms": round(app_row[2] / 1000, 1),
+        "modules_loaded": len(rows),
+        "top_imports_ms": {name: round(us / 1000, 1) for name, us in direct[:top]},
+        "heavy_modules_loaded": {name: any(row[0] == name for row in rows) for name in ('pandas', 'geopy', 'linebot.v3.messaging')},
+    }
+
+
+def measure_warm_up():
+    result = subprocess.run([sys.executable, '-c', WARM_UP_SCRIPT], cwd=ROOT, env=_env(), capture_output=True, text=True, check=True)
+    line = next(line for line in result.stdout.splitlines() if line.startswith('STARTUP_REPORT '))
+    return json.loads(line[len('STARTUP_REPORT '):])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    report = {"python": sys.version.split()[0], "imports": measure_imports(args.top), "warm_up": measure_warm_up()}
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    imports = report["imports"]
+    print(f"import app: {imports['app_import_ms']}ms ({imports['modules_loaded']} modules)")
+    for name, ms in imports["top_imports_ms"].items():
+        print(f"  {ms:8.1f}ms  {name}")
+    print(f"heavy modules loaded at import: {imports['heavy_modules_loaded']}")
+    warm = report["warm_up"]
+    print(f"warm_up(network=False): {warm['warm_up']}" + (f" errors={warm['warm_up_errors']}" if warm['warm_up_errors'] else ""))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+import json
+import threading
+import time
+
+from gspread.utils import numericise_all
+
+import local_db
+
+# ローカルのテーブル名 → 同期先のシート名と、行の値から作る索引列（0始まりの列番号）、
+# シートの行と突き合わせるときに使う key 列（運営が行を並べ替え・削除しても変わらない列）、
+# シートへ書くときの value_input_option（ユーザーが入力した文字列を含むシートは、数式や数値に変換されないよう RAW）
+TABLES = {
+    'users': {'sheet': 'ユーザー管理', 'index': {'user_id': 0}, 'key': (0,), 'value_input': 'RAW'},
+    'offers': {'sheet': 'オファー管理', 'index': {'user_id': 0, 'salon_id': 1}, 'key': (0, 1), 'value_input': 'USER_ENTERED'},
+    'offer_queue': {'sheet': 'Offer Queue', 'index': {'user_id': 0, 'salon_id': 1, 'send_at': 2, 'status': 3}, 'key': (0, 1, 2), 'value_input': 'USER_ENTERED'},
+}
+SALON_SHEET = '店舗マスタ'
+# オファー管理をシートから取り込み直すたびに増やす（各プロセスのオファー履歴索引を作り直す合図）
+OFFER_HISTORY_GENERATION_KEY = 'offers.generation'
+
+
+def _cell(values, index):
+    return str(values[index]) if index < len(values) and values[index] is not None else ''
+
+
+class LocalStore:
+    """
+    ユーザー管理・店舗マスタ・オファー管理・Offer Queue を SQLite に持つローカルストア。
+    ルートはここだけを読み書きし、シートとの同期は SheetSync がバックグラウンドで行う。
+
+    各行はシート上の1行の値のリスト（data）として持ち、
+    - sheet_row が NULL の行はシートへの追記待ち
+    - dirty_cols に列番号（1始まり）がある行はシートへのセル更新待ち
+    を表す。version はローカルで書き換えるたびに増え、同期中に更新された行を取りこぼさないために使う。
+    """
+
+    def __init__(self, db_path=None):
+        self._db_path = db_path
+        # オファー履歴の索引 {ユーザーID: {店舗ID}}。offers の最大 id と世代番号で、他プロセスの追記・取り込みに追従する
+        self._history_lock = threading.Lock()
+        self._offer_history = {}
+        self._history_max_id = 0
+        self._history_generation = None
+        self._ensure_schema()
+
+    def _conn(self):
+        return local_db.connect(self._db_path)
+
+    def _ensure_schema(self):
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS sheet_meta (sheet TEXT PRIMARY KEY, headers TEXT NOT NULL, pulled_at REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS salons (salon_id TEXT PRIMARY KEY, sheet_row INTEGER, data TEXT NOT NULL)")
+        for table, spec in TABLES.items():
+            index_columns = ''.join(f", {name} TEXT" for name in spec['index'])
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, sheet_row INTEGER,"
+                f" data TEXT NOT NULL, dirty_cols TEXT NOT NULL DEFAULT '[]', version INTEGER NOT NULL DEFAULT 0{index_columns})"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_sheet_row ON {table} (sheet_row)")
+        # 事前に生成したオファー文と、送信処理中の確保（どちらもシートには書かない）
+        queue_columns = [row['name'] for row in conn.execute("PRAGMA table_info(offer_queue)")]
+        for name, column_type in (('offer_text', 'TEXT'), ('claimed_by', 'TEXT'), ('claim_until', 'REAL')):
+            if name not in queue_columns: conn.execute(f"ALTER TABLE offer_queue ADD COLUMN {name} {column_type}")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_user_id ON users (user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS offers_user_id ON offers (user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS offer_queue_due ON offer_queue (status, send_at)")
+
+    # --- メタ情報 ---
+
+    def headers(self, sheet):
+        row = self._conn().execute("SELECT headers FROM sheet_meta WHERE sheet = ?", (sheet,)).fetchone()
+        return json.loads(row['headers']) if row else []
+
+    def is_pulled(self, sheet):
+        row = self._conn().execute("SELECT pulled_at FROM sheet_meta WHERE sheet = ?", (sheet,)).fetchone()
+        return bool(row and row['pulled_at'])
+
+    def _set_meta(self, conn, sheet, headers):
+        conn.execute(
+            "INSERT OR REPLACE INTO sheet_meta (sheet, headers, pulled_at) VALUES (?, ?, ?)",
+            (sheet, json.dumps(headers, ensure_ascii=False), time.time()),
+        )
+
+    # --- 共通の行操作 ---
+
+    def _index_values(self, table, values):
+        return [_cell(values, i) for i in TABLES[table]['index'].values()]
+
+    def _row_key(self, table, values):
+        return tuple(_cell(values, i) for i in TABLES[table]['key'])
+
+    def _insert(self, conn, table, values, sheet_row=None):
+        names = list(TABLES[table]['index'])
+        columns = ', '.join(['sheet_row', 'data'] + names)
+        placeholders = ', '.join(['?'] * (2 + len(names)))
+        cursor = conn.execute(
+            f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+            [sheet_row, json.dumps(values, ensure_ascii=False)] + self._index_values(table, values),
+        )
+        return cursor.lastrowid
+
+    def _update_cells(self, conn, table, row, cells):
+        """cells: {列番号(1始まり): 値}。行を書き換えて dirty_cols に加える"""
+        values = json.loads(row['data'])
+        for col, value in cells.items():
+            values += [''] * (col - len(values))
+            values[col - 1] = value
+        dirty = sorted(set(json.loads(row['dirty_cols'])) | set(cells))
+        assignments = ', '.join(f"{name} = ?" for name in TABLES[table]['index'])
+        conn.execute(
+            f"UPDATE {table} SET data = ?, dirty_cols = ?, version = version + 1, {assignments} WHERE id = ?",
+            [json.dumps(values, ensure_ascii=False), json.dumps(dirty)] + self._index_values(table, values) + [row['id']],
+        )
+        return values
+
+    # --- ユーザー管理 ---
+
+    def _user_row(self, user_id, conn=None):
+        return (conn or self._conn()).execute("SELECT * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+
+    def get_user(self, user_id):
+        """{ヘッダー: 値} を返す。存在しなければ None"""
+        row = self._user_row(user_id)
+        if row is None: return None
+        headers = self.headers(TABLES['users']['sheet'])
+        values = json.loads(row['data'])
+        values += [''] * (len(headers) - len(values))
+        return dict(zip(headers, values))
+
+    def get_users(self, user_ids):
+        user_ids = [str(u) for u in set(user_ids)]
+        if not user_ids: return {}
+        headers = self.headers(TABLES['users']['sheet'])
+        placeholders = ', '.join(['?'] * len(user_ids))
+        rows = self._conn().execute(f"SELECT user_id, data FROM users WHERE user_id IN ({placeholders})", user_ids).fetchall()
+        users = {}
+        for row in rows:
+            values = json.loads(row['data'])
+            values += [''] * (len(headers) - len(values))
+            users[row['user_id']] = dict(zip(headers, values))
+        return users
+
+    def update_user_cells(self, user_id, cells):
+        """既存ユーザーの指定列を書き換える。ユーザーがいなければ False"""
+        conn = self._conn()
+        with local_db.transaction(conn):
+            row = self._user_row(user_id, conn)
+            if row is None: return False
+            self._update_cells(conn, 'users', row, cells)
+            return True
+
+    def upsert_user(self, user_id, cells, row_width):
+        """ユーザーがいれば指定列を更新し、いなければ row_width 列の新しい行として追加する"""
+        conn = self._conn()
+        with local_db.transaction(conn):
+            row = self._user_row(user_id, conn)
+            if row is not None:
+                self._update_cells(conn, 'users', row, cells)
+                return 'updated'
+            values = [''] * max(row_width, max(cells) if cells else 0, 1)
+            for col, value in cells.items(): values[col - 1] = value
+            values[0] = user_id
+            self._insert(conn, 'users', values)
+            return 'created'
+
+    # --- 店舗マスタ ---
+
+    def all_salons(self):
+        """get_all_records() と同じ形（数値は数値に変換済み）の店舗リスト"""
+        headers = self.headers(SALON_SHEET)
+        rows = self._conn().execute("SELECT data FROM salons ORDER BY sheet_row").fetchall()
+        salons = []
+        for row in rows:
+            values = json.loads(row['data'])
+            values += [''] * (len(headers) - len(values))
+            salons.append(dict(zip(headers, values)))
+        return salons
+
+    def replace_salons(self, headers, rows):
+        if '店舗ID' not in headers: raise ValueError(f"{SALON_SHEET} に 店舗ID 列がありません: {headers}")
+        id_col = headers.index('店舗ID')
+        conn = self._conn()
+        with local_db.transaction(conn):
+            conn.execute("DELETE FROM salons")
+            for i, values in enumerate(rows, start=2):
+                salon_id = _cell(values, id_col)
+                if not salon_id: continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO salons (salon_id, sheet_row, data) VALUES (?, ?, ?)",
+                    (salon_id, i, json.dumps(numericise_all(list(values)), ensure_ascii=False)),
+                )
+            self._set_meta(conn, SALON_SHEET, headers)
+
+    # --- オファー管理 ---
+
+    def append_offers(self, rows):
+        conn = self._conn()
+        with local_db.transaction(conn):
+            for values in rows: self._insert(conn, 'offers', list(values))
+        with self._history_lock:
+            for values in rows:
+                user_id, salon_id = self._index_values('offers', values)
+                self._offer_history.setdefault(user_id, set()).add(salon_id)
+
+    def _sync_offer_history(self):
+        generation = local_db.get_state(OFFER_HISTORY_GENERATION_KEY, '0', path=self._db_path)
+        conn = self._conn()
+        with self._history_lock:
+            if generation != self._history_generation:
+                # 初回・シートから取り込み直した後は全件から作り直す
+                self._offer_history, self._history_max_id = {}, 0
+                self._history_generation = generation
+            rows = conn.execute("SELECT id, user_id, salon_id FROM offers WHERE id > ? ORDER BY id", (self._history_max_id,)).fetchall()
+            for row in rows:
+                self._offer_history.setdefault(row['user_id'], set()).add(row['salon_id'])
+            if rows: self._history_max_id = rows[-1]['id']
+
+    def offered_salon_ids(self, user_id):
+        """そのユーザーにオファー済みの店舗IDの集合（文字列）"""
+        self._sync_offer_history()
+        with self._history_lock:
+            return frozenset(self._offer_history.get(str(user_id), ()))
+
+    # --- Offer Queue ---
+
+    def enqueue_offers(self, rows, offer_texts=None):
+        """rows: [[user_id, salon_id, send_at, 'pending'], ...]。offer_texts は各行の事前生成したオファー文"""
+        conn = self._conn()
+        with local_db.transaction(conn):
+            for i, values in enumerate(rows):
+                row_id = self._insert(conn, 'offer_queue', list(values))
+                if offer_texts and offer_texts[i]:
+                    conn.execute("UPDATE offer_queue SET offer_text = ? WHERE id = ?", (offer_texts[i], row_id))
+
+    def claim_due_queue(self, now_iso, owner, claim_seconds, limit=None):
+        """
+        期限の来た pending 行を owner の処理中として確保し、返す（複数プロセスの実行が同じ行を二重に送らないため）。
+        確保の期限（claim_until）を過ぎた行は、処理中に落ちた実行の分とみなして取り直す。
+        """
+        now = time.time()
+        sql = ("SELECT id, user_id, salon_id, send_at, offer_text FROM offer_queue"
+               " WHERE status = 'pending' AND send_at <= ? AND (claim_until IS NULL OR claim_until < ?) ORDER BY send_at, id")
+        params = [now_iso, now]
+        if limit:
+            sql += " LIMIT ?"; params.append(limit)
+        conn = self._conn()
+        with local_db.transaction(conn):
+            rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+            conn.executemany(
+                "UPDATE offer_queue SET claimed_by = ?, claim_until = ? WHERE id = ?",
+                [(owner, now + claim_seconds, row['id']) for row in rows],
+            )
+        return rows
+
+    def release_queue_claims(self, queue_ids, owner):
+        """owner が確保したまま送らなかった行を、次の実行で取れるように戻す"""
+        conn = self._conn()
+        with local_db.transaction(conn):
+            conn.executemany(
+                "UPDATE offer_queue SET claimed_by = NULL, claim_until = NULL WHERE id = ? AND claimed_by = ?",
+                [(queue_id, owner) for queue_id in queue_ids],
+            )
+
+    def set_queue_status(self, updates):
+        """updates: [(offer_queue.id, status), ...]"""
+        conn = self._conn()
+        with local_db.transaction(conn):
+            for queue_id, status in updates:
+                row = conn.execute("SELECT * FROM offer_queue WHERE id = ?", (queue_id,)).fetchone()
+                if row is None: continue
+                self._update_cells(conn, 'offer_queue', row, {4: status})
+                conn.execute("UPDATE offer_queue SET claimed_by = NULL, claim_until = NULL WHERE id = ?", (queue_id,))
+
+    def first_pending_queue_row(self):
+        """シート上で pending の最初の行番号（なければ最終行の次）"""
+        conn = self._conn()
+        row = conn.execute("SELECT MIN(sheet_row) AS r FROM offer_queue WHERE status = 'pending' AND sheet_row IS NOT NULL").fetchone()
+        if row['r']: return row['r']
+        row = conn.execute("SELECT MAX(sheet_row) AS r FROM offer_queue").fetchone()
+        return (row['r'] or 1) + 1
+
+    def shift_queue_rows(self, deleted_count):
+        """シートの先頭 deleted_count 行（2行目から）が削除されたのに合わせて行番号をずらす"""
+        conn = self._conn()
+        with local_db.transaction(conn):
+            conn.execute("DELETE FROM offer_queue WHERE sheet_row BETWEEN 2 AND ?", (1 + deleted_count,))
+            conn.execute("UPDATE offer_queue SET sheet_row = sheet_row - ? WHERE sheet_row > ?", (deleted_count, 1 + deleted_count))
+
+    # --- 同期用 ---
+
+    def pending_appends(self, table):
+        rows = self._conn().execute(f"SELECT id, data, version FROM {table} WHERE sheet_row IS NULL ORDER BY id").fetchall()
+        return [(row['id'], json.loads(row['data']), row['version']) for row in rows]
+
+    def mark_appended(self, table, rows, start_row):
+        """rows: pending_appends() の (id, data, version)。追記した順に start_row から行番号を振る"""
+        conn = self._conn()
+        with local_db.transaction(conn):
+            for offset, (row_id, _, version) in enumerate(rows):
+                conn.execute(
+                    f"UPDATE {table} SET sheet_row = ?, dirty_cols = CASE WHEN version = ? THEN '[]' ELSE dirty_cols END WHERE id = ?",
+                    (start_row + offset, version, row_id),
+                )
+
+    def pending_updates(self, table):
+        rows = self._conn().execute(
+            f"SELECT id, sheet_row, data, dirty_cols, version FROM {table} WHERE sheet_row IS NOT NULL AND dirty_cols != '[]'"
+        ).fetchall()
+        return [(row['id'], row['sheet_row'], json.loads(row['data']), json.loads(row['dirty_cols']), row['version']) for row in rows]
+
+    def mark_updated(self, table, row_id, version):
+        # 同期中にさらに書き換えられていたら dirty のまま残し、次回また送る
+        self._conn().execute(f"UPDATE {table} SET dirty_cols = '[]' WHERE id = ? AND version = ?", (row_id, version))
+
+    def reindex(self, table, key_rows, start_row=2):
+        """
+        シートの key 列（start_row 行目から）と突き合わせて、ずれた行番号を直す。
+        シートから消えた行は、未送信の変更があれば追記し直し、なければローカルからも消す。
+        戻り値は直した件数。
+        """
+        conn = self._conn()
+        with local_db.transaction(conn):
+            return self._reindex(conn, table, key_rows, start_row)
+
+    def _reindex(self, conn, table, key_rows, start_row):
+        actual_rows = {}
+        for i, values in enumerate(key_rows, start=start_row):
+            key = self._row_key(table, values)
+            if any(key): actual_rows.setdefault(key, []).append(i)
+        rows = conn.execute(
+            f"SELECT id, sheet_row, data, dirty_cols FROM {table} WHERE sheet_row >= ? ORDER BY sheet_row", (start_row,)
+        ).fetchall()
+        # 行番号どおりの位置にある行を先に確定し、残りを同じ key の空いている行へ上から割り当てる
+        claimed, moved = set(), []
+        for row in rows:
+            key = self._row_key(table, json.loads(row['data']))
+            if row['sheet_row'] in actual_rows.get(key, ()) and row['sheet_row'] not in claimed:
+                claimed.add(row['sheet_row'])
+            else:
+                moved.append((row, key))
+        for row, key in moved:
+            actual = next((i for i in actual_rows.get(key, ()) if i not in claimed), None)
+            if actual is not None:
+                claimed.add(actual)
+                conn.execute(f"UPDATE {table} SET sheet_row = ? WHERE id = ?", (actual, row['id']))
+            elif row['dirty_cols'] != '[]':
+                conn.execute(f"UPDATE {table} SET sheet_row = NULL WHERE id = ?", (row['id'],))
+            else:
+                conn.execute(f"DELETE FROM {table} WHERE id = ?", (row['id'],))
+        return len(moved)
+
+    def rows_in_place(self, table, rows, start_row=2):
+        """ローカルの行（start_row 行目以降）が、シート上の同じ行番号の行と key 列まで一致しているか"""
+        local = self._conn().execute(f"SELECT sheet_row, data FROM {table} WHERE sheet_row >= ?", (start_row,)).fetchall()
+        for row in local:
+            offset = row['sheet_row'] - start_row
+            if offset >= len(rows) or self._row_key(table, rows[offset]) != self._row_key(table, json.loads(row['data'])): return False
+        return True
+
+    def has_pending_writes(self):
+        conn = self._conn()
+        return any(
+            conn.execute(f"SELECT 1 FROM {table} WHERE sheet_row IS NULL OR dirty_cols != '[]' LIMIT 1").fetchone()
+            for table in TABLES
+        )
+
+    def apply_pull(self, table, headers, rows, start_row=2):
+        """
+        シートから読んだ rows（start_row 行目から）をローカルに反映する。
+        ローカルで未送信の列（dirty_cols）と追記待ちの行は上書きしない。
+        users はユーザーIDで、それ以外は key 列で行番号を直してから行番号で突き合わせる
+        （運営が行を挿入・削除・並べ替えても、別の行の値やオファー文と混ざらないように）。
+        """
+        conn = self._conn()
+        with local_db.transaction(conn):
+            if table != 'users': self._reindex(conn, table, rows, start_row)
+            seen = set()
+            for offset, values in enumerate(rows):
+                sheet_row = start_row + offset
+                values = list(values)
+                if table == 'users':
+                    if not values or values[0] in ('', None): continue
+                    local = conn.execute("SELECT * FROM users WHERE user_id = ?", (str(values[0]),)).fetchone()
+                else:
+                    local = conn.execute(f"SELECT * FROM {table} WHERE sheet_row = ?", (sheet_row,)).fetchone()
+                if local is None:
+                    seen.add(self._insert(conn, table, values, sheet_row=sheet_row))
+                    continue
+                seen.add(local['id'])
+                local_values = json.loads(local['data'])
+                dirty = json.loads(local['dirty_cols'])
+                if local['sheet_row'] is None:
+                    # 追記待ちのユーザーがシート側に既にいた場合は、その行を更新対象にする
+                    dirty = list(range(1, len(local_values) + 1))
+                merged = list(values) + [''] * max(0, len(local_values) - len(values))
+                for col in dirty:
+                    if col - 1 < len(local_values): merged[col - 1] = local_values[col - 1]
+                assignments = ', '.join(f"{name} = ?" for name in TABLES[table]['index'])
+                conn.execute(
+                    f"UPDATE {table} SET sheet_row = ?, data = ?, dirty_cols = ?, {assignments} WHERE id = ?",
+                    [sheet_row, json.dumps(merged, ensure_ascii=False), json.dumps(dirty)] + self._index_values(table, merged) + [local['id']],
+                )
+
+            # シートから消えた行（未送信の変更がないもの）はローカルからも消す
+            stale = conn.execute(
+                f"SELECT id FROM {table} WHERE sheet_row IS NOT NULL AND sheet_row >= ? AND dirty_cols = '[]'", (start_row,)
+            ).fetchall()
+            for row in stale:
+                if row['id'] not in seen: conn.execute(f"DELETE FROM {table} WHERE id = ?", (row['id'],))
+            self._set_meta(conn, TABLES[table]['sheet'], headers)
+            if table == 'offers':
+                generation = int(local_db.get_state(OFFER_HISTORY_GENERATION_KEY, '0', path=self._db_path))
+                local_db.set_state(OFFER_HISTORY_GENERATION_KEY, generation + 1, path=self._db_path)
+
+    def stats(self):
+        conn = self._conn()
+        result = {'salons': conn.execute("SELECT COUNT(*) FROM salons").fetchone()[0], 'offer_history_users': len(self._offer_history)}
+        for table in TABLES:
+            result[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            result[f"{table}_pending_appends"] = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE sheet_row IS NULL").fetchone()[0]
+            result[f"{table}_pending_updates"] = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE sheet_row IS NOT NULL AND dirty_cols != '[]'").fetchone()[0]
+        return result
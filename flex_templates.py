@@ -0,0 +1,89 @@
+from functools import lru_cache
+
+# linebot.v3.messaging は読み込みに時間がかかるので、実際に検証・送信するときに読み込む
+
+
+class Slot:
+    """テンプレートの中で、メッセージごとに値を差し込む場所"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"Slot({self.name!r})"
+
+
+@lru_cache(maxsize=None)
+def _validated_bubble_class():
+    from linebot.v3.messaging import FlexBubble
+
+    class _ValidatedBubble(FlexBubble):
+        """検証済みの dict をそのまま送るための FlexBubble（pydantic の検証と dict への変換をしない）"""
+
+        def to_dict(self):
+            return self.__dict__['raw']
+
+    return _ValidatedBubble
+
+
+def validated_container(raw):
+    """FlexTemplate.fill() で作った dict を、検証し直さずに FlexMessage の contents に渡せる形にする"""
+    return _validated_bubble_class().construct(type='bubble', raw=raw)
+
+
+def _compile(node):
+    """node を (スロットを含むか, 値から node を組み立てる関数) にする。スロットを含まない部分は同じオブジェクトを使い回す"""
+    if isinstance(node, Slot):
+        name = node.name
+        return True, lambda values: values[name]
+    if isinstance(node, dict):
+        children = {k: _compile(v) for k, v in node.items()}
+        if not any(has_slot for has_slot, _ in children.values()): return False, lambda values: node
+        builders = [(k, build) for k, (_, build) in children.items()]
+        return True, lambda values: {k: build(values) for k, build in builders}
+    if isinstance(node, list):
+        children = [_compile(v) for v in node]
+        if not any(has_slot for has_slot, _ in children): return False, lambda values: node
+        builders = [build for _, build in children]
+        return True, lambda values: [build(values) for build in builders]
+    return False, lambda values: node
+
+
+def _slot_names(node):
+    if isinstance(node, Slot): return {node.name}
+    if isinstance(node, dict): return set().union(*(_slot_names(v) for v in node.values())) if node else set()
+    if isinstance(node, list): return set().union(*(_slot_names(v) for v in node)) if node else set()
+    return set()
+
+
+class FlexTemplate:
+    """
+    Flex Message の bubble のひな形。sample の値を差し込んで1回だけ SDK の検証を通し（起動時の warm-up か、最初の fill() のとき）、
+    以降は fill() でスロットだけを埋める（スロット以外の部分は全メッセージで共有するので、戻り値を書き換えないこと）。
+    スロットには文字列だけを入れる想定。
+    """
+
+    def __init__(self, shape, sample):
+        self.slots = frozenset(_slot_names(shape))
+        missing = self.slots - set(sample)
+        if missing: raise ValueError(f"sample に値のないスロットがあります: {sorted(missing)}")
+        _, self._build = _compile(shape)
+        self._sample = sample
+        self.validated = False
+
+    def validate(self):
+        if self.validated: return
+        from linebot.v3.messaging import FlexContainer
+        FlexContainer.from_dict(self._build(self._sample))
+        self.validated = True
+
+    def fill(self, **values):
+        """スロットを埋めた bubble の dict を返す"""
+        self.validate()
+        for name in self.slots:
+            if not isinstance(values.get(name), str):
+                raise ValueError(f"スロット {name} には文字列を指定してください: {values.get(name)!r}")
+        return self._build(values)
+
+    def container(self, **values):
+        return validated_container(self.fill(**values))
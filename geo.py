@@ -0,0 +1,167 @@
+import numpy as np
+
+# WGS84 楕円体
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+# 緯度1度あたりの距離の下限（赤道付近の子午線方向）。バウンディングボックスを広めに取るために使う
+KM_PER_DEG_LAT_MIN = 110.574
+
+
+def lambert_distance_km(lat, lon, lats, lons):
+    """
+    1地点 (lat, lon) から複数地点 (lats, lons) までの楕円体上の距離[km]をまとめて計算する。
+
+    Lambert の公式（更成緯度上の大円距離に扁平率の1次補正をかけたもの）を NumPy でベクトル化している。
+    geopy.distance.geodesic（Karney法）との差は、数十km以内では 1m 未満、
+    日本国内の長距離（約2,000km）でも数メートル程度に収まる（benchmarks/bench_distance.py で確認）。
+    25km / 5km の判定に対しては十分な精度。
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+
+    b1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat)))
+    b2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lats)))
+    dlon = np.radians(lons - lon)
+
+    # 更成緯度上の中心角（haversine）
+    h = np.sin((b2 - b1) / 2) ** 2 + np.cos(b1) * np.cos(b2) * np.sin(dlon / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+    p = (b1 + b2) / 2
+    q = (b2 - b1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / np.cos(sigma / 2) ** 2
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / np.sin(sigma / 2) ** 2
+        distance = WGS84_A_KM * (sigma - WGS84_F / 2 * (x + y))
+    return np.where(sigma > 0, distance, 0.0)
+
+
+def bounding_box_mask(lat, lon, lats, lons, radius_km):
+    """
+    (lat, lon) から radius_km 以内に入りうる地点だけを True にする粗いマスク。
+    必ず実距離以上の範囲を取るので、この後に正確な距離で絞り込むこと。
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    dlat = radius_km / KM_PER_DEG_LAT_MIN
+    # 経度方向はボックスの極側の端の緯度で幅を見積もる
+    edge_lat = min(abs(lat) + dlat, 89.0)
+    dlon = radius_km / (KM_PER_DEG_LAT_MIN * np.cos(np.radians(edge_lat)))
+    lon_diff = np.abs((lons - lon + 180.0) % 360.0 - 180.0)
+    return (np.abs(lats - lat) <= dlat) & (lon_diff <= dlon)
+
+
+def distances_within(lat, lon, lats, lons, radius_km):
+    """
+    radius_km 以内の地点の位置（インデックス）とその距離[km]を返す。
+    バウンディングボックスで候補を絞ってから、残りだけ正確な距離を計算する。
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    candidates = np.flatnonzero(bounding_box_mask(lat, lon, lats, lons, radius_km))
+    if candidates.size == 0:
+        return candidates, np.empty(0)
+    distances = lambert_distance_km(lat, lon, lats[candidates], lons[candidates])
+    within = distances <= radius_km
+    return candidates[within], distances[within]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class SpatialIndex:
+    """
+    店舗座標の格子インデックス。
+    緯度・経度を cell_deg 度のマスに分け、半径検索では円にかかるマスの店舗だけを距離計算する。
+    全体の店舗数が増えても、1回の検索で触るのは周辺のマスの店舗だけになる。
+
+    店舗はマスの順（行→列）に並べ替えて持つので、同じ行のマスの店舗は配列上で連続する。
+    検索では行ごとに1つのスライスを取るだけで候補が集まる。
+    距離は lambert_distance_km と同じ Lambert の公式だが、更成緯度の球面上の単位ベクトルを構築時に計算しておき、
+    検索時は内積と平方根・arcsin だけで求める（三角関数を店舗ごとに何度も呼ばない）。
+    """
+
+    # マスの (行, 列) を1つの整数にするときの列の幅（経度 ±180度を cell_deg で割った数より大きければよい）
+    _COL_SPAN = 1 << 20
+
+    def __init__(self, lats, lons, cell_deg=0.1):
+        self.cell_deg = cell_deg
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+
+        valid = np.flatnonzero(~(np.isnan(self.lats) | np.isnan(self.lons)))
+        rows = np.floor(self.lats[valid] / cell_deg).astype(np.int64)
+        cols = np.floor(self.lons[valid] / cell_deg).astype(np.int64)
+
+        # マスの順に並べ替える（ソートするだけなので大きな店舗数でも速い）
+        cell_keys = rows * self._COL_SPAN + cols
+        order = np.argsort(cell_keys, kind='stable')
+        self._cell_keys = cell_keys[order]
+        self._positions = valid[order]
+        self._vectors = _reduced_unit_vectors(self.lats[self._positions], self.lons[self._positions])
+        self.size = int(valid.size)
+
+    @classmethod
+    def from_records(cls, records, cell_deg=0.1):
+        lats = [_to_float(r.get('緯度')) for r in records]
+        lons = [_to_float(r.get('経度')) for r in records]
+        return cls(lats, lons, cell_deg=cell_deg)
+
+    def query_radius(self, lat, lon, radius_km):
+        """(lat, lon) から radius_km 以内の店舗の位置（records上のインデックス）と距離[km]を返す"""
+        dlat = radius_km / KM_PER_DEG_LAT_MIN
+        edge_lat = min(abs(lat) + dlat, 89.0)
+        dlon = radius_km / (KM_PER_DEG_LAT_MIN * np.cos(np.radians(edge_lat)))
+
+        row_min, row_max = int(np.floor((lat - dlat) / self.cell_deg)), int(np.floor((lat + dlat) / self.cell_deg))
+        col_min, col_max = int(np.floor((lon - dlon) / self.cell_deg)), int(np.floor((lon + dlon) / self.cell_deg))
+        rows = np.arange(row_min, row_max + 1, dtype=np.int64) * self._COL_SPAN
+        starts = np.searchsorted(self._cell_keys, rows + col_min, side='left')
+        ends = np.searchsorted(self._cell_keys, rows + col_max, side='right')
+        slices = [slice(start, end) for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+        if not slices:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        vectors = np.concatenate([self._vectors[s] for s in slices]) if len(slices) > 1 else self._vectors[slices[0]]
+        positions = np.concatenate([self._positions[s] for s in slices]) if len(slices) > 1 else self._positions[slices[0]]
+        origin = _reduced_unit_vectors(lat, lon)
+        # 四隅など明らかに半径の外の候補は、球面上の角距離だけで先に落とす。
+        # Lambert の補正で距離が縮むのは高々 a·σ·f なので、σ が radius / (a·(1 - f)) を超えれば必ず半径の外
+        diff = vectors - origin
+        h = np.einsum('ij,ij->i', diff, diff) / 4
+        sigma_max = radius_km / (WGS84_A_KM * (1 - WGS84_F)) * 1.001
+        near = h <= np.sin(sigma_max / 2) ** 2
+        distances = _lambert_from_vectors(origin, vectors[near], h[near])
+        within = distances <= radius_km
+        positions, distances = positions[near][within], distances[within]
+        # 結果はシート上の並び順で返す（位置は重複しないので安定ソートでなくてよい）
+        order = np.argsort(positions)
+        return positions[order], distances[order]
+
+
+def _reduced_unit_vectors(lats, lons):
+    """更成緯度の単位球面上の位置 (x, y, z)。配列なら (n, 3)、1地点なら (3,) で返す"""
+    b = np.arctan((1 - WGS84_F) * np.tan(np.radians(lats)))
+    lon = np.radians(lons)
+    cos_b = np.cos(b)
+    return np.stack([cos_b * np.cos(lon), cos_b * np.sin(lon), np.sin(b)], axis=-1)
+
+
+def _lambert_from_vectors(origin, vectors, h):
+    """
+    lambert_distance_km と同じ計算を単位ベクトルから行う。
+    h は haversine の h（弦の長さの2乗の 1/4）。sin²p·cos²q = ((z1 + z2) / 2)²、cos²p·sin²q = ((z2 - z1) / 2)² を使う。
+    """
+    h = np.clip(h, 0.0, 1.0)
+    sigma = 2 * np.arcsin(np.sqrt(h))
+    z_sum = ((vectors[:, 2] + origin[2]) / 2) ** 2
+    z_diff = ((vectors[:, 2] - origin[2]) / 2) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (sigma - np.sin(sigma)) * z_sum / (1 - h)
+        y = (sigma + 2 * np.sqrt(h * (1 - h))) * z_diff / h
+        distance = WGS84_A_KM * (sigma - WGS84_F / 2 * (x + y))
+    return np.where(sigma > 0, distance, 0.0)
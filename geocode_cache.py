@@ -0,0 +1,147 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import local_db
+from metrics import outcome_of
+
+
+def normalize_area_key(query):
+    """全角・半角や空白の揺れを吸収したキャッシュキーを作る"""
+    text = unicodedata.normalize('NFKC', query or '')
+    return ' '.join(text.split()).lower()
+
+
+class GeocodeCache:
+    """
+    ジオコーディング結果のキャッシュ。
+    メモリ上の LRU → SQLite の順に引き、どちらにもなければ Nominatim に問い合わせる。
+    見つからなかった地名も短めの TTL で覚えておき、Nominatim への問い合わせは
+    min_interval 秒に1回までに抑える（Nominatim の利用規約は 1 req/s）。
+    observer(upstream, operation, 秒, outcome) を渡すと、Nominatim への問い合わせごとに呼ぶ（順番待ちの時間は含まない）。
+    """
+
+    def __init__(self, geocoder, db_path=None, memory_size=1024, ttl_seconds=30 * 86400,
+                 negative_ttl_seconds=86400, min_interval=1.0, observer=None):
+        # geopy の読み込みを最初の問い合わせまで遅らせられるよう、geocoder を作る関数も受け付ける
+        self._geocoder = geocoder if hasattr(geocoder, 'geocode') else None
+        self._geocoder_factory = geocoder
+        self._db_path = db_path
+        self.memory_size = memory_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.min_interval = min_interval
+        self.observer = observer
+        self._memory = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "negative_hits": 0, "lookups": 0, "errors": 0}
+        self._ensure_table()
+
+    def _get_geocoder(self):
+        if self._geocoder is None:
+            self._geocoder = self._geocoder_factory()
+        return self._geocoder
+
+    def _conn(self):
+        return local_db.connect(self._db_path)
+
+    def _ensure_table(self):
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS geocode_cache ("
+            " key TEXT PRIMARY KEY, latitude REAL, longitude REAL, found INTEGER NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    # --- キャッシュ層 ---
+
+    def _memory_get(self, key):
+        with self._memory_lock:
+            entry = self._memory.get(key)
+            if entry is None: return None
+            if entry[1] < time.time():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key, coords, expires_at):
+        with self._memory_lock:
+            self._memory[key] = (coords, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        row = self._conn().execute(
+            "SELECT latitude, longitude, found, expires_at FROM geocode_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row['expires_at'] < time.time(): return None
+        coords = (row['latitude'], row['longitude']) if row['found'] else None
+        return coords, row['expires_at']
+
+    def _disk_put(self, key, coords, expires_at):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO geocode_cache (key, latitude, longitude, found, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (key, coords[0] if coords else None, coords[1] if coords else None, 1 if coords else 0, expires_at),
+        )
+
+    def _cached(self, key):
+        entry = self._memory_get(key)
+        if entry is not None:
+            self._counters["memory_hits"] += 1
+            return entry
+        entry = self._disk_get(key)
+        if entry is not None:
+            self._counters["disk_hits"] += 1
+            self._memory_put(key, *entry)
+        return entry
+
+    # --- 問い合わせ ---
+
+    def _wait_for_slot(self):
+        # _rate_lock を持っている間に呼ぶこと
+        wait = self._next_request_at - time.time()
+        if wait > 0: time.sleep(wait)
+        self._next_request_at = time.time() + self.min_interval
+
+    def geocode(self, query, timeout=10):
+        """(緯度, 経度) を返す。見つからなければ None。通信エラーは例外のまま投げる"""
+        key = normalize_area_key(query)
+        self._counters["lookups"] += 1
+        entry = self._cached(key)
+        if entry is not None:
+            if entry[0] is None: self._counters["negative_hits"] += 1
+            return entry[0]
+        with self._rate_lock:
+            # 待っている間に他のスレッドが同じ地名を引いていればそれを使う
+            entry = self._cached(key)
+            if entry is not None: return entry[0]
+            self._counters["misses"] += 1
+            self._wait_for_slot()
+            started = time.perf_counter()
+            try:
+                location = self._get_geocoder().geocode(query, timeout=timeout)
+            except Exception as e:
+                self._counters["errors"] += 1
+                self._observe(started, outcome_of(error=e))
+                raise
+            self._observe(started, 'ok' if location else 'not_found')
+            coords = (location.latitude, location.longitude) if location else None
+            ttl = self.ttl_seconds if coords else self.negative_ttl_seconds
+            expires_at = time.time() + ttl
+            self._disk_put(key, coords, expires_at)
+            self._memory_put(key, coords, expires_at)
+            return coords
+
+    def _observe(self, started, outcome):
+        if self.observer is not None:
+            self.observer('nominatim', 'geocode', time.perf_counter() - started, outcome)
+
+    def stats(self):
+        counters = dict(self._counters)
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        counters["hit_ratio"] = round(hits / counters["lookups"], 3) if counters["lookups"] else None
+        counters["memory_entries"] = len(self._memory)
+        return counters
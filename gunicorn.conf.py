@@ -0,0 +1,20 @@
+import os
+
+# gunicorn は起動したディレクトリの gunicorn.conf.py を自動で読み込む（Procfile の `gunicorn app:app` のままでよい）
+#   GUNICORN_PRELOAD=1 : 親プロセスで app を読み込み、ライブラリ・テンプレート・店舗スナップショット（ローカルに取り込み済みのときだけ）を準備してから fork する
+#   WARMUP_ON_START=1  : 各ワーカーで、最初のリクエストを受ける前にシートの認証・取り込みや LINE の接続を済ませる
+
+preload_app = os.environ.get('GUNICORN_PRELOAD') == '1'
+
+
+def when_ready(server):
+    # preload のときは fork 前に呼ばれる。接続を持たない準備だけをして、ワーカーにはメモリごと引き継ぐ
+    if preload_app:
+        import app
+        app.warm_up(network=False)
+
+
+def post_worker_init(worker):
+    if os.environ.get('WARMUP_ON_START') == '1':
+        import app
+        app.warm_up(network=True)
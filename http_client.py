@@ -0,0 +1,244 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import outcome_of
+
+# 再試行するステータス（429: レート制限、5xx: 一時的なエラー）
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """連続して失敗している外部サービスへの呼び出しを、しばらく行わずに失敗させる"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    failure_threshold 回続けて失敗したら open にし、reset_seconds の間は呼び出しを止める。
+    その後の1回（half-open）が成功すれば閉じ、失敗すればまた open に戻す。
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.opened_count = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None: return 'closed'
+            return 'half_open' if time.monotonic() - self._opened_at >= self.reset_seconds else 'open'
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None: return
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_running:
+                raise CircuitOpenError(f"{self.name}: circuit open")
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_running: self.opened_count += 1
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class Upstream:
+    """外部サービス1つ分の設定（タイムアウト・再試行回数）とサーキットブレーカー"""
+
+    def __init__(self, name, timeout=10.0, max_retries=3, backoff_base=0.5, backoff_max=8.0,
+                 failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_seconds)
+        self._counters = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0}
+
+    @classmethod
+    def from_env(cls, name, timeout, max_retries=3):
+        """UPSTREAM_<NAME>_TIMEOUT_SECONDS / UPSTREAM_<NAME>_MAX_RETRIES で上書きできる"""
+        prefix = f"UPSTREAM_{name.upper()}_"
+        return cls(
+            name,
+            timeout=float(os.environ.get(prefix + 'TIMEOUT_SECONDS', timeout)),
+            max_retries=int(os.environ.get(prefix + 'MAX_RETRIES', max_retries)),
+            failure_threshold=int(os.environ.get(prefix + 'FAILURE_THRESHOLD', 5)),
+            reset_seconds=float(os.environ.get(prefix + 'RESET_SECONDS', 30)),
+        )
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    def count(self, name, n=1):
+        self._counters[name] += n
+
+    def stats(self):
+        return dict(self._counters, circuit=self.breaker.state, circuit_opened=self.breaker.opened_count)
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def is_upstream_failure(exc):
+    """サーキットブレーカーで失敗として数える例外か（4xx は呼び出し側の問題なので数えない）"""
+    status = getattr(exc, 'status', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return status is None or status in RETRYABLE_STATUSES
+
+
+class HttpClient:
+    """
+    外部APIへの HTTP 呼び出しをまとめる共有クライアント。
+    - requests.Session を1つ共有し、ホストごとに keep-alive の接続プールを使い回す（pool_size はワーカーの同時実行数に合わせる）
+    - 429 / 5xx / 通信エラーはジッター付き指数バックオフで再試行する（Retry-After があればそれに従う）
+    - 外部サービスごとのサーキットブレーカーで、落ちているサービスへの呼び出しをすぐに失敗させる
+    - observer(upstream, operation, 秒, outcome) を渡すと、呼び出し1回（再試行を含む）ごとに呼ぶ
+    """
+
+    def __init__(self, upstreams, pool_size=10, observer=None):
+        self.upstreams = {u.name: u for u in upstreams}
+        self.pool_size = pool_size
+        self.observer = observer
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    def session(self):
+        # fork 後の子プロセスでは接続を共有しないよう作り直す
+        with self._session_lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=max(4, len(self.upstreams)), pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session, self._session_pid = session, os.getpid()
+            return self._session
+
+    def upstream(self, name):
+        return self.upstreams[name]
+
+    def _observe(self, upstream_name, operation, started, outcome):
+        if self.observer is not None:
+            self.observer(upstream_name, operation, time.perf_counter() - started, outcome)
+
+    def request(self, upstream_name, method, url, timeout=None, max_retries=None, operation=None, **kwargs):
+        """
+        レスポンスを返す。再試行しても 429 / 5xx のままなら最後のレスポンスを返す（raise_for_status は呼び出し側で）。
+        通信エラーが続いた場合はその例外、ブレーカーが open なら CircuitOpenError を投げる。
+        operation はメトリクス用の呼び出しの種類（省略時は HTTP メソッド）。
+        """
+        upstream = self.upstreams[upstream_name]
+        timeout = timeout if timeout is not None else upstream.timeout
+        max_retries = max_retries if max_retries is not None else upstream.max_retries
+        operation = operation or method.lower()
+        started = time.perf_counter()
+        try:
+            upstream.breaker.before_call()
+        except CircuitOpenError:
+            upstream.count("rejected")
+            self._observe(upstream_name, operation, started, 'rejected')
+            raise
+        upstream.count("calls")
+        try:
+            response = self._request_with_retry(upstream, method, url, timeout, max_retries, **kwargs)
+        except Exception as e:
+            self._observe(upstream_name, operation, started, outcome_of(error=e))
+            raise
+        self._observe(upstream_name, operation, started, outcome_of(status=response.status_code))
+        return response
+
+    def _request_with_retry(self, upstream, method, url, timeout, max_retries, **kwargs):
+        upstream_name = upstream.name
+        for attempt in range(max_retries + 1):
+            response = None
+            try:
+                response = self.session().request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= max_retries:
+                    upstream.count("failures")
+                    upstream.breaker.record_failure()
+                    raise
+                print(f"[{upstream_name}] 通信エラーのため再試行します ({attempt + 1}/{max_retries}): {e}")
+            except Exception:
+                # 再試行しない例外（ChunkedEncodingError やフック内の例外など）でも必ず失敗を記録する。
+                # 記録しないと half-open の試行中フラグが残り、以降の呼び出しがすべて拒否される
+                upstream.count("failures")
+                upstream.breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in RETRYABLE_STATUSES:
+                    upstream.breaker.record_success()
+                    return response
+                if attempt >= max_retries:
+                    upstream.count("failures")
+                    upstream.breaker.record_failure()
+                    return response
+                print(f"[{upstream_name}] {response.status_code} のため再試行します ({attempt + 1}/{max_retries})")
+            upstream.count("retries")
+            time.sleep(upstream.backoff(attempt, _retry_after_seconds(response)))
+
+    def get(self, upstream_name, url, **kwargs):
+        return self.request(upstream_name, 'GET', url, **kwargs)
+
+    def post(self, upstream_name, url, **kwargs):
+        return self.request(upstream_name, 'POST', url, **kwargs)
+
+    def guard(self, upstream_name, fn, operation='call'):
+        """
+        SDK 経由の呼び出し（LINE など）をサーキットブレーカーで包む。
+        再試行は SDK 側（urllib3 の Retry）に任せ、ここでは失敗の記録だけをする。
+        """
+        upstream = self.upstreams[upstream_name]
+        started = time.perf_counter()
+        try:
+            upstream.breaker.before_call()
+        except CircuitOpenError:
+            upstream.count("rejected")
+            self._observe(upstream_name, operation, started, 'rejected')
+            raise
+        upstream.count("calls")
+        try:
+            result = fn()
+        except Exception as e:
+            if is_upstream_failure(e):
+                upstream.count("failures")
+                upstream.breaker.record_failure()
+            else:
+                upstream.breaker.record_success()
+            self._observe(upstream_name, operation, started, outcome_of(error=e))
+            raise
+        upstream.breaker.record_success()
+        self._observe(upstream_name, operation, started, 'ok')
+        return result
+
+    def stats(self):
+        return {name: upstream.stats() for name, upstream in self.upstreams.items()}
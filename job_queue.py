@@ -0,0 +1,275 @@
+import json
+import os
+import random
+import threading
+import time
+import traceback
+
+import local_db
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def _pid_alive(pid):
+    if not pid or pid == os.getpid(): return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _process_token(pid):
+    """
+    プロセスの起動時刻（/proc/<pid>/stat の starttime）。コンテナの再起動などで同じ pid が
+    別のプロセスに使い回されても見分けられる。/proc が無い環境では None
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _owner_alive(pid, token):
+    if not _pid_alive(pid): return False
+    current = _process_token(pid)
+    return token is None or current is None or current == token
+
+
+class JobContext:
+    """
+    ジョブ実行中にハンドラへ渡すオブジェクト。
+    step() で実行したステップは完了状態が保存され、再実行時（リトライ・再起動後）には飛ばされる。
+    """
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job_id = job['id']
+        self.key = job['job_key']
+        self.payload = job['payload']
+        self.attempt = job['attempts']
+        self.state = job['state']
+        self.state.setdefault('done', [])
+        self.state.setdefault('failed', {})
+        self.state.setdefault('timings', {})
+        self._state_lock = threading.Lock()
+
+    def is_done(self, name):
+        return name in self.state['done']
+
+    def record(self, key, value):
+        """任意の情報（所要時間など）をジョブの状態に保存する"""
+        with self._state_lock:
+            self.state[key] = value
+            self.queue._save_state(self.job_id, self.state)
+
+    def step(self, name, fn, attempts=None):
+        """fn を最大 attempts 回まで指数バックオフ付きで実行する。失敗し続けた場合は記録して続行する"""
+        if name in self.state['done']:
+            print(f"[Job {self.job_id}] step {name} は完了済みのためスキップ")
+            return None
+        attempts = attempts or self.queue.step_attempts
+        started = time.time()
+        for i in range(attempts):
+            try:
+                result = fn()
+                self._finish(name, started, error=None)
+                return result
+            except Exception as e:
+                print(f"[Job {self.job_id}] step {name} 失敗 ({i + 1}/{attempts}): {e}")
+                if i + 1 >= attempts:
+                    traceback.print_exc()
+                    self._finish(name, started, error=str(e))
+                    return None
+                time.sleep(self.queue.backoff(i))
+
+    def _finish(self, name, started, error):
+        with self._state_lock:
+            self.state['timings'][name] = round(time.time() - started, 3)
+            if error is None:
+                self.state['done'].append(name)
+                self.state['failed'].pop(name, None)
+            else:
+                self.state['failed'][name] = error
+            self.queue._save_state(self.job_id, self.state)
+
+
+class JobQueue:
+    """
+    SQLite に永続化するジョブキューと、同時実行数を制限したワーカースレッド。
+    - submit() はジョブを保存してすぐ返る。未処理のジョブが max_pending 件以上なら QueueFullError
+    - プロセスが落ちて running のまま残ったジョブは、次の起動時に queued へ戻して再実行する
+    """
+
+    def __init__(self, name, handler, db_path=None, concurrency=4, max_pending=200,
+                 max_attempts=3, step_attempts=3, backoff_base=2.0, backoff_max=60.0):
+        self.name = name
+        self._handler = handler
+        self._db_path = db_path
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.step_attempts = step_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._wakeup = threading.Condition()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._ensure_table()
+
+    def _conn(self):
+        return local_db.connect(self._db_path)
+
+    def _ensure_table(self):
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, job_key TEXT NOT NULL,"
+            " payload TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " state TEXT NOT NULL DEFAULT '{}', last_error TEXT, owner_pid INTEGER, run_after REAL NOT NULL,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        if 'owner_token' not in [row['name'] for row in conn.execute("PRAGMA table_info(jobs)")]:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner_token TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (queue, status, run_after)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (queue, job_key)")
+
+    def backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    # --- 投入・参照 ---
+
+    def submit(self, key, payload):
+        self.start()
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE queue = ? AND status IN ('queued', 'running')", (self.name,)
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFullError(f"{self.name}: {pending} jobs pending")
+            cursor = conn.execute(
+                "INSERT INTO jobs (queue, job_key, payload, status, run_after, created_at, updated_at)"
+                " VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (self.name, key, json.dumps(payload, ensure_ascii=False), now, now, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._wakeup:
+            self._wakeup.notify()
+        return {"id": cursor.lastrowid, "status": "queued", "pending": pending + 1}
+
+    def _row_to_job(self, row):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['state'] = json.loads(job['state'])
+        return job
+
+    def get_latest(self, key):
+        row = self._conn().execute(
+            "SELECT * FROM jobs WHERE queue = ? AND job_key = ? ORDER BY id DESC LIMIT 1", (self.name, key)
+        ).fetchone()
+        if row is None: return None
+        job = self._row_to_job(row)
+        del job['payload']
+        return job
+
+    def stats(self):
+        rows = self._conn().execute(
+            "SELECT status, COUNT(*) AS n FROM jobs WHERE queue = ? GROUP BY status", (self.name,)
+        ).fetchall()
+        return dict({r['status']: r['n'] for r in rows}, concurrency=self.concurrency, max_pending=self.max_pending)
+
+    # --- ワーカー ---
+
+    def start(self):
+        """ワーカースレッドを起動する（fork 後のプロセスでも起動し直せるよう pid で判定）"""
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            self._started_pid = os.getpid()
+            # 落ちたプロセスが実行中のまま残したジョブを戻す
+            conn = self._conn()
+            rows = conn.execute(
+                "SELECT id, owner_pid, owner_token FROM jobs WHERE queue = ? AND status = 'running'", (self.name,)
+            ).fetchall()
+            for row in rows:
+                if not _owner_alive(row['owner_pid'], row['owner_token']):
+                    conn.execute(
+                        "UPDATE jobs SET status = 'queued', updated_at = ? WHERE id = ? AND status = 'running'",
+                        (time.time(), row['id']),
+                    )
+            for i in range(self.concurrency):
+                threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True).start()
+
+    def _claim(self):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE queue = ? AND status = 'queued' AND run_after <= ? ORDER BY run_after, id LIMIT 1",
+                (self.name, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, owner_pid = ?, owner_token = ?, updated_at = ? WHERE id = ?",
+                    (os.getpid(), _process_token(os.getpid()), now, row['id']),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None: return None
+        job = self._row_to_job(row)
+        job['attempts'] += 1
+        return job
+
+    def _save_state(self, job_id, state):
+        self._conn().execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(state, ensure_ascii=False), time.time(), job_id),
+        )
+
+    def _finish(self, job, status, error=None, run_after=None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, last_error = ?, run_after = COALESCE(?, run_after), updated_at = ? WHERE id = ?",
+            (status, error, run_after, time.time(), job['id']),
+        )
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"[{self.name}] ジョブ取得エラー: {e}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=1.0)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        context = JobContext(self, job)
+        try:
+            self._handler(context)
+            status = 'done_with_errors' if context.state['failed'] else 'done'
+            self._finish(job, status, error=json.dumps(context.state['failed'], ensure_ascii=False) if context.state['failed'] else None)
+        except Exception as e:
+            traceback.print_exc()
+            if job['attempts'] < self.max_attempts:
+                print(f"[{self.name}] ジョブ {job['id']} を再試行します ({job['attempts']}/{self.max_attempts}): {e}")
+                self._finish(job, 'queued', error=str(e), run_after=time.time() + self.backoff(job['attempts']))
+            else:
+                print(f"[{self.name}] ジョブ {job['id']} は失敗しました: {e}")
+                self._finish(job, 'failed', error=str(e))
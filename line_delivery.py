@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+
+# LINE Messaging API の1リクエストあたりの上限
+MAX_MESSAGES_PER_REQUEST = 5
+MAX_MULTICAST_RECIPIENTS = 500
+
+
+class TokenBucket:
+    """1秒あたり rate 回まで（瞬間的には capacity 回まで）に呼び出しを抑える"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited_seconds += wait
+                time.sleep(wait)
+
+
+class Delivery:
+    """1回の API 呼び出し分。kind は 'push'（1人）か 'multicast'（同じ内容を複数人に）"""
+
+    def __init__(self, kind, to, messages, keys, rows=None):
+        self.kind = kind
+        self.to = to
+        self.messages = messages
+        self.keys = keys
+        # [(key, user_id, メッセージ)]。まとめた配信を1件ずつ送り直すときに使う
+        self.rows = rows or []
+
+    def split(self):
+        """1件ずつの push に分ける"""
+        return [Delivery('push', [user_id], [message], [key], [(key, user_id, message)]) for key, user_id, message in self.rows]
+
+
+def plan_deliveries(items):
+    """
+    items: [(key, user_id, メッセージの dict)]（key は結果を返すときの識別子）
+    ユーザーごとにメッセージを5件ずつまとめ、内容がまったく同じまとまりは multicast にする。
+    """
+    per_user = {}
+    for key, user_id, message in items:
+        per_user.setdefault(user_id, []).append((key, message))
+
+    by_payload = {}
+    for user_id, entries in per_user.items():
+        for i in range(0, len(entries), MAX_MESSAGES_PER_REQUEST):
+            chunk = entries[i:i + MAX_MESSAGES_PER_REQUEST]
+            messages = [message for _, message in chunk]
+            payload = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+            by_payload.setdefault(payload, []).append((user_id, messages, [key for key, _ in chunk]))
+
+    deliveries = []
+    for bundles in by_payload.values():
+        for i in range(0, len(bundles), MAX_MULTICAST_RECIPIENTS):
+            group = bundles[i:i + MAX_MULTICAST_RECIPIENTS]
+            kind = 'multicast' if len(group) > 1 else 'push'
+            rows = [(key, user_id, message) for user_id, messages, keys in group for key, message in zip(keys, messages)]
+            deliveries.append(Delivery(kind, [user_id for user_id, _, _ in group], group[0][1], [key for key, _, _ in rows], rows))
+    return deliveries
+
+
+class LineDeliverer:
+    """
+    plan_deliveries() で作った配信を、push と multicast それぞれのトークンバケットで流量を抑えながら並行に送る。
+    send(delivery) が例外を投げたら、classify_error(例外) の戻り値をその配信に含まれる全件のステータスにする。
+    ただし複数件をまとめた配信が送り直しても届かないエラー（classify_error が None 以外）になったときは、
+    宛先1人・1件の不備でまとめて断られていることがあるので、1件ずつの push で送り直してから各行のステータスを決める。
+    """
+
+    def __init__(self, push_rate=1000, multicast_rate=100):
+        self.buckets = {'push': TokenBucket(push_rate), 'multicast': TokenBucket(multicast_rate)}
+        self._counters = {"push_calls": 0, "multicast_calls": 0, "messages": 0, "recipients": 0, "failed_calls": 0, "split_retries": 0}
+        self._lock = threading.Lock()
+
+    def deliver(self, deliveries, send, executor, classify_error):
+        """{key: 'sent' またはエラー時の classify_error の値} を返す"""
+        def attempt(delivery):
+            self.buckets[delivery.kind].acquire()
+            try:
+                send(delivery)
+                status = 'sent'
+            except Exception as e:
+                print(f"LINE {delivery.kind} 送信エラー ({len(delivery.to)}人, {len(delivery.messages)}通): {e}")
+                status = classify_error(e)
+            with self._lock:
+                self._counters[f"{delivery.kind}_calls"] += 1
+                if status != 'sent': self._counters["failed_calls"] += 1
+                else:
+                    self._counters["messages"] += len(delivery.messages) * len(delivery.to)
+                    self._counters["recipients"] += len(delivery.to)
+            return status
+
+        def run(delivery):
+            status = attempt(delivery)
+            if status in ('sent', None) or len(delivery.rows) <= 1:
+                return {key: status for key in delivery.keys}
+            with self._lock:
+                self._counters["split_retries"] += 1
+            return {piece.keys[0]: attempt(piece) for piece in delivery.split()}
+
+        results = {}
+        for statuses in executor.map(run, deliveries): results.update(statuses)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, throttled_seconds={k: round(b.waited_seconds, 3) for k, b in self.buckets.items()})
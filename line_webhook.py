@@ -0,0 +1,205 @@
+import os
+import queue
+import threading
+import time
+import traceback
+
+from linebot.v3.webhooks import MessageEvent
+
+import local_db
+from job_queue import QueueFullError
+
+
+class WebhookDispatcher:
+    """
+    LINE の Webhook を受けたら署名の検証と重複チェックだけをして、イベントの処理はワーカースレッドに任せる。
+    - add(イベントの型[, メッセージの型]) でハンドラを登録する（WebhookHandler.add と同じ使い方）
+    - 同じ webhookEventId のイベント（LINE の再送）は dedupe_seconds の間、2回目以降を処理しない（SQLite で記録するのでプロセス間でも有効）
+    - キューが満杯なら QueueFullError を投げる（呼び出し側は 5xx を返し、LINE の再送に任せる）
+    """
+
+    def __init__(self, parser, db_path=None, concurrency=4, max_pending=1000, dedupe_seconds=86400):
+        self.parser = parser
+        self._db_path = db_path
+        self.concurrency = concurrency
+        self.dedupe_seconds = dedupe_seconds
+        self._handlers = {}
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._counters = {"received": 0, "duplicates": 0, "handled": 0, "errors": 0, "rejected": 0}
+        self._counters_lock = threading.Lock()
+        self._ensure_table()
+
+    def _conn(self):
+        return local_db.connect(self._db_path)
+
+    def _ensure_table(self):
+        self._conn().execute("CREATE TABLE IF NOT EXISTS webhook_events (event_id TEXT PRIMARY KEY, received_at REAL NOT NULL)")
+
+    def _count(self, name, n=1):
+        with self._counters_lock:
+            self._counters[name] += n
+
+    def add(self, event, message=None):
+        def decorator(func):
+            self._handlers[(event, message)] = func
+            return func
+        return decorator
+
+    def _handler_for(self, event):
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get((type(event), type(event.message)))
+            if func: return func
+        return self._handlers.get((type(event), None))
+
+    # --- 受信 ---
+
+    def _is_new(self, event_id):
+        """初めて見るイベントなら記録して True を返す"""
+        if not event_id: return True
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO webhook_events (event_id, received_at) VALUES (?, ?)", (event_id, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def _forget(self, event_id):
+        if event_id: self._conn().execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+
+    def accept(self, body, signature):
+        """署名を検証してイベントをキューに積み、積んだ件数を返す（署名が不正なら InvalidSignatureError）"""
+        self.start()
+        payload = self.parser.parse(body, signature, as_payload=True)
+        accepted = 0
+        for event in payload.events:
+            self._count("received")
+            event_id = getattr(event, 'webhook_event_id', None)
+            if not self._is_new(event_id):
+                self._count("duplicates")
+                print(f"[webhook] 再送されたイベントのため処理しません: {event_id}")
+                continue
+            try:
+                self._queue.put_nowait((event, payload.destination))
+            except queue.Full:
+                # 再送されたときに処理できるよう、受信記録を消しておく
+                self._forget(event_id)
+                self._count("rejected")
+                raise QueueFullError(f"webhook: {self._queue.qsize()} events pending")
+            accepted += 1
+        return accepted
+
+    # --- ワーカー ---
+
+    def start(self):
+        """ワーカースレッドを起動する（fork 後のプロセスでも起動し直せるよう pid で判定）"""
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            self._started_pid = os.getpid()
+            self._conn().execute("DELETE FROM webhook_events WHERE received_at < ?", (time.time() - self.dedupe_seconds,))
+            for i in range(self.concurrency):
+                threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True).start()
+
+    def _worker(self):
+        while True:
+            event, destination = self._queue.get()
+            try:
+                func = self._handler_for(event)
+                if func is not None:
+                    func(event)
+                self._count("handled")
+            except Exception as e:
+                self._count("errors")
+                print(f"[webhook] {type(event).__name__} の処理でエラー: {e}"); traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        with self._counters_lock:
+            return dict(self._counters, pending=self._queue.qsize(), concurrency=self.concurrency)
+
+
+class BatchCollector:
+    """
+    add() した項目を interval_seconds ごと（または max_items 件たまったら）にまとめて flush(items) に渡す。
+    key を指定すると、同じ key の項目は1回のまとまりの中で最初の1件だけを残す。
+    flush が例外を投げたまとまりは捨てずに、次回に送り直す（max_items * 10 件を超えた古いものは捨てる）。
+    """
+
+    def __init__(self, name, flush, interval_seconds=5.0, max_items=100, key=None):
+        self.name = name
+        self._flush = flush
+        self.interval_seconds = interval_seconds
+        self.max_items = max_items
+        self._key = key
+        self._items = []
+        self._keys = set()
+        self._lock = threading.Condition()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._counters = {"added": 0, "coalesced": 0, "flushes": 0, "flushed_items": 0, "errors": 0, "dropped": 0}
+
+    def add(self, item):
+        self.start()
+        with self._lock:
+            self._counters["added"] += 1
+            key = self._key(item) if self._key else None
+            if key is not None:
+                if key in self._keys:
+                    self._counters["coalesced"] += 1
+                    return
+                self._keys.add(key)
+            self._items.append(item)
+            if len(self._items) >= self.max_items: self._lock.notify()
+
+    def start(self):
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self._worker, name=f"{self.name}-batcher", daemon=True).start()
+
+    def _take(self):
+        with self._lock:
+            items, self._items, self._keys = self._items, [], set()
+            return items
+
+    def flush_now(self):
+        items = self._take()
+        if not items: return 0
+        try:
+            self._flush(items)
+        except Exception:
+            with self._lock:
+                self._counters["errors"] += 1
+                pending, self._items, self._keys = items + self._items, [], set()
+                for item in pending:
+                    key = self._key(item) if self._key else None
+                    if key is not None:
+                        if key in self._keys: continue
+                        self._keys.add(key)
+                    self._items.append(item)
+                limit = self.max_items * 10
+                if len(self._items) > limit:
+                    self._counters["dropped"] += len(self._items) - limit
+                    self._items = self._items[-limit:]
+                    self._keys = {self._key(item) for item in self._items} if self._key else set()
+            raise
+        with self._lock:
+            self._counters["flushes"] += 1
+            self._counters["flushed_items"] += len(items)
+        return len(items)
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if len(self._items) < self.max_items:
+                    self._lock.wait(timeout=self.interval_seconds)
+            try:
+                self.flush_now()
+            except Exception as e:
+                # 送れなかった分は残っているので、少し待ってから送り直す
+                print(f"[{self.name}] まとめ送信に失敗: {e}")
+                time.sleep(self.interval_seconds)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, pending=len(self._items))
@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# ローカルに永続化するデータ（ジオコーディング結果など）を置く SQLite ファイル
+DB_PATH = os.environ.get('LUMINA_DB_PATH', 'lumina_offer.sqlite3')
+
+_local = threading.local()
+
+
+def connect(path=None):
+    """
+    スレッドごとに1本の SQLite 接続を返す。
+    WAL モードにして、読み込みが書き込みに待たされないようにしている。
+    """
+    path = path or DB_PATH
+    connections = getattr(_local, 'connections', None)
+    # fork 前（gunicorn の preload など）に親プロセスで開いた接続は子プロセスで使わない
+    if connections is None or getattr(_local, 'pid', None) != os.getpid():
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+    conn = connections.get(path)
+    if conn is None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        connections[path] = conn
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    """書き込みロックを取ってから複数の文をまとめて実行する"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _ensure_state_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS app_state (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+
+def get_state(key, default=None, path=None):
+    """小さな設定値・進捗（最高水位線など）を読む"""
+    conn = connect(path)
+    _ensure_state_table(conn)
+    row = conn.execute("SELECT value FROM app_state WHERE key = ?", (key,)).fetchone()
+    return row['value'] if row else default
+
+
+def set_state(key, value, path=None):
+    conn = connect(path)
+    _ensure_state_table(conn)
+    conn.execute(
+        "INSERT OR REPLACE INTO app_state (key, value, updated_at) VALUES (?, ?, strftime('%s', 'now'))",
+        (key, str(value)),
+    )
@@ -0,0 +1,147 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+JST = timezone(timedelta(hours=+9))
+
+# 秒。外部APIの応答（数十ms〜数十秒）とオファー処理のステップ（〜数分）の両方が収まるようにする
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def outcome_of(status=None, error=None):
+    """HTTP ステータスか例外から、メトリクスの outcome ラベル（ok / throttled / client_error / server_error / error）を決める"""
+    if status is None and error is not None:
+        status = getattr(error, 'status', None)
+        if status is None: status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is None: return 'error' if error is not None else 'ok'
+    if status == 429: return 'throttled'
+    if 400 <= status < 500: return 'client_error'
+    if status >= 500: return 'server_error'
+    return 'error' if error is not None else 'ok'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels_text(pairs):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} のラベルは {self.label_names} です: {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            for key, value in items:
+                lines += self._lines(list(zip(self.label_names, key)), value)
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def _lines(self, pairs, value):
+        return [f"{self.name}{_labels_text(pairs)} {_number(value)}"]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets): entry["buckets"][index] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _lines(self, pairs, entry):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, entry["buckets"]):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels_text(pairs + [('le', _number(float(bound)))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{_labels_text(pairs + [('le', '+Inf')])} {entry['count']}")
+        lines.append(f"{self.name}_sum{_labels_text(pairs)} {_number(round(entry['sum'], 6))}")
+        lines.append(f"{self.name}_count{_labels_text(pairs)} {entry['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    /metrics で Prometheus のテキスト形式に出力するカウンタとヒストグラム。
+    値はプロセスごとに持つ（gunicorn のワーカーを複数にした場合、1回の取得で見えるのはそのワーカーの分だけ）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, help_text, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError(f"メトリクス {name} は別の型・ラベルで登録済みです")
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._get_or_create(Counter, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics: lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+def log_event(event, **fields):
+    """1行の JSON でログを出す（ログ検索で userId などの項目ごとに絞り込めるように）"""
+    print(json.dumps(dict({"event": event, "time": datetime.now(JST).isoformat(timespec='milliseconds')}, **fields), ensure_ascii=False, default=str))
@@ -0,0 +1,167 @@
+import os
+import random
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+import local_db
+
+JST = timezone(timedelta(hours=+9))
+
+
+class NotificationQueue:
+    """
+    運営宛てメール通知の送信キュー（SQLite に永続化し、1本のバックグラウンドスレッドで送る）。
+    - enqueue() は保存するだけですぐ返る（リクエスト処理が Brevo の応答を待たない）
+    - urgent=True の通知はすぐに1通ずつ送る
+    - digest_seconds > 0 のとき、急ぎでない通知は最初の1件から digest_seconds 経つか digest_max 件たまったら、まとめて1通で送る
+    - sender(subject, body) は送信に失敗したら例外を投げること。失敗した通知はバックオフして max_attempts 回まで送り直す
+    - 送る前に status='sending' にして取得するので、複数プロセスで動かしても同じ通知を二重に送らない
+      （送信中のまま claim_seconds を過ぎた通知は、送信中に落ちたプロセスの分とみなして取り直す）
+    """
+
+    def __init__(self, sender, db_path=None, digest_seconds=0.0, digest_max=50, max_attempts=5,
+                 backoff_base=5.0, backoff_max=300.0, retention_days=7, claim_seconds=600.0):
+        self._sender = sender
+        self._db_path = db_path
+        self.digest_seconds = digest_seconds
+        self.digest_max = digest_max
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention_days = retention_days
+        self.claim_seconds = claim_seconds
+        self._wakeup = threading.Condition()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._counters = {"emails_sent": 0, "digests_sent": 0, "send_errors": 0}
+        self._ensure_table()
+
+    def _conn(self):
+        return local_db.connect(self._db_path)
+
+    def _ensure_table(self):
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS notifications ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT NOT NULL, body TEXT NOT NULL,"
+            " urgent INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT, next_attempt_at REAL NOT NULL, created_at REAL NOT NULL, sent_at REAL)"
+        )
+        if 'owner_pid' not in [row['name'] for row in conn.execute("PRAGMA table_info(notifications)")]:
+            conn.execute("ALTER TABLE notifications ADD COLUMN owner_pid INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS notifications_pending ON notifications (status, urgent, next_attempt_at)")
+
+    def backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    # --- 投入・参照 ---
+
+    def enqueue(self, subject, body, urgent=False):
+        self.start()
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO notifications (subject, body, urgent, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (subject, body, 1 if urgent else 0, now, now),
+        )
+        if urgent or self.digest_seconds <= 0:
+            with self._wakeup:
+                self._wakeup.notify()
+        return cursor.lastrowid
+
+    def stats(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) AS n FROM notifications GROUP BY status").fetchall()
+        return dict({r['status']: r['n'] for r in rows}, **self._counters, digest_seconds=self.digest_seconds)
+
+    # --- ワーカー ---
+
+    def start(self):
+        """送信スレッドを起動する（fork 後のプロセスでも起動し直せるよう pid で判定）"""
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            self._started_pid = os.getpid()
+            self._conn().execute(
+                "DELETE FROM notifications WHERE status = 'sent' AND sent_at < ?",
+                (time.time() - self.retention_days * 86400,),
+            )
+            threading.Thread(target=self._worker, name="notification-worker", daemon=True).start()
+
+    def _worker(self):
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[notifications] 送信処理でエラー: {e}"); traceback.print_exc()
+            with self._wakeup:
+                self._wakeup.wait(timeout=1.0)
+
+    def _claim(self, urgent, now, limit=None, ready=None):
+        """
+        送る時期の来た通知を status='sending' にしてこのプロセスのものにし、返す。
+        ready(rows) が False を返したときは何も取らない（まとめ送信の条件を、取得と同じトランザクションで判定する）。
+        """
+        sql = "SELECT * FROM notifications WHERE status IN ('pending', 'sending') AND urgent = ? AND next_attempt_at <= ? ORDER BY id"
+        if limit: sql += f" LIMIT {int(limit)}"
+        conn = self._conn()
+        with local_db.transaction(conn):
+            rows = [dict(r) for r in conn.execute(sql, (urgent, now)).fetchall()]
+            if not rows or (ready and not ready(rows)): return []
+            ids = [row['id'] for row in rows]
+            conn.execute(
+                f"UPDATE notifications SET status = 'sending', owner_pid = ?, next_attempt_at = ? WHERE id IN ({','.join('?' * len(ids))})",
+                (os.getpid(), now + self.claim_seconds, *ids),
+            )
+        return rows
+
+    def flush(self, force=False):
+        """送る時期の来た通知を送る（force=True ならまとめ待ちの通知もすぐに送る）"""
+        now = time.time()
+        # 1通ずつ送るものは1件ずつ取る（まとめて取ると、送り終わる前に取り直し期限が来るおそれがある）
+        for urgent in ([1] if self.digest_seconds > 0 else [1, 0]):
+            while True:
+                rows = self._claim(urgent, now, limit=1)
+                if not rows: break
+                self._send(rows, rows[0]['subject'], rows[0]['body'])
+        if self.digest_seconds <= 0: return
+        ready = None if force else lambda rows: len(rows) >= self.digest_max or now - rows[0]['created_at'] >= self.digest_seconds
+        rows = self._claim(0, now, limit=self.digest_max, ready=ready)
+        if not rows: return
+        if len(rows) == 1:
+            self._send(rows, rows[0]['subject'], rows[0]['body'])
+        else:
+            self._send(rows, *self._digest(rows))
+
+    @staticmethod
+    def _digest(rows):
+        subject = f"【LUMINAオファー】通知まとめ（{len(rows)}件）"
+        sections = []
+        for row in rows:
+            created = datetime.fromtimestamp(row['created_at'], JST).strftime('%Y/%m/%d %H:%M')
+            sections.append(f"■ {row['subject']}（{created}）\n{row['body'].strip()}")
+        return subject, f"{len(rows)}件の通知があります。\n\n" + "\n\n----------\n\n".join(sections)
+
+    def _send(self, rows, subject, body):
+        ids = [row['id'] for row in rows]
+        placeholders = ','.join('?' * len(ids))
+        try:
+            self._sender(subject, body)
+        except Exception as e:
+            self._counters["send_errors"] += 1
+            attempts = max(row['attempts'] for row in rows) + 1
+            status = 'failed' if attempts >= self.max_attempts else 'pending'
+            print(f"[notifications] 送信失敗 ({attempts}/{self.max_attempts}): {subject}: {e}")
+            self._conn().execute(
+                f"UPDATE notifications SET status = ?, owner_pid = NULL, attempts = ?, last_error = ?, next_attempt_at = ?"
+                f" WHERE id IN ({placeholders}) AND owner_pid = ?",
+                (status, attempts, str(e), time.time() + self.backoff(attempts - 1), *ids, os.getpid()),
+            )
+            return False
+        self._counters["emails_sent"] += 1
+        if len(rows) > 1: self._counters["digests_sent"] += 1
+        self._conn().execute(
+            f"UPDATE notifications SET status = 'sent', owner_pid = NULL, sent_at = ? WHERE id IN ({placeholders}) AND owner_pid = ?",
+            (time.time(), *ids, os.getpid()),
+        )
+        return True
@@ -0,0 +1,86 @@
+import threading
+from datetime import datetime, timedelta
+
+from gspread.exceptions import WorksheetNotFound
+from gspread.utils import rowcol_to_a1
+
+import local_db
+
+QUEUE_COLUMNS = ['user_id', 'salon_id', 'send_at', 'status']
+HWM_STATE_KEY = 'offer_queue.first_pending_row'
+
+
+def _parse_send_at(value):
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return parsed if parsed.tzinfo else parsed.astimezone()
+
+
+class QueueRow:
+    def __init__(self, row_num, values):
+        values = list(values) + [''] * (len(QUEUE_COLUMNS) - len(values))
+        self.row_num = row_num
+        self.user_id = str(values[0])
+        self.salon_id = str(values[1])
+        self.send_at = str(values[2])
+        self.status = str(values[3])
+
+
+class OfferQueueReader:
+    """
+    Offer Queue の最高水位線（最初の pending 行）を持ち、それより前の行をアーカイブする。
+    送信済み・エラーの行は pending に戻らないので、最高水位線より前は読む必要がない（SheetSync はそこから下だけを取り込む）。
+    最高水位線は SQLite に保存する。
+    """
+
+    def __init__(self, get_worksheet, db_path=None):
+        self._get_worksheet = get_worksheet
+        self._db_path = db_path
+        # 最高水位線の読み書きとアーカイブ（行削除）が重ならないようにする
+        self.lock = threading.Lock()
+
+    @property
+    def first_pending_row(self):
+        return int(local_db.get_state(HWM_STATE_KEY, 2, path=self._db_path))
+
+    @first_pending_row.setter
+    def first_pending_row(self, row_num):
+        local_db.set_state(HWM_STATE_KEY, max(2, int(row_num)), path=self._db_path)
+
+    def archive_finished(self, archive_worksheet, older_than_days=30):
+        """
+        最高水位線より前（すべて送信済み・エラー）の行のうち、send_at が古いものを先頭から
+        アーカイブ用シートへ移し、Offer Queue から削除する。戻り値は移した行数。
+        """
+        with self.lock:
+            worksheet = self._get_worksheet()
+            hwm = self.first_pending_row
+            if hwm <= 2: return 0
+            last_col = rowcol_to_a1(1, len(QUEUE_COLUMNS)).rstrip('1')
+            values = worksheet.get(f"A2:{last_col}{hwm - 1}")
+            cutoff = datetime.now().astimezone() - timedelta(days=older_than_days)
+
+            # 行番号をずらさないよう、先頭から連続した古い行だけを対象にする
+            count = 0
+            for v in values:
+                row = QueueRow(0, v)
+                if row.status not in ('sent', 'error') or _parse_send_at(row.send_at) is None or _parse_send_at(row.send_at) > cutoff: break
+                count += 1
+            if count == 0: return 0
+
+            archive_worksheet.append_rows([list(v) for v in values[:count]], value_input_option='USER_ENTERED')
+            worksheet.delete_rows(2, 1 + count)
+            self.first_pending_row = hwm - count
+            return count
+
+
+def get_or_create_archive_worksheet(spreadsheet, title='Offer Queue Archive'):
+    try:
+        return spreadsheet.worksheet(title)
+    except WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(title=title, rows=1000, cols=len(QUEUE_COLUMNS))
+        worksheet.append_row(QUEUE_COLUMNS)
+        return worksheet
+
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import local_db
+
+# オファー文の生成に使う候補者の項目と、ユーザー管理シートでの列名。
+# 文章はこれと店舗IDだけで決まるので、同じ組み合わせの人には使い回せる
+OFFER_PROFILE_FIELDS = {'role': '役職', 'mbti': 'MBTI', 'perk': '興味のある待遇'}
+
+
+def offer_profile(user_wishes):
+    """登録時の wishes（英語キー）とユーザー管理の行（日本語の列名）のどちらからでも同じ項目を取り出す"""
+    return {field: user_wishes.get(field) or user_wishes.get(column) or '' for field, column in OFFER_PROFILE_FIELDS.items()}
+
+
+def offer_text_key(user_wishes, salon_id):
+    payload = json.dumps({'profile': offer_profile(user_wishes), 'salon_id': str(salon_id)}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class OfferTextCache:
+    """
+    オファー文のキャッシュ（SQLite、キーは候補者の項目と店舗IDのハッシュ）。
+    generator(profile, salon_info) は生成に失敗したら例外を投げること。失敗時は fallback_text（fallback=False なら None）を返し、キャッシュしない。
+    同じキーの生成が同時に走らないよう、キーごとにロックを取る。
+    """
+
+    def __init__(self, generator, fallback_text, db_path=None, ttl_seconds=7 * 86400):
+        self._generator = generator
+        self.fallback_text = fallback_text
+        self._db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self._locks = {}  # key -> [Lock, そのロックを持っている・待っているスレッド数]
+        self._locks_lock = threading.Lock()
+        self._counters = {"hits": 0, "generated": 0, "errors": 0}
+        self._ensure_table()
+
+    def _conn(self):
+        return local_db.connect(self._db_path)
+
+    def _ensure_table(self):
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS offer_text_cache (key TEXT PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    @contextmanager
+    def _key_lock(self, key):
+        """キーごとのロック。待っているスレッドがいる間は消さず、誰も使わなくなったら消す"""
+        with self._locks_lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0: del self._locks[key]
+
+    def _get(self, key):
+        row = self._conn().execute("SELECT text, expires_at FROM offer_text_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row['expires_at'] < time.time(): return None
+        return row['text']
+
+    def get(self, user_wishes, salon_info, fallback=True):
+        """
+        オファー文を返す（キャッシュになければ生成する）。
+        事前生成では fallback=False にして、失敗時は None を返す（送信時に生成し直せるよう、定型文を保存させない）。
+        """
+        key = offer_text_key(user_wishes, salon_info.get('店舗ID'))
+        text = self._get(key)
+        if text is not None:
+            self._counters["hits"] += 1
+            return text
+        with self._key_lock(key):
+            text = self._get(key)
+            if text is not None:
+                self._counters["hits"] += 1
+                return text
+            try:
+                text = self._generator(offer_profile(user_wishes), salon_info)
+            except Exception as e:
+                self._counters["errors"] += 1
+                print(f"オファー文の生成中にエラー: {e}")
+                return self.fallback_text if fallback else None
+            now = time.time()
+            self._conn().execute(
+                "INSERT OR REPLACE INTO offer_text_cache (key, text, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, text, now, now + self.ttl_seconds),
+            )
+            self._counters["generated"] += 1
+            return text
+
+    def stats(self):
+        return dict(self._counters)
@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class Step:
+    """
+    パイプラインの1ステップ。
+    fn は依存ステップの結果 {ステップ名: 戻り値} を受け取る。
+    """
+
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+
+
+class StepGraphError(Exception):
+    pass
+
+
+def run_step_graph(steps, executor, run_step=None):
+    """
+    依存関係が揃ったステップから順に executor で並行実行する。
+    run_step(name, call) を渡すと各ステップの実行をそれで包む（リトライ・チェックポイント用）。
+    例外が出たステップの後続は実行しない（他の枝はそのまま続ける）。
+    戻り値は (結果, タイミング, 例外) の dict 3つ。タイミングは開始からの経過秒 start / 所要秒 duration。
+    """
+    by_name = {s.name: s for s in steps}
+    for s in steps:
+        missing = [d for d in s.deps if d not in by_name]
+        if missing: raise StepGraphError(f"{s.name} の依存ステップが存在しません: {missing}")
+
+    started = time.perf_counter()
+    results, timings, errors = {}, {}, {}
+    pending = dict(by_name)
+    running = {}
+
+    def execute(step, inputs):
+        step_started = time.perf_counter()
+        try:
+            call = lambda: step.fn(inputs)
+            return run_step(step.name, call) if run_step else call()
+        finally:
+            timings[step.name] = {
+                "start": round(step_started - started, 3),
+                "duration": round(time.perf_counter() - step_started, 3),
+            }
+
+    while pending or running:
+        # 依存先が失敗したステップは実行しない
+        for name in [n for n, s in pending.items() if any(d in errors for d in s.deps)]:
+            del pending[name]
+            errors[name] = StepGraphError(f"{name}: 依存ステップが失敗したため実行しませんでした")
+        ready = [s for s in pending.values() if all(d in results for d in s.deps)]
+        for s in ready:
+            del pending[s.name]
+            inputs = {d: results[d] for d in s.deps}
+            running[executor.submit(execute, s, inputs)] = s
+        if not running:
+            if pending: raise StepGraphError(f"依存関係が循環しています: {list(pending)}")
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            step = running.pop(future)
+            try:
+                results[step.name] = future.result()
+            except Exception as e:
+                errors[step.name] = e
+
+    timings["total"] = {"start": 0.0, "duration": round(time.perf_counter() - started, 3)}
+    return results, timings, errors
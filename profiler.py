@@ -0,0 +1,100 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+
+def _stack(frame, max_depth):
+    """frame から呼び出し元へたどり、(ファイル名, 関数名, 行番号) のタプルを根元→末端の順で返す"""
+    stack = []
+    while frame is not None and len(stack) < max_depth:
+        code = frame.f_code
+        stack.append((os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+class SlowRequestProfiler:
+    """
+    遅いリクエストだけを記録するサンプリングプロファイラ。
+    begin() から end() までの間、interval_seconds ごとにそのスレッドのスタックを sys._current_frames() で取り、
+    end() の時点で threshold_seconds 以上かかっていれば、多く現れたスタック（flamegraph の collapsed 形式）と
+    末端の行（自身で時間を使っていた行）を、直近 keep 件まで残す。リクエストを止めて計測することはない。
+    """
+
+    def __init__(self, threshold_seconds, interval_seconds=0.01, keep=20, max_depth=60, top=15):
+        self.threshold_seconds = threshold_seconds
+        self.interval_seconds = interval_seconds
+        self.max_depth = max_depth
+        self.top = top
+        self._active = {}  # thread id -> {"started", "samples"}
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=keep)
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._counters = {"tracked": 0, "captured": 0, "samples": 0}
+
+    def start(self):
+        """サンプリング用のスレッドを起動する（fork 後のプロセスでも起動し直せるよう pid で判定）"""
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self._worker, name="slow-request-profiler", daemon=True).start()
+
+    def begin(self):
+        self.start()
+        with self._lock:
+            self._active[threading.get_ident()] = {"started": time.perf_counter(), "samples": Counter()}
+            self._counters["tracked"] += 1
+
+    def end(self, label):
+        """begin() と同じスレッドで呼ぶ。しきい値を超えていれば記録したプロファイルを返す"""
+        with self._lock:
+            entry = self._active.pop(threading.get_ident(), None)
+        if entry is None: return None
+        duration = time.perf_counter() - entry["started"]
+        if duration < self.threshold_seconds: return None
+        profile = self._summarize(label, duration, entry["samples"])
+        with self._lock:
+            self._recent.append(profile)
+            self._counters["captured"] += 1
+        return profile
+
+    def _worker(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval_seconds)
+            with self._lock:
+                if not self._active: continue
+                frames = sys._current_frames()
+                for thread_id, entry in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None or thread_id == me: continue
+                    entry["samples"][_stack(frame, self.max_depth)] += 1
+                    self._counters["samples"] += 1
+
+    def _summarize(self, label, duration, samples):
+        total = sum(samples.values())
+        leaves = Counter()
+        for stack, count in samples.items():
+            if stack: leaves["{}:{}:{}".format(*stack[-1])] += count
+        return {
+            "label": label,
+            "duration_s": round(duration, 3),
+            "samples": total,
+            "interval_ms": round(self.interval_seconds * 1000, 1),
+            "top_stacks": [
+                {"stack": ";".join(f"{file}:{func}" for file, func, _ in stack), "samples": count}
+                for stack, count in samples.most_common(self.top)
+            ],
+            "top_lines": [{"line": line, "samples": count} for line, count in leaves.most_common(self.top)],
+        }
+
+    def recent(self):
+        with self._lock:
+            return list(self._recent)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, threshold_seconds=self.threshold_seconds, active=len(self._active))
@@ -0,0 +1,98 @@
+import json
+import math
+import threading
+from collections import deque
+
+# ランキングに使う店舗の列（画像URL・住所・店舗名などは渡さない）
+SALON_PROMPT_COLUMNS = ['店舗ID', '距離', '役職', '募集', 'サロンの魅力キャッチコピー', 'サロン紹介文', '給与詳細', '福利厚生詳細', '休日詳細', '特徴']
+# ランキングに使う候補者の項目（氏名・電話番号・生年月日は渡さない）
+USER_PROMPT_FIELDS = ['role', 'license', 'gender', 'age', 'mbti', 'perk', 'area_prefecture', 'area_detail', 'satisfaction', 'current_status', 'timing']
+
+
+def estimate_tokens(text):
+    """おおよそのトークン数（英数字は4文字で1、それ以外は1文字で1として多めに見積もる）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def _project_salon(salon, max_field_chars):
+    projected = {}
+    for column in SALON_PROMPT_COLUMNS:
+        value = salon.get(column)
+        if value is None or value == '' or (isinstance(value, float) and math.isnan(value)): continue
+        if column == '距離':
+            value = round(float(value), 1)
+        elif isinstance(value, str) and len(value) > max_field_chars:
+            value = value[:max_field_chars] + '…'
+        projected[column] = value
+    return projected
+
+
+def build_ranking_prompt(user_wishes, candidates, limit, max_candidates=15, token_budget=4000, max_field_chars=120):
+    """
+    ランキング用のプロンプトを作る。candidates は事前スコアの高い順に並んでいること。
+    必要な列だけに絞り、上位 max_candidates 件までを token_budget に収まるだけ入れる。
+    戻り値は (プロンプト, プロンプトに入れた候補のリスト)。
+    """
+    profile = {k: user_wishes.get(k) for k in USER_PROMPT_FIELDS if user_wishes.get(k) not in (None, '')}
+    header = f"""
+        # あなたのタスク
+        以下の候補者プロフィールと求人リストを基に、最もマッチ度が高い順に最大{limit}件のサロンの「店舗ID」をリストで回答してください。
+        # 候補者プロフィール:
+        {json.dumps(profile, ensure_ascii=False)}
+        # 候補となる求人リスト:
+        """
+    footer = """
+        # 回答フォーマット
+        JSON形式のリストのみを回答してください。例: [101, 108, 125]
+        """
+    used_tokens = estimate_tokens(header) + estimate_tokens(footer)
+    lines, included = [], []
+    for salon in candidates[:max_candidates]:
+        line = json.dumps(_project_salon(salon, max_field_chars), ensure_ascii=False)
+        cost = estimate_tokens(line) + 1
+        # 予算を超える候補は入れない（最低1件は入れる）
+        if included and used_tokens + cost > token_budget: break
+        lines.append(line); included.append(salon)
+        used_tokens += cost
+    return header + '[' + ',\n'.join(lines) + ']' + footer, included
+
+
+class LlmCallStats:
+    """AI呼び出しごとのプロンプトの大きさと応答時間を記録する"""
+
+    def __init__(self, history=100):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=history)
+        self._totals = {"calls": 0, "errors": 0, "prompt_chars": 0, "prompt_tokens": 0, "latency_ms": 0.0}
+
+    def record(self, name, prompt, latency_ms, candidates=None, prompt_tokens=None, error=None):
+        entry = {
+            "name": name,
+            "prompt_chars": len(prompt),
+            # 応答の usageMetadata があればその値、なければ見積もり
+            "prompt_tokens": prompt_tokens if prompt_tokens is not None else estimate_tokens(prompt),
+            "latency_ms": round(latency_ms, 1),
+            "candidates": candidates,
+            "error": error,
+        }
+        with self._lock:
+            self._recent.append(entry)
+            self._totals["calls"] += 1
+            self._totals["errors"] += 1 if error else 0
+            self._totals["prompt_chars"] += entry["prompt_chars"]
+            self._totals["prompt_tokens"] += entry["prompt_tokens"]
+            self._totals["latency_ms"] += latency_ms
+        print(f"[LLM] {name}: prompt={entry['prompt_chars']}文字/{entry['prompt_tokens']}tokens candidates={candidates} latency={entry['latency_ms']}ms" + (f" error={error}" if error else ""))
+        return entry
+
+    def stats(self):
+        with self._lock:
+            calls = self._totals["calls"] or 1
+            return dict(
+                self._totals,
+                latency_ms=round(self._totals["latency_ms"], 1),
+                avg_prompt_tokens=round(self._totals["prompt_tokens"] / calls, 1),
+                avg_latency_ms=round(self._totals["latency_ms"] / calls, 1),
+                recent=list(self._recent)[-10:],
+            )
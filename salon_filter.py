@@ -0,0 +1,97 @@
+import numpy as np
+
+# 「指定なし」として扱うターゲット性別・年齢の値
+OPEN_TARGET_VALUES = ('', '指定なし')
+
+
+def _is_open(value):
+    return value is None or (isinstance(value, float) and np.isnan(value)) or value in OPEN_TARGET_VALUES
+
+
+def _categorical(values):
+    """値 → 整数コードの配列と、コード → 値の対応（「指定なし」は -1）"""
+    vocabulary = {}
+    codes = np.full(len(values), -1, dtype=np.int32)
+    for i, value in enumerate(values):
+        if _is_open(value): continue
+        codes[i] = vocabulary.setdefault(value, len(vocabulary))
+    return codes, vocabulary
+
+
+class SalonFilterIndex:
+    """
+    店舗マスタのスナップショットから作る、募集条件の絞り込み用の型付き列。
+    役職はビットマスク、免許はフラグ、ターゲット性別・年齢はカテゴリコードにしておき、
+    候補者の条件は NumPy のマスク演算だけで評価する（リクエストごとに文字列を分解しない）。
+    """
+
+    def __init__(self, records):
+        n = len(records)
+        self.size = n
+        self.positions_by_id = {}
+        for i, r in enumerate(records):
+            self.positions_by_id.setdefault(str(r.get('店舗ID')), []).append(i)
+        self.recruiting = np.array([r.get('募集状況') == '募集中' for r in records], dtype=bool)
+
+        # 役職: 「スタイリスト, アシスタント」のようなカンマ区切りを、役職ごとのビットにする
+        self.role_bits = {}
+        self.roles = np.zeros(n, dtype=np.uint64)
+        for i, r in enumerate(records):
+            for role in str(r.get('役職', '')).split(','):
+                bit = self.role_bits.setdefault(role.strip(), np.uint64(1) << np.uint64(len(self.role_bits)))
+                self.roles[i] |= bit
+
+        licenses = [r.get('美容師免許') for r in records]
+        self.license_required = np.array([v == '取得' for v in licenses], dtype=bool)
+        self.license_any = self.license_required | np.array([v == '未取得' for v in licenses], dtype=bool)
+
+        self.gender_codes, self.gender_vocabulary = _categorical([r.get('ターゲット性別') for r in records])
+        self.age_codes, self.age_vocabulary = _categorical([r.get('ターゲット年齢') for r in records])
+
+    @classmethod
+    def from_records(cls, records):
+        return cls(records)
+
+    def _role_mask(self, role):
+        bit = self.role_bits.get(role)
+        if bit is None: return np.zeros(self.size, dtype=bool)
+        return (self.roles & bit) != 0
+
+    def _age_mask(self, age_group):
+        # ターゲット年齢は「20代,30代」のような文字列。部分一致する値のコードをまとめて引く
+        matched = [code for value, code in self.age_vocabulary.items() if isinstance(value, str) and age_group in value]
+        return (self.age_codes == -1) | np.isin(self.age_codes, matched)
+
+    def constraints(self, user_wishes, exclude_salon_ids=()):
+        """候補者の条件を、(マスク, 絞り込んで0件になったときの理由) のリストで返す（元の判定順）"""
+        user_license = user_wishes.get("license")
+        constraints = [
+            (self.recruiting, "募集中のサロンがありません。"),
+            (self._role_mask(user_wishes.get("role")), "役職に合うサロンがありません。"),
+            (self.license_required if user_license == "取得済み" else self.license_any, "免許条件に合うサロンがありません。"),
+        ]
+        user_gender = user_wishes.get("gender")
+        if user_gender:
+            code = self.gender_vocabulary.get(user_gender, -2)
+            constraints.append(((self.gender_codes == -1) | (self.gender_codes == code), "性別の条件に合うサロンがありません。"))
+        user_age_group = user_wishes.get("age")
+        if user_age_group:
+            constraints.append((self._age_mask(user_age_group), "年齢の条件に合うサロンがありません。"))
+        if exclude_salon_ids:
+            not_offered = np.ones(self.size, dtype=bool)
+            for salon_id in exclude_salon_ids:
+                not_offered[self.positions_by_id.get(str(salon_id), [])] = False
+            constraints.append((not_offered, "条件に合うサロンはありますが、すべて過去にオファー済みです。"))
+        return constraints
+
+    def select(self, user_wishes, positions=None, exclude_salon_ids=()):
+        """
+        positions（空間インデックスで絞った店舗の位置）のうち、条件をすべて満たすものの
+        位置の配列と、0件になった場合はその理由を返す。
+        """
+        positions = np.arange(self.size) if positions is None else np.asarray(positions, dtype=np.intp)
+        selected = np.ones(len(positions), dtype=bool)
+        for mask, reason in self.constraints(user_wishes, exclude_salon_ids):
+            selected &= mask[positions]
+            if not selected.any(): return positions[:0], reason
+        return positions[selected], None
@@ -0,0 +1,117 @@
+import math
+
+# スコアの重み（合計1）。環境変数 RANKING_WEIGHTS で上書きできる（例: "distance=0.5,perk=0.3,mbti=0.1,recruitment=0.1"）
+DEFAULT_WEIGHTS = {'distance': 0.4, 'perk': 0.3, 'mbti': 0.2, 'recruitment': 0.1}
+
+# 待遇・雰囲気の判定に使う店舗マスタの文章列
+SALON_TEXT_COLUMNS = ['サロンの魅力キャッチコピー', 'サロン紹介文', '給与詳細', '福利厚生詳細', '休日詳細', '特徴', '募集']
+
+# 「最も興味のある待遇」ごとに、店舗の文章に含まれていれば満たしているとみなす語
+PERK_KEYWORDS = {
+    '高収入': ['高収入', '高歩合', '歩合', '高還元', '昇給', '賞与', 'ボーナス', '年収', '月給'],
+    '社会保険完備': ['社会保険', '社保', '厚生年金', '雇用保険'],
+    '完全週休2日制': ['完全週休2日', '週休2日', '週休二日'],
+    '土日休み可能': ['土日休', '土日祝休', '土日OK', '土日可'],
+    'シフト/休みが自由': ['シフト自由', '自由シフト', '休み自由', '希望休', '時短', '柔軟'],
+    '教育体制充実': ['教育', '研修', 'カリキュラム', '講習', 'レッスン', 'デビュー'],
+    '新規客が多い': ['新規', '集客', '指名', 'ホットペッパー', '予約'],
+    '大手サロン': ['大手', '店舗展開', 'グループ', '全国', '上場'],
+}
+
+# MBTI の各指標と相性のよいサロンの雰囲気を表す語
+MBTI_CULTURE_KEYWORDS = {
+    'E': ['アットホーム', 'チーム', 'イベント', '明る', 'にぎやか', '仲が良'],
+    'I': ['落ち着', '少人数', 'マンツーマン', 'プライベート', '個室', '静か'],
+    'S': ['マニュアル', '安定', '基礎', '丁寧', '着実'],
+    'N': ['デザイン', 'クリエイティブ', 'トレンド', '撮影', '新しい', 'SNS'],
+    'T': ['実力', '成果', '評価制度', 'キャリア', '技術'],
+    'F': ['アットホーム', '寄り添', '思いやり', '笑顔', '温か', '人柄'],
+    'J': ['カリキュラム', '計画', '制度', '明確', '目標'],
+    'P': ['自由', '柔軟', 'のびのび', '裁量', '自分らしく'],
+}
+
+# 待遇の希望から見た、募集形態の相性（どれにも当てはまらなければ 0.5）
+RECRUITMENT_AFFINITY = {
+    '高収入': {'業務委託': 1.0, '正社員': 0.6},
+    'シフト/休みが自由': {'業務委託': 1.0, 'パート': 0.9, 'アルバイト': 0.9, '正社員': 0.4},
+    '社会保険完備': {'正社員': 1.0, '業務委託': 0.1},
+    '完全週休2日制': {'正社員': 0.9},
+    '教育体制充実': {'正社員': 1.0, '業務委託': 0.2},
+    '大手サロン': {'正社員': 0.8},
+}
+
+
+def parse_weights(spec):
+    """"distance=0.5,perk=0.3" のような指定を重みの dict にする（指定のないものは既定値）"""
+    weights = dict(DEFAULT_WEIGHTS)
+    for part in (spec or '').split(','):
+        if '=' not in part: continue
+        name, value = part.split('=', 1)
+        if name.strip() in weights: weights[name.strip()] = float(value)
+    return weights
+
+
+def _salon_text(salon):
+    return ' '.join(str(salon.get(c) or '') for c in SALON_TEXT_COLUMNS)
+
+
+class LocalRanker:
+    """
+    距離・待遇・MBTIと雰囲気・募集形態の重み付きスコアで候補サロンを並べる、決定的なランキング。
+    同じ入力には常に同じ順番を返す（同点は距離、店舗IDの順）。
+    """
+
+    def __init__(self, weights=None, radius_km=25.0):
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.radius_km = radius_km
+
+    def distance_score(self, distance_km):
+        try:
+            distance_km = float(distance_km)
+        except (TypeError, ValueError):
+            return 0.0
+        if math.isnan(distance_km): return 0.0
+        return max(0.0, 1.0 - distance_km / self.radius_km)
+
+    @staticmethod
+    def perk_score(perk, text):
+        keywords = PERK_KEYWORDS.get(perk)
+        if not keywords: return 0.5
+        hits = sum(1 for k in keywords if k in text)
+        return min(1.0, hits / 2)
+
+    @staticmethod
+    def mbti_score(mbti, text):
+        letters = [c for c in str(mbti or '').upper() if c in MBTI_CULTURE_KEYWORDS]
+        if len(letters) != 4: return 0.5
+        return sum(1 for c in letters if any(k in text for k in MBTI_CULTURE_KEYWORDS[c])) / 4
+
+    @staticmethod
+    def recruitment_score(perk, recruitment_type):
+        affinity = RECRUITMENT_AFFINITY.get(perk, {})
+        recruitment_type = str(recruitment_type or '')
+        scores = [score for name, score in affinity.items() if name in recruitment_type]
+        return max(scores) if scores else 0.5
+
+    def score(self, user_wishes, salon):
+        """候補1件のスコアと内訳を返す"""
+        text = _salon_text(salon)
+        perk = user_wishes.get('perk')
+        features = {
+            'distance': self.distance_score(salon.get('距離')),
+            'perk': self.perk_score(perk, text),
+            'mbti': self.mbti_score(user_wishes.get('mbti'), text),
+            'recruitment': self.recruitment_score(perk, salon.get('募集')),
+        }
+        return sum(self.weights.get(name, 0.0) * value for name, value in features.items()), features
+
+    def rank(self, user_wishes, salons, limit=None):
+        """salons（'距離' 列を含む dict のリスト）をスコアの高い順に並べて返す"""
+        scored = []
+        for salon in salons:
+            total, _ = self.score(user_wishes, salon)
+            distance = self.distance_score(salon.get('距離'))
+            scored.append((-total, -distance, str(salon.get('店舗ID')), salon))
+        scored.sort(key=lambda item: item[:3])
+        ranked = [item[3] for item in scored]
+        return ranked[:limit] if limit is not None else ranked
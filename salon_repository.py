@@ -0,0 +1,150 @@
+import threading
+import time
+import traceback
+
+
+class SalonSnapshot:
+    """ある時点の店舗マスタ全件と、店舗IDの索引（読み取り専用として扱う）"""
+
+    def __init__(self, records, version, loaded_at):
+        self.records = records
+        self.by_id = {str(r.get('店舗ID')): r for r in records}
+        self.version = version
+        self.loaded_at = loaded_at
+
+
+class SalonRepository:
+    """
+    店舗マスタのメモリキャッシュ。
+    - TTL内はメモリ上のスナップショットをそのまま返す
+    - TTL切れ後 stale_seconds 以内は古いスナップショットを返しつつ裏で再読み込み
+    - それ以上古い／未読み込み／invalidate後は同期的に読み込む
+    """
+
+    def __init__(self, loader, ttl_seconds=300, stale_seconds=3600):
+        self._loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self._snapshot = None
+        self._expired = False
+        self._version = 0
+        self._load_lock = threading.Lock()
+        self._flag_lock = threading.Lock()
+        self._refreshing = False
+        self._derived = {}
+        self._builders = {}
+        self._derived_lock = threading.Lock()
+        self._counters = {"loads": 0, "background_refreshes": 0, "load_errors": 0, "hits": 0, "stale_hits": 0}
+        self._last_error = None
+
+    # --- 読み込み ---
+
+    def _load(self):
+        records = self._loader()
+        self._version += 1
+        snapshot = SalonSnapshot(records, self._version, time.time())
+        # 登録済みの派生データは、差し替え前に読み込みスレッド側で作っておく
+        for name, builder in list(self._builders.items()):
+            try:
+                self._store_derived(name, snapshot, builder(snapshot))
+            except Exception as e:
+                print(f"店舗マスタの派生データ({name})の作成に失敗: {e}"); traceback.print_exc()
+        self._snapshot = snapshot
+        self._expired = False
+        self._counters["loads"] += 1
+        return snapshot
+
+    def refresh(self):
+        """店舗マスタを今すぐ読み直す"""
+        with self._load_lock:
+            return self._load()
+
+    def _refresh_in_background(self):
+        with self._flag_lock:
+            if self._refreshing: return
+            self._refreshing = True
+
+        def run():
+            try:
+                with self._load_lock:
+                    self._load()
+                self._counters["background_refreshes"] += 1
+            except Exception as e:
+                self._counters["load_errors"] += 1
+                self._last_error = str(e)
+                print(f"店舗マスタのバックグラウンド更新に失敗: {e}"); traceback.print_exc()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and not self._expired:
+            age = time.time() - snapshot.loaded_at
+            if age <= self.ttl_seconds:
+                self._counters["hits"] += 1
+                return snapshot
+            if age <= self.ttl_seconds + self.stale_seconds:
+                self._counters["stale_hits"] += 1
+                self._refresh_in_background()
+                return snapshot
+
+        with self._load_lock:
+            # 待っている間に別スレッドが読み込んでいればそれを使う
+            if self._snapshot is not None and self._snapshot is not snapshot and not self._expired:
+                return self._snapshot
+            try:
+                return self._load()
+            except Exception as e:
+                self._counters["load_errors"] += 1
+                self._last_error = str(e)
+                raise
+
+    # --- 参照 ---
+
+    def all(self):
+        return self.snapshot().records
+
+    def get(self, salon_id):
+        return self.snapshot().by_id.get(str(salon_id))
+
+    def register_derived(self, name, builder):
+        """
+        スナップショットから作る派生データ（索引など）を登録する。
+        builder はスナップショットを受け取る関数で、店舗マスタを読み込むたびに作り直される。
+        """
+        self._builders[name] = builder
+
+    def _store_derived(self, name, snapshot, value):
+        with self._derived_lock:
+            cached = self._derived.get(name)
+            if not cached or cached[0] < snapshot.version:
+                self._derived[name] = (snapshot.version, value)
+
+    def derived(self, name, snapshot=None):
+        """snapshot（省略時は現在のスナップショット）に対応する派生データを返す"""
+        snapshot = snapshot or self.snapshot()
+        with self._derived_lock:
+            cached = self._derived.get(name)
+            if cached and cached[0] == snapshot.version:
+                return cached[1]
+        value = self._builders[name](snapshot)
+        self._store_derived(name, snapshot, value)
+        return value
+
+    def invalidate(self):
+        """次の参照で必ず読み直させる"""
+        self._expired = True
+
+    def stats(self):
+        snapshot = self._snapshot
+        return dict(
+            self._counters,
+            version=snapshot.version if snapshot else None,
+            salons=len(snapshot.records) if snapshot else 0,
+            age_seconds=round(time.time() - snapshot.loaded_at, 1) if snapshot else None,
+            ttl_seconds=self.ttl_seconds,
+            stale_seconds=self.stale_seconds,
+            last_error=self._last_error,
+        )
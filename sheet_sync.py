@@ -0,0 +1,232 @@
+import json
+import os
+import re
+import threading
+import time
+import traceback
+
+from gspread.utils import rowcol_to_a1
+
+import local_db
+from datastore import SALON_SHEET, TABLES
+from offer_queue import QUEUE_COLUMNS, get_or_create_archive_worksheet
+from sheet_writer import SheetWriteBuffer, call_with_retry
+
+LEASE_STATE_KEY = 'sheet_sync.leader'
+# リースを持たないプロセスから担当プロセスへの依頼（店舗マスタの再読み込み・アーカイブ）
+REQUESTS_STATE_KEY = 'sheet_sync.requests'
+
+
+def _key_range(table):
+    """key 列（2行目から最終行まで）の A1 範囲。例: Offer Queue なら A2:C"""
+    last_col = rowcol_to_a1(1, max(TABLES[table]['key']) + 1).rstrip('1')
+    return f"A2:{last_col}"
+
+
+def _appended_start_row(response):
+    """append_rows のレスポンス（updates.updatedRange: 'シート'!A10:D12）から追記先の先頭行を取り出す"""
+    updated_range = (response or {}).get('updates', {}).get('updatedRange', '')
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    if not match: raise ValueError(f"追記先の行番号を取得できません: {response}")
+    return int(match.group(1))
+
+
+class SheetSync:
+    """
+    LocalStore とスプレッドシートの双方向同期。
+    - push: ローカルで追記・更新した行を、シートごとに batch_update 1回 + append_rows 1回でまとめて書き込む
+    - pull: 運営がシート上で直接編集した内容をローカルに取り込む（未送信のローカル変更は上書きしない）
+    複数プロセスで動かしても同期するのは1プロセスだけになるよう、SQLite 上のリースで担当を決める。
+    シートを読み書きする処理（初回取り込み・管理用の再読み込み・アーカイブ）もリースを持つプロセスだけが行う。
+    """
+
+    def __init__(self, store, sheets, queue_reader, db_path=None, push_interval=5.0, pull_intervals=None,
+                 lease_seconds=60.0, on_salons_pulled=None):
+        self.store = store
+        self.sheets = sheets
+        self.queue_reader = queue_reader
+        self._db_path = db_path
+        self.push_interval = push_interval
+        self.pull_intervals = dict({'users': 60.0, 'offer_queue': 60.0, 'offers': 300.0, 'salons': 300.0}, **(pull_intervals or {}))
+        self.lease_seconds = lease_seconds
+        self._on_salons_pulled = on_salons_pulled
+        # push / pull / アーカイブは行番号を書き換えるので、同時に走らせない
+        self.lock = threading.RLock()
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+        self._last_pull = {}
+        # 行のずれを見つけたシート（次の pull は先頭から読み直す）
+        self._shifted = set()
+        self._initialized = False
+        self._counters = {"pushes": 0, "pushed_cells": 0, "pushed_rows": 0, "pulls": 0, "rows_fixed": 0, "errors": 0}
+        self._last_error = None
+
+    # --- 初期化・起動 ---
+
+    def ensure_initialized(self, wait_seconds=30.0):
+        """
+        まだ一度も取り込んでいないシートがあれば、その場で取り込む。
+        他のプロセスがリースを持っていれば、そのプロセスの取り込みが終わるのを待つ。
+        """
+        if self._initialized: return
+        deadline = time.monotonic() + wait_seconds
+        with self.lock:
+            while True:
+                names = [t for t, spec in TABLES.items() if not self.store.is_pulled(spec['sheet'])]
+                if not self.store.is_pulled(SALON_SHEET): names.append('salons')
+                if not names: break
+                if self._acquire_lease():
+                    for name in names: self.pull(name)
+                    break
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"他のプロセスによるシートの取り込みが終わりません: {names}")
+                time.sleep(0.5)
+            self._initialized = True
+
+    def start(self):
+        """同期スレッドを起動する（fork 後のプロセスでも起動し直せるよう pid で判定）"""
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self._run, name='sheet-sync', daemon=True).start()
+
+    def _acquire_lease(self):
+        now = time.time()
+        conn = local_db.connect(self._db_path)
+        with local_db.transaction(conn):
+            lease = json.loads(local_db.get_state(LEASE_STATE_KEY, 'null', path=self._db_path))
+            if lease and lease['pid'] != os.getpid() and lease['until'] > now: return False
+            local_db.set_state(LEASE_STATE_KEY, json.dumps({'pid': os.getpid(), 'until': now + self.lease_seconds}), path=self._db_path)
+            return True
+
+    def run_as_leader(self, task, **params):
+        """
+        リースを取れれば task（'pull' / 'archive_queue'）をこのプロセスで実行し、(True, 戻り値) を返す。
+        他のプロセスが同期を担当していれば app_state に依頼を残して (False, None) を返す（担当プロセスが次の同期で実行する）。
+        """
+        with self.lock:
+            if self._acquire_lease(): return True, self._tasks()[task](**params)
+        request = {'task': task, 'params': params}
+        conn = local_db.connect(self._db_path)
+        with local_db.transaction(conn):
+            requests = json.loads(local_db.get_state(REQUESTS_STATE_KEY, '[]', path=self._db_path))
+            if request not in requests: requests.append(request)
+            local_db.set_state(REQUESTS_STATE_KEY, json.dumps(requests), path=self._db_path)
+        return False, None
+
+    def _tasks(self):
+        return {'pull': self.pull, 'archive_queue': self.archive_queue}
+
+    def _run_requests(self):
+        conn = local_db.connect(self._db_path)
+        with local_db.transaction(conn):
+            requests = json.loads(local_db.get_state(REQUESTS_STATE_KEY, '[]', path=self._db_path))
+            if requests: local_db.set_state(REQUESTS_STATE_KEY, '[]', path=self._db_path)
+        for request in requests:
+            try:
+                result = self._tasks()[request['task']](**request['params'])
+                print(f"依頼された同期作業 {request['task']} {request['params']} を実行しました: {result}")
+            except Exception as e:
+                self._counters["errors"] += 1
+                self._last_error = str(e)
+                print(f"依頼された同期作業 {request['task']} でエラー: {e}"); traceback.print_exc()
+
+    def _run(self):
+        while True:
+            time.sleep(self.push_interval)
+            try:
+                if not self._acquire_lease(): continue
+                self.ensure_initialized()
+                self.sync_once()
+            except Exception as e:
+                self._counters["errors"] += 1
+                self._last_error = str(e)
+                print(f"シート同期でエラー（次回再試行）: {e}"); traceback.print_exc()
+
+    def sync_once(self):
+        with self.lock:
+            self._run_requests()
+            self.push()
+            now = time.monotonic()
+            for name, interval in self.pull_intervals.items():
+                last = self._last_pull.get(name)
+                if last is None or now - last >= interval:
+                    self.pull(name)
+
+    # --- push ---
+
+    def push(self):
+        with self.lock:
+            if not self.store.has_pending_writes(): return
+            self._counters["pushes"] += 1
+            for table, spec in TABLES.items():
+                worksheet = None
+                updates = self.store.pending_updates(table)
+                if updates:
+                    worksheet = self.sheets.worksheet(spec['sheet'])
+                    # 運営が行を並べ替え・削除していても別の行に書かないよう、key 列を1回読んで行番号を確かめる
+                    fixed = self.store.reindex(table, call_with_retry(lambda: worksheet.get(_key_range(table))))
+                    if fixed:
+                        self._counters["rows_fixed"] += fixed
+                        self._shifted.add(table)
+                        updates = self.store.pending_updates(table)
+                    buffer = SheetWriteBuffer()
+                    for _, sheet_row, values, cols, _ in updates:
+                        for col in cols: buffer.update_cell(worksheet, sheet_row, col, values[col - 1] if col <= len(values) else '', spec['value_input'])
+                    buffer.flush()
+                    for row_id, _, _, cols, version in updates: self.store.mark_updated(table, row_id, version)
+                    self._counters["pushed_cells"] += sum(len(cols) for _, _, _, cols, _ in updates)
+
+                appends = self.store.pending_appends(table)
+                if appends:
+                    worksheet = worksheet or self.sheets.worksheet(spec['sheet'])
+                    response = call_with_retry(lambda: worksheet.append_rows([values for _, values, _ in appends], value_input_option=spec['value_input']))
+                    self.store.mark_appended(table, appends, _appended_start_row(response))
+                    self._counters["pushed_rows"] += len(appends)
+            self.queue_reader.first_pending_row = self.store.first_pending_queue_row()
+
+    # --- pull ---
+
+    def pull(self, name):
+        with self.lock:
+            if name == 'salons':
+                values = call_with_retry(lambda: self.sheets.worksheet(SALON_SHEET).get_all_values())
+                self.store.replace_salons(values[0] if values else [], values[1:])
+                if self._on_salons_pulled: self._on_salons_pulled()
+            elif name == 'offer_queue':
+                # Offer Queue は最初の pending 行から下だけを読む（それより上は送信済み・エラーで変わらない）
+                if 'offer_queue' in self._shifted:
+                    start_row = 2
+                elif self.store.is_pulled(TABLES['offer_queue']['sheet']):
+                    start_row = self.store.first_pending_queue_row()
+                else:
+                    start_row = self.queue_reader.first_pending_row
+                worksheet = self.sheets.worksheet(TABLES['offer_queue']['sheet'])
+                values = call_with_retry(lambda: worksheet.get(f"A{start_row}:D"))
+                if start_row > 2 and not self.store.rows_in_place('offer_queue', values, start_row):
+                    # 読んだ範囲より上で行が挿入・削除されていたら、先頭から読み直して全体を突き合わせる
+                    start_row = 2
+                    values = call_with_retry(lambda: worksheet.get("A2:D"))
+                self.store.apply_pull('offer_queue', QUEUE_COLUMNS, values, start_row=start_row)
+                self.queue_reader.first_pending_row = self.store.first_pending_queue_row()
+            else:
+                worksheet = self.sheets.worksheet(TABLES[name]['sheet'])
+                values = call_with_retry(lambda: worksheet.get_all_values())
+                self.store.apply_pull(name, values[0] if values else [], values[1:])
+            self._shifted.discard(name)
+            self._last_pull[name] = time.monotonic()
+            self._counters["pulls"] += 1
+
+    # --- アーカイブ ---
+
+    def archive_queue(self, older_than_days=30):
+        """未送信の変更を書き込んでから Offer Queue をアーカイブし、ローカルの行番号を合わせる"""
+        with self.lock:
+            self.push()
+            archive_worksheet = get_or_create_archive_worksheet(self.sheets.spreadsheet())
+            archived = self.queue_reader.archive_finished(archive_worksheet, older_than_days=older_than_days)
+            if archived: self.store.shift_queue_rows(archived)
+            return archived
+
+    def stats(self):
+        return dict(self._counters, last_error=self._last_error, store=self.store.stats())
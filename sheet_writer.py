@@ -0,0 +1,133 @@
+import random
+import threading
+import time
+
+from gspread.exceptions import APIError
+from gspread.utils import rowcol_to_a1
+
+# 再試行するステータス（429: 書き込みクォータ超過、5xx: 一時的なエラー）
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def call_with_retry(fn, max_retries=5, backoff_base=1.0, backoff_max=32.0):
+    """Sheets API 呼び出しを 429 / 5xx のときだけ指数バックオフ（ジッター付き）で再試行する"""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except APIError as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status not in RETRYABLE_STATUSES or attempt >= max_retries: raise
+            delay = min(backoff_max, backoff_base * (2 ** attempt)) * (0.5 + random.random() / 2)
+            print(f"Sheets API {status} のため {delay:.1f}秒後に再試行します ({attempt + 1}/{max_retries})")
+            time.sleep(delay)
+
+
+def _coalesce_row_cells(cells):
+    """同じ行で列が連続するセルを1つの範囲にまとめる。cells: {(row, col): value}"""
+    ranges = []
+    for row, col in sorted(cells):
+        value = cells[(row, col)]
+        last = ranges[-1] if ranges else None
+        if last and last['row'] == row and last['col'] + len(last['values']) == col:
+            last['values'].append(value)
+        else:
+            ranges.append({'row': row, 'col': col, 'values': [value]})
+    return [{'range': rowcol_to_a1(r['row'], r['col']), 'values': [r['values']]} for r in ranges]
+
+
+class SheetWriteBuffer:
+    """
+    ワークシートへの書き込み（セル更新・行追加）をためておき、まとめて書き込む。
+    - ワークシート・value_input_option ごとに batch_update 1回 + append_rows 1回に集約する（同じセルへの更新は最後の値だけ）
+    - 通常は flush() / with を抜けたときに書き込む。呼び出し側が flush まで進まなくなったときの保険として、
+      ためた件数が max_pending を超えたとき、最初の書き込みから max_delay 秒経ったときにも書き込む（max_delay=0 でタイマーなし）
+    ユーザーが入力した文字列は 'RAW' で書くこと（'USER_ENTERED' だと = で始まる値が数式になり、電話番号の先頭の 0 が落ちる）。
+    """
+
+    def __init__(self, max_pending=200, max_delay=10.0, max_retries=5):
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self._lock = threading.RLock()
+        self._cells = {}    # (worksheet.id, value_input_option) -> (worksheet, {(row, col): value})
+        self._appends = {}  # (worksheet.id, value_input_option) -> (worksheet, [rows])
+        self._pending = 0
+        self._timer = None
+        self._counters = {"buffered_cells": 0, "buffered_rows": 0, "flushes": 0, "api_calls": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    # --- 書き込みの予約 ---
+
+    def update_cell(self, worksheet, row, col, value, value_input_option='USER_ENTERED'):
+        with self._lock:
+            _, cells = self._cells.setdefault((worksheet.id, value_input_option), (worksheet, {}))
+            cells[(row, col)] = value
+            self._counters["buffered_cells"] += 1
+            self._added()
+
+    def append_row(self, worksheet, row, value_input_option='USER_ENTERED'):
+        self.append_rows(worksheet, [row], value_input_option=value_input_option)
+
+    def append_rows(self, worksheet, rows, value_input_option='USER_ENTERED'):
+        with self._lock:
+            _, pending_rows = self._appends.setdefault((worksheet.id, value_input_option), (worksheet, []))
+            pending_rows.extend(rows)
+            self._counters["buffered_rows"] += len(rows)
+            self._added(len(rows))
+
+    def _added(self, count=1):
+        self._pending += count
+        if self._pending >= self.max_pending:
+            self.flush()
+        elif self._timer is None and self.max_delay:
+            self._timer = threading.Timer(self.max_delay, self._flush_from_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"シート書き込みバッファの定期フラッシュでエラー: {e}")
+
+    # --- 書き込み ---
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            cells, appends = self._cells, self._appends
+            self._cells, self._appends, self._pending = {}, {}, 0
+            if not cells and not appends: return
+            self._counters["flushes"] += 1
+            try:
+                for key, (worksheet, worksheet_cells) in list(cells.items()):
+                    data = _coalesce_row_cells(worksheet_cells)
+                    call_with_retry(lambda: worksheet.batch_update(data, value_input_option=key[1]), self.max_retries)
+                    self._counters["api_calls"] += 1
+                    cells.pop(key)
+                for key, (worksheet, rows) in list(appends.items()):
+                    call_with_retry(lambda: worksheet.append_rows(rows, value_input_option=key[1]), self.max_retries)
+                    self._counters["api_calls"] += 1
+                    appends.pop(key)
+            except Exception:
+                # 書けなかった分は戻しておき、次の flush で再度書き込む
+                for key, (worksheet, worksheet_cells) in cells.items():
+                    _, current = self._cells.setdefault(key, (worksheet, {}))
+                    for position, value in worksheet_cells.items(): current.setdefault(position, value)
+                    self._pending += len(worksheet_cells)
+                for key, (worksheet, rows) in appends.items():
+                    _, current = self._appends.setdefault(key, (worksheet, []))
+                    current[:0] = rows
+                    self._pending += len(rows)
+                raise
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, pending=self._pending)
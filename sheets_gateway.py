@@ -0,0 +1,158 @@
+import os
+import re
+import threading
+import time
+
+import gspread
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+from metrics import outcome_of
+
+# オファー関連のシートはすべてこのスプレッドシートに入っている
+SPREADSHEET_NAME = "店舗マスタ_LUMINA Offer用"
+
+# values:append や :batchUpdate など、URL の末尾の「:メソッド」
+_CUSTOM_METHOD = re.compile(r':([A-Za-z]+)$')
+
+
+def sheets_operation(method, endpoint):
+    """Sheets / Drive API のリクエストを、メトリクス用の種類（read / append / batchUpdate / drive など）にする"""
+    path = endpoint.split('?', 1)[0]
+    if '/drive/' in path: return 'drive'
+    match = _CUSTOM_METHOD.search(path)
+    if match: return match.group(1)
+    return 'read' if method.upper() == 'GET' else method.lower()
+
+
+class SheetsGateway:
+    """
+    プロセス全体で共有する Google Sheets クライアント。
+    認証は一度だけ行い、トークンは期限切れ時にのみ更新する。
+    HTTPセッション（keep-alive）と Spreadsheet / Worksheet のハンドルを使い回す。
+    observer(upstream, operation, 秒, outcome) を渡すと、API リクエスト1回ごとに呼ぶ。
+    """
+
+    def __init__(self, creds_path, pool_size=10, observer=None):
+        self.creds_path = creds_path
+        self.pool_size = pool_size
+        self.observer = observer
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._client = None
+        self._client_pid = None
+        self._spreadsheets = {}
+        self._worksheets = {}
+        self._counters = {
+            "client_created": 0,
+            "auth_refreshes": 0,
+            "spreadsheet_opens": 0,
+            "worksheet_fetches": 0,
+            "handle_cache_hits": 0,
+        }
+
+    # --- 認証・クライアント ---
+
+    def _build_client(self):
+        credentials = Credentials.from_service_account_file(self.creds_path, scopes=gspread.auth.DEFAULT_SCOPES)
+        self._wrap_refresh(credentials)
+        client = gspread.authorize(credentials)
+
+        # gspread 6 系は client.http_client.session、5 系は client.session
+        http_client = getattr(client, "http_client", client)
+        session = getattr(http_client, "session", None)
+        if session is not None:
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+        if self.observer is not None and hasattr(http_client, "request"):
+            self._wrap_request(http_client)
+        self._counters["client_created"] += 1
+        return client
+
+    def _wrap_request(self, http_client):
+        # gspread のすべての API 呼び出しは http_client.request を通るので、ここで時間を測る
+        original_request = http_client.request
+
+        def observed_request(method, endpoint, *args, **kwargs):
+            started = time.perf_counter()
+            operation = sheets_operation(method, endpoint)
+            try:
+                response = original_request(method, endpoint, *args, **kwargs)
+            except Exception as e:
+                self.observer("sheets", operation, time.perf_counter() - started, outcome_of(error=e))
+                raise
+            self.observer("sheets", operation, time.perf_counter() - started, outcome_of(status=response.status_code))
+            return response
+
+        http_client.request = observed_request
+
+    def _wrap_refresh(self, credentials):
+        # トークン更新を数えつつ、複数スレッドからの同時更新を1回にまとめる
+        original_refresh = credentials.refresh
+
+        def counted_refresh(auth_request):
+            token_before = credentials.token
+            with self._refresh_lock:
+                if credentials.token != token_before and credentials.valid:
+                    return
+                original_refresh(auth_request)
+                self._counters["auth_refreshes"] += 1
+
+        credentials.refresh = counted_refresh
+
+    def _reset_if_forked(self):
+        # fork 後の子プロセスでは、親プロセスの接続とハンドルを使わずに作り直す（_lock を持っている間に呼ぶこと）
+        if self._client is not None and self._client_pid != os.getpid():
+            self._client = None
+            self._spreadsheets.clear()
+            self._worksheets.clear()
+
+    def client(self):
+        with self._lock:
+            self._reset_if_forked()
+            if self._client is None:
+                self._client = self._build_client()
+                self._client_pid = os.getpid()
+            return self._client
+
+    # --- ハンドルキャッシュ ---
+
+    def spreadsheet(self, title=SPREADSHEET_NAME):
+        with self._lock:
+            self._reset_if_forked()
+            spreadsheet = self._spreadsheets.get(title)
+            if spreadsheet is not None:
+                self._counters["handle_cache_hits"] += 1
+                return spreadsheet
+            spreadsheet = self.client().open(title)
+            self._counters["spreadsheet_opens"] += 1
+            self._spreadsheets[title] = spreadsheet
+            return spreadsheet
+
+    def worksheet(self, name, title=SPREADSHEET_NAME):
+        key = (title, name)
+        with self._lock:
+            self._reset_if_forked()
+            worksheet = self._worksheets.get(key)
+            if worksheet is not None:
+                self._counters["handle_cache_hits"] += 1
+                return worksheet
+            worksheet = self.spreadsheet(title).worksheet(name)
+            self._counters["worksheet_fetches"] += 1
+            self._worksheets[key] = worksheet
+            return worksheet
+
+    def invalidate(self, title=None):
+        """シートの追加・名称変更などでハンドルが古くなった場合に呼ぶ"""
+        with self._lock:
+            if title is None:
+                self._spreadsheets.clear()
+                self._worksheets.clear()
+                return
+            self._spreadsheets.pop(title, None)
+            for key in [k for k in self._worksheets if k[0] == title]:
+                del self._worksheets[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, cached_spreadsheets=len(self._spreadsheets), cached_worksheets=len(self._worksheets))